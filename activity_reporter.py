@@ -1,56 +1,177 @@
 """
 קובץ פשוט לדיווח פעילות - העתק את הקובץ הזה לכל בוט
+
+הדיווח לא כותב למונגו בזמן האירוע: report_activity רק מעדכן מונה בזיכרון
+(מאוחד לפי user_id), ות'רד רקע כותב הכל ב-bulk_write כל FLUSH_INTERVAL
+שניות או כשמצטברים FLUSH_MAX_EVENTS אירועים.
+
+החיבור למונגו נוצר רק בכתיבה הראשונה (בת'רד הרקע), כך שעליית הבוט לא תלויה
+ב-DNS/Atlas; בלי URI הדיווח כבוי לגמרי.
 """
-from pymongo import MongoClient
+import time
+import atexit
+import threading
 from datetime import datetime, timezone
 
+from pymongo import MongoClient, UpdateOne
+
+# ברירות מחדל לבאפר
+FLUSH_INTERVAL = 10.0      # שניות בין כתיבות
+FLUSH_MAX_EVENTS = 200     # כתיבה מוקדמת אחרי כמות אירועים כזו
+MAX_PENDING_USERS = 10000  # גבול לתור – מעבר לזה אירועים של משתמשים חדשים נזרקים
+CONNECT_RETRY_SEC = 60.0   # המתנה בין ניסיונות חיבור שנכשלו
+
+
 class SimpleActivityReporter:
-    def __init__(self, mongodb_uri, service_id, service_name=None):
+    def __init__(self, mongodb_uri, service_id, service_name=None, client=None,
+                 flush_interval=FLUSH_INTERVAL, flush_max_events=FLUSH_MAX_EVENTS,
+                 max_pending_users=MAX_PENDING_USERS):
         """
         mongodb_uri: חיבור למונגו (אותו מהבוט המרכזי)
         service_id: מזהה השירות ב-Render
         service_name: שם הבוט (אופציונלי)
+        client: לקוח מוכן (למשל mongomock.MongoClient() או fake בטסטים) במקום MongoClient(mongodb_uri)
         """
+        self.service_id = service_id
+        self.service_name = service_name or service_id
+        self.flush_interval = flush_interval
+        self.flush_max_events = flush_max_events
+        self.max_pending_users = max_pending_users
+
+        # user_id -> [count, last_ts] – איחוד אירועים עד הכתיבה הבאה
+        self._pending = {}
+        self._pending_events = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+        # מונים לבקרה
+        self.dropped = 0
+        self.flushed_events = 0
+        self.flush_errors = 0
+
+        # חיבור עצל: נוצר ב-_connect בכתיבה הראשונה
+        self.mongodb_uri = (mongodb_uri or "").strip()
+        self.client = client
+        self.db = None
+        self.connect_seconds = None   # כמה זמן לקח החיבור (None = עוד לא התחבר)
+        self.connect_error = None
+        self._next_connect_at = 0.0
+
+        # בלי URI ובלי לקוח מוזרק – אין מה לדווח
+        self.enabled = client is not None or bool(self.mongodb_uri)
+
+    @property
+    def connected(self):
+        return self.db is not None
+
+    def _connect(self):
+        """יוצר את הלקוח (קורה בת'רד הרקע). מחזיר True אם יש חיבור."""
+        if self.db is not None:
+            return True
+        if time.monotonic() < self._next_connect_at:
+            return False
+        t0 = time.monotonic()
+        client = None
         try:
-            self.client = MongoClient(mongodb_uri)
+            if self.client is None:
+                client = MongoClient(self.mongodb_uri, serverSelectionTimeoutMS=5000)
+                client.admin.command("ping")
+                self.client = client
             self.db = self.client["render_bot_monitor"]
-            self.service_id = service_id
-            self.service_name = service_name or service_id
-            self.connected = True
-        except:
-            self.connected = False
-            print("⚠️ לא ניתן להתחבר למונגו - פעילות לא תירשם")
-    
+            self.connect_seconds = round(time.monotonic() - t0, 3)
+            self.connect_error = None
+            return True
+        except Exception as e:
+            if client is not None:
+                try:
+                    client.close()
+                except Exception:
+                    pass
+            if self.connect_error is None:
+                print("⚠️ לא ניתן להתחבר למונגו - פעילות תירשם כשהחיבור יחזור")
+            self.connect_error = f"{type(e).__name__}: {e}"
+            self._next_connect_at = time.monotonic() + CONNECT_RETRY_SEC
+            return False
+
     def report_activity(self, user_id):
-        """דיווח פעילות פשוט"""
-        if not self.connected:
+        """דיווח פעילות – נכנס לתור בזיכרון בלבד, לא חוסם"""
+        if not self.enabled:
+            return
+
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            entry = self._pending.get(user_id)
+            if entry is None:
+                if len(self._pending) >= self.max_pending_users:
+                    self.dropped += 1
+                    return
+                self._pending[user_id] = [1, now]
+            else:
+                entry[0] += 1
+                entry[1] = now
+            self._pending_events += 1
+            if self._pending_events >= self.flush_max_events:
+                self._wake.set()
+        self._ensure_thread()
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="activity-reporter", daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """כותב את כל מה שהצטבר בשתי פניות למונגו (bulk לאינטראקציות + עדכון השירות)"""
+        with self._lock:
+            if not self._pending:
+                return
+        if not self._connect():
+            # נשאר בתור עד שהחיבור יצליח
             return
-        
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            events, self._pending_events = self._pending_events, 0
+
         try:
-            now = datetime.now(timezone.utc)
-            
-            # עדכון אינטראקציית המשתמש
-            self.db.user_interactions.update_one(
-                {"service_id": self.service_id, "user_id": user_id},
-                {
-                    "$set": {"last_interaction": now},
-                    "$inc": {"interaction_count": 1},
-                    "$setOnInsert": {"created_at": now}
-                },
-                upsert=True
-            )
-            
+            # עדכון אינטראקציות המשתמשים
+            ops = [
+                UpdateOne(
+                    {"service_id": self.service_id, "user_id": user_id},
+                    {
+                        "$set": {"last_interaction": last_ts},
+                        "$inc": {"interaction_count": count},
+                        "$setOnInsert": {"created_at": last_ts}
+                    },
+                    upsert=True
+                )
+                for user_id, (count, last_ts) in pending.items()
+            ]
+            self.db.user_interactions.bulk_write(ops, ordered=False)
+
             # עדכון פעילות השירות
+            last = max(ts for _, ts in pending.values())
             self.db.service_activity.update_one(
                 {"_id": self.service_id},
                 {
                     "$set": {
-                        "last_user_activity": now,
+                        "last_user_activity": last,
                         "service_name": self.service_name,
-                        "updated_at": now
+                        "updated_at": last
                     },
                     "$setOnInsert": {
-                        "created_at": now,
+                        "created_at": last,
                         "status": "active",
                         "total_users": 0,
                         "suspend_count": 0
@@ -58,12 +179,50 @@ class SimpleActivityReporter:
                 },
                 upsert=True
             )
-            
-        except Exception as e:
-            # שקט - אל תיכשל את הבוט אם יש בעיה
-            pass
+            self.flushed_events += events
+
+        except Exception:
+            # שקט - אל תיכשל את הבוט אם יש בעיה; מחזירים לתור לניסיון הבא (בגבולות התור)
+            self.flush_errors += 1
+            with self._lock:
+                for user_id, (count, last_ts) in pending.items():
+                    entry = self._pending.get(user_id)
+                    if entry is not None:
+                        entry[0] += count
+                        entry[1] = max(entry[1], last_ts)
+                    elif len(self._pending) < self.max_pending_users:
+                        self._pending[user_id] = [count, last_ts]
+                    else:
+                        self.dropped += count
+                        continue
+                    self._pending_events += count
+
+    def close(self):
+        """עצירת ת'רד הרקע וכתיבה אחרונה של מה שנשאר"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+        if self.enabled:
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending_users = len(self._pending)
+            pending_events = self._pending_events
+        return {
+            "pending_users": pending_users,
+            "pending_events": pending_events,
+            "flushed_events": self.flushed_events,
+            "dropped": self.dropped,
+            "flush_errors": self.flush_errors,
+            "enabled": self.enabled,
+            "connected": self.connected,
+            "connect_seconds": self.connect_seconds,
+            "connect_error": self.connect_error,
+        }
 
 # דוגמה לשימוש קל
 def create_reporter(mongodb_uri, service_id, service_name=None):
     """יצירת reporter פשוט"""
-    return SimpleActivityReporter(mongodb_uri, service_id, service_name)
\ No newline at end of file
+    return SimpleActivityReporter(mongodb_uri, service_id, service_name)
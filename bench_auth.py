@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark for Web App init-data validation.
+
+Compares the per-request cost of:
+  - the old path (derive the WebAppData key, then verify)
+  - a full verify with the precomputed key
+  - validate_telegram_webapp_data() after the first call (cache hit)
+
+Usage: python bench_auth.py [iterations]
+"""
+
+import os
+import sys
+import json
+import time
+import hmac
+import hashlib
+import timeit
+from urllib.parse import urlencode
+
+os.environ.setdefault("BOT_TOKEN", "123456:bench-token")
+os.environ.setdefault("PY_WORKERS", "0")
+
+import webapp_server as core  # noqa: E402
+
+
+def make_init_data(user_id: int = 1) -> str:
+    """Signed init data, the way Telegram builds it."""
+    fields = {
+        "auth_date": str(int(time.time())),
+        "query_id": "AAHdF6IQAAAAAN0XohDhrOrc",
+        "user": json.dumps({"id": user_id, "first_name": "Bench", "username": "bench", "language_code": "he"}),
+    }
+    check = "\n".join(f"{k}={fields[k]}" for k in sorted(fields))
+    fields["hash"] = hmac.new(core.WEBAPP_SECRET_KEY, check.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+def verify_uncached_old(init_data: str):
+    """The pre-cache behaviour: key derived on every call."""
+    hmac.new(b"WebAppData", core.BOT_TOKEN.encode(), hashlib.sha256).digest()
+    return core._verify_init_data(init_data)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    init_data = make_init_data()
+    assert core.validate_telegram_webapp_data(init_data)["user"]["id"] == 1
+
+    cases = [
+        ("derive key + verify (old)", lambda: verify_uncached_old(init_data)),
+        ("verify, precomputed key", lambda: core._verify_init_data(init_data)),
+        ("validate, cache hit", lambda: core.validate_telegram_webapp_data(init_data)),
+    ]
+    base = None
+    for name, fn in cases:
+        per_call = min(timeit.repeat(fn, number=n, repeat=3)) / n
+        base = base or per_call
+        print(f"{name:28s} {per_call * 1e6:8.2f} us/call  x{base / per_call:5.1f}")
+    print("cache:", core.AUTH_CACHE.stats())
+
+
+if __name__ == "__main__":
+    main()
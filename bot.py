@@ -12,19 +12,30 @@ import textwrap
 import subprocess
 import zipfile  # נשאר אם תרצה להשתמש בהמשך
 import io
+import gzip
 import traceback
 import contextlib
 import re
 import hashlib
+import hmac
+import base64
 import secrets
 import random
 import inspect
 import ast
+import functools
+import contextvars
 
 from activity_reporter import create_reporter
+from py_pool import create_pool_from_env
+from py_contexts import PythonContexts
+from js_worker import run_js, reset_js
+from java_daemon import run_java
+from scheduler import SCHEDULER, JobCancelled, QueueFull, classify as classify_job
+from session_store import ShellSessions
 from telegram import Update, InlineQueryResultArticle, InputTextMessageContent, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import Application, CommandHandler, ContextTypes, InlineQueryHandler, CallbackQueryHandler, ChosenInlineResultHandler, MessageHandler, filters
-from telegram.error import NetworkError, TimedOut, Conflict, BadRequest
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, ContextTypes, InlineQueryHandler, CallbackQueryHandler, ChosenInlineResultHandler, MessageHandler, filters
+from telegram.error import NetworkError, TimedOut, Conflict, BadRequest, RetryAfter
 
 # Import shared utilities
 from shared_utils import (
@@ -36,10 +47,14 @@ from shared_utils import (
     truncate as _truncate_base,
     is_safe_pip_name,
     exec_python_in_context,
-    run_js_blocking,
-    run_java_blocking,
-    run_shell_blocking,
+    RunCanceller,
+    cancellable,
+    run_shell_async,
+    stream_shell_async,
     handle_builtins,
+    TTLCache,
+    CommandIndex,
+    parse_cmds_string,
 )
 
 # ==== תצורה ====
@@ -49,9 +64,28 @@ PIP_TIMEOUT = int(os.getenv("PIP_TIMEOUT", "120"))
 MAX_OUTPUT = int(os.getenv("MAX_OUTPUT", "10000"))
 TG_MAX_MESSAGE = int(os.getenv("TG_MAX_MESSAGE", "4000"))
 RESTART_NOTIFY_PATH = os.getenv("RESTART_NOTIFY_PATH", "/tmp/bot_restart_notify.json")
+# הזרמת פלט /sh: עריכת הודעה אחת תוך כדי ריצה (כבוי עם SH_STREAM=0)
+SH_STREAM = os.getenv("SH_STREAM", "1").lower() in ("1", "true", "yes", "on")
+SH_STREAM_INTERVAL = float(os.getenv("SH_STREAM_INTERVAL", "1.0"))
+# מצב webhook: כשמוגדר BOT_WEBHOOK_URL (כתובת ציבורית בסיסית) טלגרם דוחף עדכונים לשרת
+# ה-webhook המובנה של PTB במקום polling. אם ההפעלה נכשלת – חוזרים ל-polling.
+WEBHOOK_URL = os.getenv("BOT_WEBHOOK_URL", "").strip().rstrip("/")
+WEBHOOK_PATH = os.getenv("BOT_WEBHOOK_PATH", "telegram-webhook").strip().strip("/")
+WEBHOOK_LISTEN = os.getenv("BOT_WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("BOT_WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET", "").strip()
+# כתובת Bot API חלופית (למשל שרת טלגרם מזויף מקומי לבדיקות)
+BOT_API_BASE_URL = os.getenv("BOT_API_BASE_URL", "").strip().rstrip("/")
+BOT_DELIVERY_MODE = "polling"  # מתעדכן ב-main
+# עיבוד עדכונים מקבילי: עד BOT_CONCURRENCY עדכונים רצים יחד (צ'אטים שונים); 1 = אחד אחרי השני
+BOT_CONCURRENCY = int(os.getenv("BOT_CONCURRENCY", "8"))
+# קבצי פלט מעל הגודל הזה (KB) נשלחים דחוסים כ-.gz (0 = אף פעם)
+OUTPUT_GZIP_MIN_KB = int(os.getenv("OUTPUT_GZIP_MIN_KB", "512"))
 
 # In-memory allowlist - loaded from shared_utils
 ALLOWED_CMDS = load_allowed_cmds()
+# אינדקס חיפוש להצעות באינליין; מתעדכן יחד עם ALLOWED_CMDS (allow/deny/update)
+ALLOWED_CMDS_INDEX = CommandIndex(ALLOWED_CMDS)
 
 ALLOW_ALL_COMMANDS = os.getenv("ALLOW_ALL_COMMANDS", "").lower() in ("1", "true", "yes", "on")
 SHELL_EXECUTABLE = os.getenv("SHELL_EXECUTABLE") or ("/bin/bash" if os.path.exists("/bin/bash") else None)
@@ -61,6 +95,7 @@ def load_allowed_cmds_from_file() -> None:
     """Load allowed commands from file if it exists; otherwise keep current (env/default)."""
     global ALLOWED_CMDS
     ALLOWED_CMDS = load_allowed_cmds()
+    ALLOWED_CMDS_INDEX.replace(ALLOWED_CMDS)
 
 
 def save_allowed_cmds_to_file() -> None:
@@ -75,22 +110,37 @@ reporter = create_reporter(
 )
 
 # ==== גלובלי לסשנים ====
-sessions = {}
+# cwd/env לכל צ'אט, בחנות המשותפת ל-Web App (SESSION_STORE=memory|sqlite, ראו session_store.py)
+sessions = ShellSessions("shell")
 
 # ==== הקשר גלובלי לסשן פייתון מתמשך (לפי chat_id) ====
-# מיפוי chat_id -> context dict לשמירת מצב פייתון לכל צ'אט בנפרד
-PY_CONTEXT = {}
+# מיפוי chat_id -> context dict לשמירת מצב פייתון לכל צ'אט בנפרד.
+# הקשר שלא נעשה בו שימוש PY_CONTEXT_IDLE_TTL שניות, או מעבר לתקציב PY_CONTEXT_MAX_MB, מפונה
+# (ואם PY_CONTEXT_SPILL_DIR מוגדר – נשמר לדיסק ומשוחזר ב-/py הבא). ראו py_contexts.py
+PY_CONTEXT = PythonContexts()
+
+# ==== בידוד תהליכים ל-/py ====
+# PY_WORKERS>0: כל צ׳אט מקבל תהליך עבודה משלו (פלט מבודד, Timeout אמיתי, כמה ליבות), עד PY_WORKERS תהליכים.
+# ברירת המחדל 0 משאירה את ההרצה בתהליך הבוט כדי ש-update/context יהיו זמינים בקוד.
+PY_POOL = create_pool_from_env(default_size=0)
 
 # ==== איסוף קוד רב-הודעות (/py_start … /py_run) ====
 # מיפוי chat_id -> list[str] של הודעות שנאספו
 PY_COLLECT: dict[int, list[str]] = {}
 
 # ==== הרצה באינליין ====
-INLINE_EXEC_STORE = {}
-INLINE_SESSIONS = {}
+INLINE_SESSIONS = ShellSessions("inline")
 INLINE_EXEC_TTL = int(os.getenv("INLINE_EXEC_TTL", "180"))
 INLINE_EXEC_MAX = int(os.getenv("INLINE_EXEC_MAX", "5000"))
+# טוקן -> רשומת הרצה; תפוגה וחיתוך גודל ב-O(1) (ראו TTLCache)
+INLINE_EXEC_STORE = TTLCache(INLINE_EXEC_TTL, INLINE_EXEC_MAX)
 INLINE_EXEC_SWEEP_SEC = int(os.getenv("INLINE_EXEC_SWEEP_SEC", "300"))
+# השהיה לפני מענה לשאילתת אינליין; אם בינתיים הגיעה שאילתה חדשה מאותו משתמש – הישנה לא נענית
+INLINE_DEBOUNCE_MS = int(os.getenv("INLINE_DEBOUNCE_MS", "250"))
+# user_id -> id של שאילתת האינליין האחרונה שהתקבלה
+_INLINE_LATEST_QUERY: dict[int, str] = {}
+# מפתח לטוקנים הדטרמיניסטיים (החנות בזיכרון בלבד, כך שמספיק מפתח לכל ריצה)
+_INLINE_TOKEN_KEY = secrets.token_bytes(32)
 
 # דגל דיבוג: ניתן להדליק/לכבות עם ENV או פקודות /debug_on /debug_off
 INLINE_DEBUG_FLAG = os.getenv("INLINE_DEBUG", "").lower() in ("1", "true", "yes", "on")
@@ -106,14 +156,7 @@ def _shorten(text: str, limit: int) -> str:
 
 
 def _get_inline_session(session_key: str):
-    sess = INLINE_SESSIONS.get(session_key)
-    if not sess:
-        sess = {
-            "cwd": os.getcwd(),
-            "env": dict(os.environ),
-        }
-        INLINE_SESSIONS[session_key] = sess
-    return sess
+    return INLINE_SESSIONS.get(session_key)
 
 
 def exec_python_in_shared_context(src: str, context_key: int):
@@ -121,12 +164,10 @@ def exec_python_in_shared_context(src: str, context_key: int):
     מחזיר (stdout, stderr, traceback_text | None)
     Uses shared_utils.exec_python_in_context internally.
     """
-    global PY_CONTEXT
-    ctx = PY_CONTEXT.get(context_key)
-    if ctx is None:
-        ctx = {"__builtins__": __builtins__, "__name__": "__main__"}
-        PY_CONTEXT[context_key] = ctx
-    return exec_python_in_context(src, ctx)
+    if PY_POOL is not None:
+        return PY_POOL.execute(context_key, src, TIMEOUT)
+    with PY_CONTEXT.use(context_key) as ctx:
+        return exec_python_in_context(src, ctx)
 
 
 def _trim_for_message(text: str) -> str:
@@ -136,9 +177,23 @@ def _trim_for_message(text: str) -> str:
     return text
 
 
-def _make_refresh_markup(token: str) -> InlineKeyboardMarkup:
+def _inline_token(user_id: int, q: str) -> str:
+    """טוקן קבוע לכל (משתמש, שאילתה): אותה שאילתה מקבלת אותו טוקן לכל סוגי ההרצה ובכל הקשה חוזרת."""
+    digest = hmac.new(_INLINE_TOKEN_KEY, f"{user_id}:{q}".encode("utf-8"), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:12]).decode("ascii")
+
+
+def _inline_exec_token(user_id: int, q: str) -> str:
+    """מחזיר את הטוקן של (user_id, q) ושומר/מרענן את הרשומה שלו בחנות."""
+    token = _inline_token(user_id, q)
+    if not INLINE_EXEC_STORE.touch(token):
+        INLINE_EXEC_STORE[token] = {"q": q, "user_id": user_id, "ts": time.time()}
+    return token
+
+
+def _make_refresh_markup(token: str, run_type: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("🔄 רענון", callback_data=f"refresh:{token}")]
+        [InlineKeyboardButton("🔄 רענון", callback_data=f"refresh:{token}:{run_type}")]
     ])
 
 
@@ -166,63 +221,33 @@ def _split_to_chunks_by_lines(text: str, max_len: int) -> list[str]:
     return chunks
 
 
-def _make_before_run_markup(token: str, total_pages: int, page_idx: int) -> InlineKeyboardMarkup:
+def _make_before_run_markup(token: str, run_type: str, total_pages: int, page_idx: int) -> InlineKeyboardMarkup:
     buttons: list[list[InlineKeyboardButton]] = []
     nav_row: list[InlineKeyboardButton] = []
     if page_idx > 0:
-        nav_row.append(InlineKeyboardButton("⬅️ הקודם", callback_data=f"page:{token}:{page_idx-1}"))
+        nav_row.append(InlineKeyboardButton("⬅️ הקודם", callback_data=f"page:{token}:{page_idx-1}:{run_type}"))
     if page_idx + 1 < total_pages:
-        nav_row.append(InlineKeyboardButton("הבא ➡️", callback_data=f"page:{token}:{page_idx+1}"))
+        nav_row.append(InlineKeyboardButton("הבא ➡️", callback_data=f"page:{token}:{page_idx+1}:{run_type}"))
     if nav_row:
         buttons.append(nav_row)
     buttons.append([
-        InlineKeyboardButton("🔄 רענון", callback_data=f"refresh:{token}"),
-        InlineKeyboardButton("📄 שלח קוד מלא", callback_data=f"sendfull:{token}"),
+        InlineKeyboardButton("🔄 רענון", callback_data=f"refresh:{token}:{run_type}"),
+        InlineKeyboardButton("📄 שלח קוד מלא", callback_data=f"sendfull:{token}:{run_type}"),
     ])
     return InlineKeyboardMarkup(buttons)
 
 
-def prune_inline_exec_store(now_ts: float | None = None) -> tuple[int, int]:
-    """מסיר רשומות פגות תוקף, ומגביל גודל מקסימלי ע"פ זמן ישן ביותר.
-    מחזיר (expired_removed, trimmed_removed).
-    """
-    try:
-        now = float(now_ts) if now_ts is not None else time.time()
-        # הסרת פגי תוקף
-        expired_keys = [k for k, v in INLINE_EXEC_STORE.items() if now - float(v.get("ts", 0)) > INLINE_EXEC_TTL]
-        for k in expired_keys:
-            INLINE_EXEC_STORE.pop(k, None)
-        trimmed = 0
-        # הגבלת גודל
-        if len(INLINE_EXEC_STORE) > INLINE_EXEC_MAX:
-            # מחיקה לפי הישן ביותר
-            by_age = sorted(INLINE_EXEC_STORE.items(), key=lambda kv: float(kv[1].get("ts", 0)))
-            overflow = len(INLINE_EXEC_STORE) - INLINE_EXEC_MAX
-            for i in range(overflow):
-                INLINE_EXEC_STORE.pop(by_age[i][0], None)
-                trimmed += 1
-        return (len(expired_keys), trimmed)
-    except Exception:
-        return (0, 0)
-
-
 # ==== עזר ====
 def allowed(u: Update) -> bool:
     return bool(u.effective_user and u.effective_user.id in OWNER_IDS)
 
 
 def report_nowait(user_id: int) -> None:
-    """מריץ דיווח פעילות ברקע בלי לעכב את הטיפול באירוע."""
+    """מדווח פעילות בלי לעכב את הטיפול באירוע (הדיווח רק נכנס לתור; הכתיבה למונגו ברקע)."""
     try:
-        loop = asyncio.get_running_loop()
-        loop.create_task(asyncio.to_thread(reporter.report_activity, user_id))
-    except RuntimeError:
-        # אין לולאה פעילה – נריץ בת'רד בלי להמתין
-        try:
-            import threading
-            threading.Thread(target=reporter.report_activity, args=(user_id,), daemon=True).start()
-        except Exception:
-            pass
+        reporter.report_activity(user_id)
+    except Exception:
+        pass
 
 def truncate(s: str) -> str:
     """Truncate output to MAX_OUTPUT characters. Uses shared_utils."""
@@ -243,15 +268,42 @@ def _chat_id(update: Update) -> int:
 
 
 def get_session(update: Update):
-    chat_id = _chat_id(update)
-    sess = sessions.get(chat_id)
-    if not sess:
-        sess = {
-            "cwd": os.getcwd(),
-            "env": dict(os.environ),
-        }
-        sessions[chat_id] = sess
-    return sess
+    """סשן ה-shell של הצ'אט; אחרי שינוי (cd/export/unset) יש לשמור עם sessions.save."""
+    return sessions.get(_chat_id(update))
+
+
+def _build_output_preview(text: str) -> str:
+    """תצוגה מקדימה של השורות הראשונות שנכנסות בהודעה אחת + "(output truncated)"."""
+    lines = text.splitlines()
+    preview_lines = []
+    current_len = 0
+    limit = max(0, TG_MAX_MESSAGE - len("(output truncated)\n"))
+    for ln in lines:
+        add_len = len(ln) + (1 if preview_lines else 0)
+        if current_len + add_len > limit:
+            break
+        preview_lines.append(ln)
+        current_len += add_len
+    preview = ("\n".join(preview_lines) + "\n(output truncated)") if preview_lines else "(output truncated)"
+    return preview[:TG_MAX_MESSAGE]
+
+
+def _output_file_payload(text: str, filename: str) -> io.BytesIO:
+    """מכין את קובץ הפלט בזיכרון (בלי קובץ זמני בדיסק); מעל OUTPUT_GZIP_MIN_KB – דחוס."""
+    data = text.encode("utf-8", errors="replace")
+    if OUTPUT_GZIP_MIN_KB > 0 and len(data) >= OUTPUT_GZIP_MIN_KB * 1024:
+        data = gzip.compress(data, compresslevel=6)
+        filename += ".gz"
+    bio = io.BytesIO(data)
+    bio.name = filename
+    return bio
+
+
+async def _send_output_file(update: Update, text: str, filename: str) -> None:
+    """מצרף קובץ עם הפלט המלא."""
+    # קידוד/דחיסה של פלט גדול בת'רד כדי לא לעכב את הלולאה
+    bio = await asyncio.to_thread(_output_file_payload, text, filename)
+    await update.message.reply_document(document=bio, filename=bio.name, caption="(full output)")
 
 
 async def send_output(update: Update, text: str, filename: str = "output.txt"):
@@ -266,37 +318,87 @@ async def send_output(update: Update, text: str, filename: str = "output.txt"):
 
     # שליחת תצוגה מקדימה
     try:
-        lines = text.splitlines()
-        preview_lines = []
-        current_len = 0
-        limit = max(0, TG_MAX_MESSAGE - len("(output truncated)\n"))
-        for ln in lines:
-            add_len = len(ln) + (1 if preview_lines else 0)
-            if current_len + add_len > limit:
-                break
-            preview_lines.append(ln)
-            current_len += add_len
-        preview = ("\n".join(preview_lines) + "\n(output truncated)") if preview_lines else "(output truncated)"
-        await update.message.reply_text(preview[:TG_MAX_MESSAGE])
+        await update.message.reply_text(_build_output_preview(text))
     except Exception:
         # אם נכשל יצירת פריוויו, נמשיך עם קובץ בלבד
         pass
 
-    # קובץ מלא
-    tmp_path = None
-    try:
-        with tempfile.NamedTemporaryFile("w", delete=False, suffix=os.path.splitext(filename)[1] or ".txt", encoding="utf-8") as tf:
-            tf.write(text)
-            tmp_path = tf.name
-        with open(tmp_path, "rb") as fh:
-            await update.message.reply_document(document=fh, filename=filename, caption="(full output)")
-    finally:
+    await _send_output_file(update, text, filename)
+
+
+class StreamingReply:
+    """הודעת טלגרם אחת שמתעדכנת בקצב מוגבל בזמן שהפלט מגיע.
+    - feed() רק מוסיף לבאפר (סינכרוני, נקרא מתוך קוראי ה-pipe)
+    - משימת רקע עורכת את ההודעה לכל היותר פעם ב-interval שניות
+    - כשהפלט עובר את TG_MAX_MESSAGE מפסיקים לערוך, והפלט המלא יישלח כקובץ בסיום
+    """
+
+    def __init__(self, update: Update, header: str, interval: float = SH_STREAM_INTERVAL):
+        self.update = update
+        self.header = header
+        self.interval = max(0.3, interval)
+        self.parts: list[str] = []
+        self.size = len(header)
+        self.message = None
+        self.overflow = False
+        self._dirty = False
+        self._last_text = ""
+        self._task: asyncio.Task | None = None
+
+    async def start(self) -> None:
+        self._last_text = self.header + "⏳ …"
+        self.message = await self.update.message.reply_text(self._last_text)
+        self._task = asyncio.create_task(self._edit_loop())
+
+    def feed(self, text: str, _is_stderr: bool = False) -> None:
+        # שומרים רק את מה שנכנס להודעה; הפלט המלא (החסום) מגיע מ-stream_shell_async
+        if self.size <= TG_MAX_MESSAGE:
+            self.parts.append(text)
+        self.size += len(text)
+        self._dirty = True
+
+    def text(self) -> str:
+        return self.header + "".join(self.parts)
+
+    async def _edit(self, text: str) -> None:
+        if not self.message or text == self._last_text:
+            return
         try:
-            if tmp_path and os.path.exists(tmp_path):
-                os.remove(tmp_path)
-        except Exception:
+            await self.message.edit_text(text)
+            self._last_text = text
+        except RetryAfter as e:
+            # Flood limit – מחכים כמה שטלגרם ביקש ומדלגים על העריכה הזו
+            await asyncio.sleep(float(getattr(e, "retry_after", 1) or 1))
+        except BadRequest:
+            # למשל "message is not modified"
             pass
 
+    async def _edit_loop(self) -> None:
+        while not self.overflow:
+            await asyncio.sleep(self.interval)
+            if not self._dirty:
+                continue
+            self._dirty = False
+            if self.size > TG_MAX_MESSAGE:
+                self.overflow = True
+                note = "\n…(הפלט ממשיך – קובץ מלא יצורף בסיום)"
+                await self._edit(self.text()[: max(0, TG_MAX_MESSAGE - len(note))] + note)
+                break
+            await self._edit(self.text())
+
+    async def finish(self, final_text: str, filename: str = "output.txt") -> None:
+        """עוצר את העריכות ומציג את התוצאה הסופית (עם קובץ אם ארוכה מדי)."""
+        if self._task:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await self._task
+        final_text = final_text or "(no output)"
+        if len(final_text) <= TG_MAX_MESSAGE:
+            await self._edit(final_text)
+            return
+        await self._edit(_build_output_preview(final_text))
+        await _send_output_file(self.update, final_text, filename)
+
 
 # Load allowlist from file at import time (fallback to ENV/default already set)
 load_allowed_cmds_from_file()
@@ -324,7 +426,7 @@ async def on_post_init(app: Application) -> None:
         if INLINE_DEBUG_FLAG:
             try:
                 for oid in (OWNER_IDS or set()):
-                    await app.bot.send_message(chat_id=oid, text="🟢 הבוט עלה (polling)")
+                    await app.bot.send_message(chat_id=oid, text=f"🟢 הבוט עלה ({BOT_DELIVERY_MODE})")
             except Exception:
                 pass
     except Exception:
@@ -423,7 +525,7 @@ async def start(update: Update, _: ContextTypes.DEFAULT_TYPE):
             "/js <קוד JS>\n"
             "/java <קוד Java>\n"
             "/webapp → פתיחת ממשק Web App\n"
-            "/health\n/restart\n/env\n/reset\n/clear\n/allow,/deny,/list,/update (מנהלי הרשאות לבעלים בלבד)\n"
+            "/health\n/restart\n/env\n/reset\n/clear\n/cancel\n/allow,/deny,/list,/update (מנהלי הרשאות לבעלים בלבד)\n"
             "(תמיכה ב-cd/export/unset, ושמירת cwd/env לסשן)"
         )
     
@@ -506,7 +608,8 @@ async def show_commands_callback(update: Update, _: ContextTypes.DEFAULT_TYPE):
         "<b>ניהול סשן:</b>\n"
         "• /env - הצגת משתני סביבה\n"
         "• /reset - איפוס cwd/env\n"
-        "• /clear - ניקוי מלא של הסשן\n\n"
+        "• /clear - ניקוי מלא של הסשן\n"
+        "• /cancel - ביטול הרצות שממתינות בתור או רצות\n\n"
         "<b>ניהול הרשאות (בעלים בלבד):</b>\n"
         "• /list - רשימת פקודות מאושרות\n"
         "• /allow <cmd> - הוספת פקודה\n"
@@ -538,7 +641,7 @@ async def back_to_start_callback(update: Update, _: ContextTypes.DEFAULT_TYPE):
 
 async def inline_query(update: Update, _: ContextTypes.DEFAULT_TYPE):
     """תמיכה במצב אינליין: מציע תוצאות מסוג InlineQueryResultArticle.
-    - מסנן מתוך ALLOWED_CMDS לפי הטקסט שהוקלד
+    - מסנן מתוך ALLOWED_CMDS לפי הטקסט שהוקלד (אינדקס ALLOWED_CMDS_INDEX)
     - מחזיר פאגינציה בעזרת next_offset
     - מוסיף קיצורי דרך להרצת /sh או /py עם הטקסט המלא
     """
@@ -546,6 +649,14 @@ async def inline_query(update: Update, _: ContextTypes.DEFAULT_TYPE):
         user_id = update.inline_query.from_user.id if update.inline_query and update.inline_query.from_user else 0
     except Exception:
         user_id = 0
+    # Debounce: בהקלדה מהירה רק השאילתה האחרונה נענית (דפדוף עם offset לא מושהה)
+    if INLINE_DEBOUNCE_MS > 0 and update.inline_query and not update.inline_query.offset:
+        iq_id = update.inline_query.id
+        _INLINE_LATEST_QUERY[user_id] = iq_id
+        await asyncio.sleep(INLINE_DEBOUNCE_MS / 1000)
+        if _INLINE_LATEST_QUERY.get(user_id) != iq_id:
+            return
+        _INLINE_LATEST_QUERY.pop(user_id, None)
     report_nowait(user_id)
     # הודעת דיבוג חד פעמית לבעלים כדי לוודא שאינליין מגיע
     if INLINE_DEBUG_FLAG:
@@ -566,69 +677,35 @@ async def inline_query(update: Update, _: ContextTypes.DEFAULT_TYPE):
         current_offset = 0
 
     PAGE_SIZE = 10
-    # ניקוי קל לפני יצירת טוקנים חדשים
-    prune_inline_exec_store()
     results = []
     is_owner = allowed(update)
     qhash = hashlib.sha1(q.encode("utf-8")).hexdigest()[:12] if q else "noq"
 
     # קיצורי דרך: חזרה למצב פשוט – כרטיסי הרצה עם כפתור רענון
+    # טוקן אחד לכל (משתמש, שאילתה), משותף לכל סוגי ההרצה; הסוג עובר ב-id וב-callback
     if q and current_offset == 0 and is_owner:
-        token = secrets.token_urlsafe(8)
-        INLINE_EXEC_STORE[token] = {"type": "sh", "q": q, "user_id": user_id, "ts": time.time()}
-        results.append(
-            InlineQueryResultArticle(
-                id=f"run:{token}:sh:{current_offset}",
-                title=_shorten(f"להריץ ב-/sh: {q}", 64),
-                description=_shorten("יופיע 'מריץ…' ואז לחיצה על הכפתור תריץ", 120),
-                input_message_content=InputTextMessageContent("⏳ מריץ…"),
-                reply_markup=_make_refresh_markup(token),
-            )
+        token = _inline_exec_token(user_id, q)
+        run_cards = (
+            ("sh", f"להריץ ב-/sh: {q}"),
+            ("py", "להריץ ב-/py (בלוק קוד)"),
+            ("js", "להריץ ב-/js (בלוק JS)"),
+            ("java", "להריץ ב-/java (בלוק Java)"),
         )
-        token_py = secrets.token_urlsafe(8)
-        INLINE_EXEC_STORE[token_py] = {"type": "py", "q": q, "user_id": user_id, "ts": time.time()}
-        results.append(
-            InlineQueryResultArticle(
-                id=f"run:{token_py}:py:{current_offset}",
-                title=_shorten("להריץ ב-/py (בלוק קוד)", 64),
-                description=_shorten("יופיע 'מריץ…' ואז לחיצה על הכפתור תריץ", 120),
-                input_message_content=InputTextMessageContent("⏳ מריץ…"),
-                reply_markup=_make_refresh_markup(token_py),
-            )
-        )
-        token_js = secrets.token_urlsafe(8)
-        INLINE_EXEC_STORE[token_js] = {"type": "js", "q": q, "user_id": user_id, "ts": time.time()}
-        results.append(
-            InlineQueryResultArticle(
-                id=f"run:{token_js}:js:{current_offset}",
-                title=_shorten("להריץ ב-/js (בלוק JS)", 64),
-                description=_shorten("יופיע 'מריץ…' ואז לחיצה על הכפתור תריץ", 120),
-                input_message_content=InputTextMessageContent("⏳ מריץ…"),
-                reply_markup=_make_refresh_markup(token_js),
-            )
-        )
-        token_java = secrets.token_urlsafe(8)
-        INLINE_EXEC_STORE[token_java] = {"type": "java", "q": q, "user_id": user_id, "ts": time.time()}
-        results.append(
-            InlineQueryResultArticle(
-                id=f"run:{token_java}:java:{current_offset}",
-                title=_shorten("להריץ ב-/java (בלוק Java)", 64),
-                description=_shorten("יופיע 'מריץ…' ואז לחיצה על הכפתור תריץ", 120),
-                input_message_content=InputTextMessageContent("⏳ מריץ…"),
-                reply_markup=_make_refresh_markup(token_java),
+        for run_type, title in run_cards:
+            results.append(
+                InlineQueryResultArticle(
+                    id=f"run:{token}:{run_type}:{current_offset}",
+                    title=_shorten(title, 64),
+                    description=_shorten("יופיע 'מריץ…' ואז לחיצה על הכפתור תריץ", 120),
+                    input_message_content=InputTextMessageContent("⏳ מריץ…"),
+                    reply_markup=_make_refresh_markup(token, run_type),
+                )
             )
-        )
 
-    # הצעות מתוך רשימת הפקודות המותרות, עם פאגינציה
-    candidates = []
+    # הצעות מתוך רשימת הפקודות המותרות, עם פאגינציה (התאמות תחילית קודם; ראו CommandIndex)
+    page_slice, total = [], 0
     if is_owner:
-        candidates = sorted(ALLOWED_CMDS)
-        if q:
-            ql = q.lower()
-            candidates = [c for c in candidates if ql in c.lower()]
-
-    total = len(candidates)
-    page_slice = candidates[current_offset: current_offset + PAGE_SIZE]
+        page_slice, total = ALLOWED_CMDS_INDEX.page(q, current_offset, PAGE_SIZE)
     for cmd in page_slice:
         results.append(
             InlineQueryResultArticle(
@@ -699,225 +776,202 @@ async def inline_query(update: Update, _: ContextTypes.DEFAULT_TYPE):
                     pass
 
 
+def _inline_allowed(q: str) -> bool:
+    """אימות פקודה ראשונה של sh מהאינליין (כשאין ALLOW_ALL_COMMANDS)."""
+    if ALLOW_ALL_COMMANDS:
+        return True
+    try:
+        parts = shlex.split(q, posix=True)
+    except ValueError:
+        parts = []
+    if not parts:
+        return False
+    first_tok = parts[0].strip()
+    return first_tok in ALLOWED_CMDS if first_tok else False
+
+
+async def _inline_execute(user_id: int, run_type: str, q: str) -> str | None:
+    """מריץ קוד מהאינליין (בחירת תוצאה או רענון) דרך המתזמן, כמו /sh /py /js /java:
+    מגבלות התור והמשתמש חלות, ו-/cancel עוצר גם הרצה כזו. מחזיר את הטקסט להצגה, או None לסוג לא נתמך.
+    """
+    if run_type not in ("sh", "py", "js", "java"):
+        return None
+    if run_type == "sh":
+        if not _inline_allowed(q):
+            return "❗ פקודה לא מאושרת"
+        header = f"$ {q}"
+    else:
+        header = normalize_code(textwrap.dedent(q)).strip("\n")
+    try:
+        return await run_scheduled(user_id, run_type, q, lambda: _inline_run(user_id, run_type, q))
+    except QueueFull:
+        return header + "\n\n⛔ יותר מדי הרצות ממתינות – נסו שוב בעוד רגע"
+    except JobCancelled:
+        return header + "\n\n⛔ בוטל"
+
+
+async def _inline_run(user_id: int, run_type: str, q: str) -> str:
+    if run_type == "sh":
+        sess = _get_inline_session(str(user_id))
+        try:
+            shell_exec = SHELL_EXECUTABLE or "/bin/bash"
+            p = await run_shell_async(shell_exec, q, sess["cwd"], sess["env"], TIMEOUT)
+            out = p.stdout or ""
+            err = p.stderr or ""
+            resp = f"$ {q}\n\n{out}"
+            if err:
+                resp += "\nERR:\n" + err
+            return resp
+        except subprocess.TimeoutExpired:
+            return f"$ {q}\n\n⏱️ Timeout"
+        except Exception as e:
+            return f"$ {q}\n\nERR:\n{e}"
+
+    cleaned = textwrap.dedent(q)
+    cleaned = normalize_code(cleaned).strip("\n") + "\n"
+    if run_type == "py":
+        try:
+            out, err, tb_text = await asyncio.wait_for(asyncio.to_thread(exec_python_in_shared_context, cleaned, int(user_id)), timeout=TIMEOUT)
+            parts_out = [cleaned.rstrip() + "\n\n"]
+            if out.strip():
+                parts_out.append(out.rstrip())
+            if err.strip():
+                parts_out.append("STDERR:\n" + err.rstrip())
+            if tb_text and tb_text.strip():
+                parts_out.append(tb_text.rstrip())
+            return "\n".join(parts_out).strip() or "(no output)"
+        except asyncio.TimeoutError:
+            return cleaned.rstrip() + "\n\n⏱️ Timeout"
+        except Exception as e:
+            return cleaned.rstrip() + f"\n\nERR:\n{e}"
+
+    try:
+        sess = _get_inline_session(str(user_id))
+        if run_type == "js":
+            p = await asyncio.to_thread(run_js, f"inline:{user_id}", cleaned, sess["cwd"], sess["env"], TIMEOUT)
+        else:
+            p = await asyncio.to_thread(run_java, cleaned, sess["cwd"], sess["env"], TIMEOUT)
+        out = (p.stdout or "").rstrip()
+        err = (p.stderr or "").rstrip()
+        parts_out = [cleaned.rstrip() + "\n\n"]
+        if out:
+            parts_out.append(out)
+        if err:
+            parts_out.append("STDERR:\n" + err)
+        return "\n".join(parts_out).strip() or "(no output)"
+    except subprocess.TimeoutExpired:
+        return cleaned.rstrip() + "\n\n⏱️ Timeout"
+    except FileNotFoundError:
+        return cleaned.rstrip() + ("\n\n❌ node לא נמצא במערכת" if run_type == "js" else "\n\n❌ javac/java לא נמצאו במערכת")
+    except Exception as e:
+        return cleaned.rstrip() + f"\n\nERR:\n{e}"
+
+
 async def on_chosen_inline_result(update: Update, _: ContextTypes.DEFAULT_TYPE):
     """כאשר המשתמש בוחר תוצאת אינליין, נזהה אם זו תוצאת 'run:' שלנו ונריץ בפועל.
     נחזיר טקסט קצר כי לא ניתן לערוך את ההודעה שנשלחה כבר; במקום זה נשלח למשתמש הודעה אישית.
     """
-    token = None
-    try:
-        chosen = update.chosen_inline_result
-        if not chosen:
-            return
-        result_id = chosen.result_id or ""
-        parts = result_id.split(":")
-        if len(parts) < 4 or parts[0] != "run":
-            return
-        token = parts[1]
-        run_type = parts[2]
-        inline_msg_id = getattr(chosen, "inline_message_id", None)
-        if INLINE_DEBUG_FLAG and OWNER_IDS:
-            try:
-                for oid in OWNER_IDS:
-                    await _.bot.send_message(
-                    chat_id=oid,
-                    text=(
-                        f"🔎 chosen_inline: result_id='{result_id}', type={run_type}, "
-                        f"has_inline_message_id={'yes' if bool(inline_msg_id) else 'no'}"
-                    ),
-                )
-            except Exception:
-                pass
-        data = INLINE_EXEC_STORE.get(token)
-        if not data:
-            return
-        # ניקוי רשומה אם ישנה זמן רב
-        if time.time() - float(data.get("ts", 0)) > INLINE_EXEC_TTL:
-            INLINE_EXEC_STORE.pop(token, None)
-            prune_inline_exec_store()
-            return
-
-        user_id = chosen.from_user.id if chosen.from_user else 0
-        report_nowait(user_id)
-        if user_id not in OWNER_IDS:
-            # אם מי שבחר אינו הבעלים – נשלח לו הודעה פרטית עם הנחיות וה-ID שלו
-            try:
+    chosen = update.chosen_inline_result
+    if not chosen:
+        return
+    result_id = chosen.result_id or ""
+    parts = result_id.split(":")
+    if len(parts) < 4 or parts[0] != "run":
+        return
+    token = parts[1]
+    run_type = parts[2]
+    inline_msg_id = getattr(chosen, "inline_message_id", None)
+    if INLINE_DEBUG_FLAG and OWNER_IDS:
+        try:
+            for oid in OWNER_IDS:
                 await _.bot.send_message(
-                    chat_id=user_id,
-                    text=(
-                        "⛔ אין לך הרשאה להריץ מהאינליין.\n"
-                        f"ה־ID שלך: {user_id}\n"
-                        "אם זה הבוט שלך, קבע OWNER_ID לערך הזה (או הוסף לרשימה) והפעל מחדש."
-                    ),
-                )
-            except Exception:
-                pass
-            return
+                chat_id=oid,
+                text=(
+                    f"🔎 chosen_inline: result_id='{result_id}', type={run_type}, "
+                    f"has_inline_message_id={'yes' if bool(inline_msg_id) else 'no'}"
+                ),
+            )
+        except Exception:
+            pass
+    # רשומה שפג תוקפה לא תוחזר מהחנות
+    data = INLINE_EXEC_STORE.get(token)
+    if not data:
+        return
 
-        q = normalize_code(str(data.get("q", ""))).strip()
-        if not q:
-            return
+    user_id = chosen.from_user.id if chosen.from_user else 0
+    report_nowait(user_id)
+    if user_id not in OWNER_IDS:
+        # אם מי שבחר אינו הבעלים – נשלח לו הודעה פרטית עם הנחיות וה-ID שלו
+        try:
+            await _.bot.send_message(
+                chat_id=user_id,
+                text=(
+                    "⛔ אין לך הרשאה להריץ מהאינליין.\n"
+                    f"ה־ID שלך: {user_id}\n"
+                    "אם זה הבוט שלך, קבע OWNER_ID לערך הזה (או הוסף לרשימה) והפעל מחדש."
+                ),
+            )
+        except Exception:
+            pass
+        return
 
-        # נערוך הרצה בהתאם לסוג
-        text_out = ""
-        if run_type == "sh":
-            # אימות פקודה ראשונה אם צריך
-            allow = True
-            if not ALLOW_ALL_COMMANDS:
-                try:
-                    parts = shlex.split(q, posix=True)
-                except ValueError:
-                    parts = []
-                if not parts:
-                    allow = False
-                else:
-                    first_tok = parts[0].strip()
-                    allow = first_tok in ALLOWED_CMDS if first_tok else False
-            if not allow:
-                text_out = f"❗ פקודה לא מאושרת"
-            else:
-                sess = _get_inline_session(str(user_id))
-                try:
-                    shell_exec = SHELL_EXECUTABLE or "/bin/bash"
-                    p = subprocess.run(
-                        [shell_exec, "-c", q],
-                        capture_output=True,
-                        text=True,
-                        timeout=TIMEOUT,
-                        cwd=sess["cwd"],
-                        env=sess["env"],
-                    )
-                    out = p.stdout or ""
-                    err = p.stderr or ""
-                    resp = f"$ {q}\n\n{out}"
-                    if err:
-                        resp += "\nERR:\n" + err
-                    text_out = resp
-                except subprocess.TimeoutExpired:
-                    text_out = f"$ {q}\n\n⏱️ Timeout"
-                except Exception as e:
-                    text_out = f"$ {q}\n\nERR:\n{e}"
-
-        elif run_type == "py":
-            cleaned = textwrap.dedent(q)
-            cleaned = normalize_code(cleaned).strip("\n") + "\n"
-            try:
-                out, err, tb_text = await asyncio.wait_for(asyncio.to_thread(exec_python_in_shared_context, cleaned, int(user_id)), timeout=TIMEOUT)
-                parts_out = [cleaned.rstrip() + "\n\n"]
-                if out.strip():
-                    parts_out.append(out.rstrip())
-                if err.strip():
-                    parts_out.append("STDERR:\n" + err.rstrip())
-                if tb_text and tb_text.strip():
-                    parts_out.append(tb_text.rstrip())
-                text_out = "\n".join(parts_out).strip() or "(no output)"
-            except asyncio.TimeoutError:
-                text_out = cleaned.rstrip() + "\n\n⏱️ Timeout"
-            except Exception as e:
-                text_out = cleaned.rstrip() + f"\n\nERR:\n{e}"
-        elif run_type == "js":
-            cleaned = textwrap.dedent(q)
-            cleaned = normalize_code(cleaned).strip("\n") + "\n"
-            try:
-                sess = _get_inline_session(str(user_id))
-                p = await asyncio.to_thread(run_js_blocking, cleaned, sess["cwd"], sess["env"], TIMEOUT)
-                out = (p.stdout or "").rstrip()
-                err = (p.stderr or "").rstrip()
-                parts_out = [cleaned.rstrip() + "\n\n"]
-                if out:
-                    parts_out.append(out)
-                if err:
-                    parts_out.append("STDERR:\n" + err)
-                text_out = "\n".join(parts_out).strip() or "(no output)"
-            except subprocess.TimeoutExpired:
-                text_out = cleaned.rstrip() + "\n\n⏱️ Timeout"
-            except FileNotFoundError:
-                text_out = cleaned.rstrip() + "\n\n❌ node לא נמצא במערכת"
-            except Exception as e:
-                text_out = cleaned.rstrip() + f"\n\nERR:\n{e}"
-        elif run_type == "java":
-            cleaned = textwrap.dedent(q)
-            cleaned = normalize_code(cleaned).strip("\n") + "\n"
-            try:
-                sess = _get_inline_session(str(user_id))
-                p = await asyncio.to_thread(run_java_blocking, cleaned, sess["cwd"], sess["env"], TIMEOUT)
-                out = (p.stdout or "").rstrip()
-                err = (p.stderr or "").rstrip()
-                parts_out = [cleaned.rstrip() + "\n\n"]
-                if out:
-                    parts_out.append(out)
-                if err:
-                    parts_out.append("STDERR:\n" + err)
-                text_out = "\n".join(parts_out).strip() or "(no output)"
-            except subprocess.TimeoutExpired:
-                text_out = cleaned.rstrip() + "\n\n⏱️ Timeout"
-            except FileNotFoundError:
-                text_out = cleaned.rstrip() + "\n\n❌ javac/java לא נמצאו במערכת"
-            except Exception as e:
-                text_out = cleaned.rstrip() + f"\n\nERR:\n{e}"
-        else:
-            return
+    q = normalize_code(str(data.get("q", ""))).strip()
+    if not q:
+        return
 
-        text_out = _trim_for_message(text_out)
+    # נריץ בהתאם לסוג, דרך המתזמן כמו הפקודות
+    text_out = await _inline_execute(user_id, run_type, q)
+    if text_out is None:
+        return
 
-        # אם יש inline_message_id – נערוך את הודעת האינליין בצ'אט היעד
-        if inline_msg_id:
-            try:
-                full_text = text_out
-                display_text = full_text if len(full_text) <= INLINE_PREVIEW_MAX else (full_text[:INLINE_PREVIEW_MAX] + "\n\n…(נשלח קובץ מלא בפרטי)")
-                # סיבוב טוקן חדש כדי לאפשר רענון נוסף
-                new_token = secrets.token_urlsafe(8)
-                INLINE_EXEC_STORE[new_token] = {"type": run_type, "q": q, "user_id": user_id, "ts": time.time()}
-                prune_inline_exec_store()
-                await _.bot.edit_message_text(inline_message_id=inline_msg_id, text=display_text, reply_markup=_make_refresh_markup(new_token))
-                if INLINE_DEBUG_FLAG and OWNER_IDS:
-                    try:
-                        for oid in OWNER_IDS:
-                            await _.bot.send_message(chat_id=oid, text="✏️ inline_message נערך בהצלחה")
-                    except Exception:
-                        pass
-            except Exception:
-                # נפילה חכמה: שליחת הודעה פרטית לבעלים
+    text_out = _trim_for_message(text_out)
+
+    # אם יש inline_message_id – נערוך את הודעת האינליין בצ'אט היעד
+    if inline_msg_id:
+        try:
+            full_text = text_out
+            display_text = full_text if len(full_text) <= INLINE_PREVIEW_MAX else (full_text[:INLINE_PREVIEW_MAX] + "\n\n…(נשלח קובץ מלא בפרטי)")
+            # אותו טוקן ממשיך לשמש לרענון (רק התוקף שלו מתחדש)
+            INLINE_EXEC_STORE.touch(token)
+            await _.bot.edit_message_text(inline_message_id=inline_msg_id, text=display_text, reply_markup=_make_refresh_markup(token, run_type))
+            if INLINE_DEBUG_FLAG and OWNER_IDS:
                 try:
-                    new_token = secrets.token_urlsafe(8)
-                    INLINE_EXEC_STORE[new_token] = {"type": run_type, "q": q, "user_id": user_id, "ts": time.time()}
-                    prune_inline_exec_store()
-                    await _.bot.send_message(chat_id=user_id, text=display_text, reply_markup=_make_refresh_markup(new_token))
-                    if INLINE_DEBUG_FLAG and OWNER_IDS:
-                        try:
-                            for oid in OWNER_IDS:
-                                await _.bot.send_message(chat_id=oid, text="⚠️ עריכה נכשלה – נשלחה הודעה פרטית")
-                        except Exception:
-                            pass
+                    for oid in OWNER_IDS:
+                        await _.bot.send_message(chat_id=oid, text="✏️ inline_message נערך בהצלחה")
                 except Exception:
                     pass
-        else:
-            # אין מזהה הודעת אינליין – שליחה פרטית לבעלים
+        except Exception:
+            # נפילה חכמה: שליחת הודעה פרטית לבעלים
             try:
-                full_text = text_out
-                display_text = full_text if len(full_text) <= INLINE_PREVIEW_MAX else (full_text[:INLINE_PREVIEW_MAX] + "\n\n…(נשלח קובץ מלא בפרטי)")
-                new_token = secrets.token_urlsafe(8)
-                INLINE_EXEC_STORE[new_token] = {"type": run_type, "q": q, "user_id": user_id, "ts": time.time()}
-                prune_inline_exec_store()
-                await _.bot.send_message(chat_id=user_id, text=display_text, reply_markup=_make_refresh_markup(new_token))
+                await _.bot.send_message(chat_id=user_id, text=display_text, reply_markup=_make_refresh_markup(token, run_type))
                 if INLINE_DEBUG_FLAG and OWNER_IDS:
                     try:
                         for oid in OWNER_IDS:
-                            await _.bot.send_message(chat_id=oid, text="ℹ️ אין inline_message_id – נשלחה הודעה פרטית")
+                            await _.bot.send_message(chat_id=oid, text="⚠️ עריכה נכשלה – נשלחה הודעה פרטית")
                     except Exception:
                         pass
             except Exception:
                 pass
-    finally:
-        # מחיקה רכה של הטוקן
+    else:
+        # אין מזהה הודעת אינליין – שליחה פרטית לבעלים
         try:
-            if token:
-                INLINE_EXEC_STORE.pop(token, None)
-            prune_inline_exec_store()
+            full_text = text_out
+            display_text = full_text if len(full_text) <= INLINE_PREVIEW_MAX else (full_text[:INLINE_PREVIEW_MAX] + "\n\n…(נשלח קובץ מלא בפרטי)")
+            INLINE_EXEC_STORE.touch(token)
+            await _.bot.send_message(chat_id=user_id, text=display_text, reply_markup=_make_refresh_markup(token, run_type))
+            if INLINE_DEBUG_FLAG and OWNER_IDS:
+                try:
+                    for oid in OWNER_IDS:
+                        await _.bot.send_message(chat_id=oid, text="ℹ️ אין inline_message_id – נשלחה הודעה פרטית")
+                except Exception:
+                    pass
         except Exception:
             pass
 
 async def handle_refresh_callback(update: Update, _: ContextTypes.DEFAULT_TYPE):
-    """כפתור רענון: מריץ שוב לפי הטוקן ושומר טוקן חדש, מעדכן את ההודעה במקום."""
+    """כפתור רענון: מריץ שוב לפי הטוקן ומעדכן את ההודעה במקום.
+    פורמט: refresh:<token>:<type> (ובתאימות לאחור refresh:<token> עם הסוג שנשמר ברשומה).
+    """
     query = update.callback_query
     if not query:
         return
@@ -926,7 +980,8 @@ async def handle_refresh_callback(update: Update, _: ContextTypes.DEFAULT_TYPE):
         return
     # שליחת קוד מלא בפרטי
     if data.startswith("sendfull:"):
-        token = data.split(":", 1)[1]
+        parts = data.split(":")
+        token = parts[1]
         rec = INLINE_EXEC_STORE.get(token)
         if not rec:
             return
@@ -935,7 +990,7 @@ async def handle_refresh_callback(update: Update, _: ContextTypes.DEFAULT_TYPE):
         q = str(rec.get("q", ""))
         try:
             bio = io.BytesIO(q.encode("utf-8"))
-            rtype = rec.get("type")
+            rtype = parts[2] if len(parts) > 2 else rec.get("type")
             if rtype == "py":
                 bio.name = "inline-code.py"
             elif rtype == "js":
@@ -959,8 +1014,9 @@ async def handle_refresh_callback(update: Update, _: ContextTypes.DEFAULT_TYPE):
     # דפדוף עמודים לפני הרצה
     if data.startswith("page:"):
         try:
-            _, token, page_str = data.split(":", 2)
-            page_idx = int(page_str)
+            parts = data.split(":")
+            token = parts[1]
+            page_idx = int(parts[2])
         except Exception:
             return
         rec = INLINE_EXEC_STORE.get(token)
@@ -969,18 +1025,19 @@ async def handle_refresh_callback(update: Update, _: ContextTypes.DEFAULT_TYPE):
         if query.from_user and rec.get("user_id") != query.from_user.id:
             return
         q = str(rec.get("q", ""))
-        run_type = rec.get("type")
+        run_type = parts[3] if len(parts) > 3 else rec.get("type")
         pages = _split_to_chunks_by_lines((f"$ {q}" if run_type == "sh" else q), INLINE_PREVIEW_MAX)
         page_idx = max(0, min(page_idx, max(0, len(pages) - 1)))
         rec["page"] = page_idx
         try:
-            await query.edit_message_text(text=f"⏳ מריץ…\n\n{pages[page_idx]}", reply_markup=_make_before_run_markup(token, len(pages), page_idx))
+            await query.edit_message_text(text=f"⏳ מריץ…\n\n{pages[page_idx]}", reply_markup=_make_before_run_markup(token, run_type, len(pages), page_idx))
             await query.answer()
         except Exception:
             pass
         return
 
-    token = data.split(":", 1)[1]
+    parts = data.split(":")
+    token = parts[1]
     rec = INLINE_EXEC_STORE.get(token)
     if not rec:
         try:
@@ -997,106 +1054,10 @@ async def handle_refresh_callback(update: Update, _: ContextTypes.DEFAULT_TYPE):
             pass
         return
 
-    if time.time() - float(rec.get("ts", 0)) > INLINE_EXEC_TTL:
-        INLINE_EXEC_STORE.pop(token, None)
-        prune_inline_exec_store()
-        try:
-            await query.answer(text="⛔ פג תוקף, נסה שוב מהאינליין", show_alert=False)
-        except Exception:
-            pass
-        return
-
-    run_type = rec.get("type")
+    run_type = parts[2] if len(parts) > 2 else rec.get("type")
     q = normalize_code(str(rec.get("q", ""))).strip()
-    text_out = ""
-    if run_type == "sh":
-        allow = True
-        if not ALLOW_ALL_COMMANDS:
-            try:
-                parts = shlex.split(q, posix=True)
-            except ValueError:
-                parts = []
-            if not parts:
-                allow = False
-            else:
-                first_tok = parts[0].strip()
-                allow = first_tok in ALLOWED_CMDS if first_tok else False
-        if not allow:
-            text_out = "❗ פקודה לא מאושרת"
-        else:
-            sess = _get_inline_session(str(user_id))
-            try:
-                shell_exec = SHELL_EXECUTABLE or "/bin/bash"
-                p = await asyncio.to_thread(run_shell_blocking, shell_exec, q, sess["cwd"], sess["env"], TIMEOUT)
-                out = p.stdout or ""
-                err = p.stderr or ""
-                header = f"$ {q}\n\n"
-                resp = header + out
-                if err:
-                    resp += "\nERR:\n" + err
-                text_out = resp
-            except subprocess.TimeoutExpired:
-                text_out = f"$ {q}\n\n⏱️ Timeout"
-            except Exception as e:
-                text_out = f"$ {q}\n\nERR:\n{e}"
-    elif run_type == "py":
-        cleaned = textwrap.dedent(q)
-        cleaned = normalize_code(cleaned).strip("\n") + "\n"
-        try:
-            out, err, tb_text = await asyncio.wait_for(asyncio.to_thread(exec_python_in_shared_context, cleaned, int(user_id)), timeout=TIMEOUT)
-            parts_out = [cleaned.rstrip() + "\n\n"]
-            if out.strip():
-                parts_out.append(out.rstrip())
-            if err.strip():
-                parts_out.append("STDERR:\n" + err.rstrip())
-            if tb_text and tb_text.strip():
-                parts_out.append(tb_text.rstrip())
-            text_out = "\n".join(parts_out).strip() or "(no output)"
-        except asyncio.TimeoutError:
-            text_out = cleaned.rstrip() + "\n\n⏱️ Timeout"
-        except Exception as e:
-            text_out = cleaned.rstrip() + f"\n\nERR:\n{e}"
-    elif run_type == "js":
-        cleaned = textwrap.dedent(q)
-        cleaned = normalize_code(cleaned).strip("\n") + "\n"
-        try:
-            sess = _get_inline_session(str(user_id))
-            p = await asyncio.to_thread(run_js_blocking, cleaned, sess["cwd"], sess["env"], TIMEOUT)
-            out = (p.stdout or "").rstrip()
-            err = (p.stderr or "").rstrip()
-            parts_out = [cleaned.rstrip() + "\n\n"]
-            if out:
-                parts_out.append(out)
-            if err:
-                parts_out.append("STDERR:\n" + err)
-            text_out = "\n".join(parts_out).strip() or "(no output)"
-        except subprocess.TimeoutExpired:
-            text_out = cleaned.rstrip() + "\n\n⏱️ Timeout"
-        except FileNotFoundError:
-            text_out = cleaned.rstrip() + "\n\n❌ node לא נמצא במערכת"
-        except Exception as e:
-            text_out = cleaned.rstrip() + f"\n\nERR:\n{e}"
-    elif run_type == "java":
-        cleaned = textwrap.dedent(q)
-        cleaned = normalize_code(cleaned).strip("\n") + "\n"
-        try:
-            sess = _get_inline_session(str(user_id))
-            p = await asyncio.to_thread(run_java_blocking, cleaned, sess["cwd"], sess["env"], TIMEOUT)
-            out = (p.stdout or "").rstrip()
-            err = (p.stderr or "").rstrip()
-            parts_out = [cleaned.rstrip() + "\n\n"]
-            if out:
-                parts_out.append(out)
-            if err:
-                parts_out.append("STDERR:\n" + err)
-            text_out = "\n".join(parts_out).strip() or "(no output)"
-        except subprocess.TimeoutExpired:
-            text_out = cleaned.rstrip() + "\n\n⏱️ Timeout"
-        except FileNotFoundError:
-            text_out = cleaned.rstrip() + "\n\n❌ javac/java לא נמצאו במערכת"
-        except Exception as e:
-            text_out = cleaned.rstrip() + f"\n\nERR:\n{e}"
-    else:
+    text_out = await _inline_execute(user_id, run_type, q)
+    if text_out is None:
         try:
             await query.answer(text="⛔ סוג לא נתמך", show_alert=False)
         except Exception:
@@ -1107,11 +1068,9 @@ async def handle_refresh_callback(update: Update, _: ContextTypes.DEFAULT_TYPE):
     display_text = full_text if len(full_text) <= INLINE_PREVIEW_MAX else (full_text[:INLINE_PREVIEW_MAX] + "\n\n…(נשלח קובץ מלא בפרטי)")
 
     try:
-        # אחרי ריצה, נמשיך לאפשר רענון נוסף עם טוקן חדש
-        new_token = secrets.token_urlsafe(8)
-        INLINE_EXEC_STORE[new_token] = {"type": run_type, "q": q, "user_id": user_id, "ts": time.time()}
-        prune_inline_exec_store()
-        await query.edit_message_text(text=display_text, reply_markup=_make_refresh_markup(new_token))
+        # אחרי ריצה, אותו טוקן ממשיך לאפשר רענון נוסף (התוקף מתחדש)
+        INLINE_EXEC_STORE.touch(token)
+        await query.edit_message_text(text=display_text, reply_markup=_make_refresh_markup(token, run_type))
         await query.answer()
     except Exception:
         try:
@@ -1120,13 +1079,6 @@ async def handle_refresh_callback(update: Update, _: ContextTypes.DEFAULT_TYPE):
         except Exception:
             pass
 
-    # נקה טוקן ישן
-    try:
-        INLINE_EXEC_STORE.pop(token, None)
-        prune_inline_exec_store()
-    except Exception:
-        pass
-
     # אם קיצרנו – נשלח קובץ מלא בפרטי
     try:
         if len(full_text) > INLINE_PREVIEW_MAX and user_id:
@@ -1135,6 +1087,108 @@ async def handle_refresh_callback(update: Update, _: ContextTypes.DEFAULT_TYPE):
             await _.bot.send_document(chat_id=user_id, document=bio, caption="(full output)")
     except Exception:
         pass
+
+
+# ==== תור הרצות ====
+async def run_scheduled(user_id: int, kind: str, code: str, run, on_queued=None):
+    """מריץ את run() (פונקציה אסינכרונית) כשהמתזמן המשותף נותן מקום, עם RunCanceller פעיל, ומשחרר.
+    on_queued(position) נקרא (await) כשההרצה ממתינה בתור. מחזיר את מה ש-run() מחזיר.
+    מעלה QueueFull כשיש יותר מדי הרצות ממתינות, ו-JobCancelled כשההרצה בוטלה ב-/cancel (בתור או בזמן ריצה).
+    ביטול הרצה עוצר גם את מה שרץ ב-thread (RunCanceller: הריגת תהליך/worker, או RunCancelled בקוד Python),
+    והמקום במתזמן משתחרר רק אחרי שהעבודה באמת נעצרה.
+    """
+    ticket = SCHEDULER.submit(user_id, classify_job(kind, code), f"/{kind} {code[:40]}")
+    task = asyncio.current_task()
+    loop = asyncio.get_running_loop()
+    active = [True]  # ביטול שמגיע אחרי הסיום לא נוגע במשימה של PTB
+    canceller = RunCanceller()
+
+    def _cancel_task():
+        if active[0]:
+            task.cancel()
+
+    def _on_cancel():
+        canceller.cancel()  # ביטול המשימה לבד לא עוצר עבודה ב-to_thread
+        loop.call_soon_threadsafe(_cancel_task)
+
+    ticket.set_cancel_hook(_on_cancel)
+    # הרצה שממתינה בתור לא תופסת מקום ב-BOT_CONCURRENCY, אחרת הרצות חונות חוסמות את הבוט כולו
+    slot = _RUNNING_SLOT.get()
+    try:
+        if not ticket.granted:
+            if slot is not None:
+                slot.release()
+            if on_queued is not None:
+                await on_queued(ticket.position())
+        await ticket.wait_async()
+        if slot is not None and not slot.held:
+            await slot.acquire()
+        with cancellable(canceller):
+            return await run()
+    except asyncio.CancelledError:
+        # ביטול שלא הגיע מ-/cancel (למשל כיבוי הבוט) ממשיך הלאה
+        if not ticket.cancelled:
+            raise
+        task.uncancel()
+        raise JobCancelled() from None
+    finally:
+        active[0] = False
+        # thread שעוד רץ (אחרי ביטול, או Timeout של wait_for) מחזיק את המקום עד שנעצר
+        if canceller.active:
+            await asyncio.to_thread(canceller.finish, TIMEOUT)
+        ticket.release()
+
+
+def scheduled(kind: str, handler):
+    """עוטף handler של הרצה (/sh, /py, /js, /java) ב-run_scheduled.
+    כשאין מקום פנוי נשלחת הודעת "בתור" עם המיקום; /cancel מבטל המתנה או הרצה.
+    """
+
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not allowed(update) or not update.message:
+            return await handler(update, context)
+        code = (update.message.text or "").partition(" ")[2].strip()
+        notice = None
+
+        async def _queued(position: int):
+            nonlocal notice
+            notice = await update.message.reply_text(f"⏳ בתור – מקום {position} (/cancel לביטול)")
+
+        async def _run():
+            nonlocal notice
+            if notice is not None:
+                with contextlib.suppress(Exception):
+                    await notice.delete()
+                notice = None
+            return await handler(update, context)
+
+        try:
+            return await run_scheduled(update.effective_user.id, kind, code, _run, on_queued=_queued)
+        except QueueFull:
+            report_nowait(update.effective_user.id)
+            return await update.message.reply_text("⛔ יותר מדי הרצות ממתינות – נסו שוב בעוד רגע או /cancel")
+        except JobCancelled:
+            pass
+        if notice is not None:
+            with contextlib.suppress(Exception):
+                return await notice.edit_text("⛔ בוטל")
+        await update.message.reply_text("⛔ בוטל")
+
+    return wrapper
+
+
+async def cancel_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
+    """מבטל את כל ההרצות של המשתמש (או /cancel <id>). עוקף את נעילת הצ'אט, ראו ChatOrderedUpdateProcessor."""
+    report_nowait(update.effective_user.id if update.effective_user else 0)
+    if not allowed(update):
+        return
+    arg = update.message.text.partition(" ")[2].strip()
+    job_id = int(arg) if arg.isdigit() else None
+    n = SCHEDULER.cancel_user(update.effective_user.id, job_id)
+    await update.message.reply_text(f"⛔ בוטלו {n} הרצות" if n else "אין הרצות פעילות")
+
+
 async def sh_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
     report_nowait(update.effective_user.id if update.effective_user else 0)
     if not allowed(update):
@@ -1150,6 +1204,7 @@ async def sh_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
     # Builtins: cd/export/unset
     builtin_resp = handle_builtins(sess, cmdline)
     if builtin_resp is not None:
+        sessions.save(_chat_id(update), sess)
         return await send_output(update, builtin_resp, "builtin.txt")
 
     # אימות: אם ALLOW_ALL_COMMANDS פעיל – אין אימות. אחרת, תמיד מאמתים את הטוקן הראשון
@@ -1164,17 +1219,13 @@ async def sh_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
         if first_token and first_token not in ALLOWED_CMDS:
             return await update.message.reply_text(f"❗ פקודה לא מאושרת: {first_token}")
 
+    if SH_STREAM:
+        return await _sh_stream(update, cmdline, sess)
+
     # הרצה בשלם (תומך בצינורות/&&/;) בתוך shell שהוגדר (ברירת מחדל bash)
     try:
         shell_exec = SHELL_EXECUTABLE or "/bin/bash"
-        p = subprocess.run(
-            [shell_exec, "-c", cmdline],
-            capture_output=True,
-            text=True,
-            timeout=TIMEOUT,
-            cwd=sess["cwd"],
-            env=sess["env"],
-        )
+        p = await run_shell_async(shell_exec, cmdline, sess["cwd"], sess["env"], TIMEOUT)
         out = p.stdout or ""
         err = p.stderr or ""
         resp = f"$ {cmdline}\n\n{out}"
@@ -1189,8 +1240,37 @@ async def sh_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
     await send_output(update, resp, "output.txt")
 
 
+async def _sh_stream(update: Update, cmdline: str, sess: dict):
+    """מריץ /sh ומזרים את הפלט להודעה אחת שמתעדכנת בזמן אמת."""
+    header = f"$ {cmdline}\n\n"
+    reply = StreamingReply(update, header)
+    await reply.start()
+    try:
+        shell_exec = SHELL_EXECUTABLE or "/bin/bash"
+        p = await stream_shell_async(shell_exec, cmdline, sess["cwd"], sess["env"], TIMEOUT, on_output=reply.feed)
+        out = p.stdout or ""
+        err = p.stderr or ""
+        resp = header + out
+        if err:
+            resp += "\nERR:\n" + err
+        resp = truncate(resp.strip() or "(no output)")
+    except subprocess.TimeoutExpired as e:
+        # שומרים את מה שהספיק להגיע לפני ה-Timeout
+        resp = header + (e.output or "")
+        if e.stderr:
+            resp += "\nERR:\n" + e.stderr
+        resp = truncate(resp.rstrip() + "\n\n⏱️ Timeout")
+    except asyncio.CancelledError:
+        # /cancel: התהליך כבר נהרג ב-stream_shell_async; עוצרים את העריכות ומסמנים
+        await reply.finish(truncate(reply.text().rstrip() + "\n\n⛔ בוטל"), "output.txt")
+        raise
+    except Exception as e:
+        resp = truncate(f"$ {cmdline}\n\nERR:\n{e}")
+    await reply.finish(resp, "output.txt")
+
+
 def _parse_cmds_args(arg_text: str) -> set:
-    return _parse_cmds_string(arg_text)
+    return parse_cmds_string(arg_text)
 
 
 async def list_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
@@ -1212,6 +1292,7 @@ async def allow_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
         return await update.message.reply_text("שימוש: /allow cmd1,cmd2,...")
     before = set(ALLOWED_CMDS)
     ALLOWED_CMDS.update(to_add)
+    ALLOWED_CMDS_INDEX.update(to_add)
     if ALLOWED_CMDS != before:
         save_allowed_cmds_to_file()
     await update.message.reply_text("נוספו: " + ",".join(sorted(to_add)))
@@ -1229,6 +1310,7 @@ async def deny_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
     for c in to_remove:
         if c in ALLOWED_CMDS:
             ALLOWED_CMDS.discard(c)
+            ALLOWED_CMDS_INDEX.discard(c)
             changed = True
     if changed:
         save_allowed_cmds_to_file()
@@ -1245,6 +1327,7 @@ async def update_allow_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
         return await update.message.reply_text("שימוש: /update cmd1,cmd2,...")
     global ALLOWED_CMDS
     ALLOWED_CMDS = set(new_set)
+    ALLOWED_CMDS_INDEX.replace(ALLOWED_CMDS)
     save_allowed_cmds_to_file()
     await update.message.reply_text("עודכן. כעת מאושרות: " + ",".join(sorted(ALLOWED_CMDS)))
 
@@ -1264,15 +1347,14 @@ async def py_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
 
     def _exec_with_telegram_context(src: str, chat_id: int, _update: Update, _context: ContextTypes.DEFAULT_TYPE):
         """Execute Python with Telegram objects available in context."""
-        global PY_CONTEXT
-        ctx = PY_CONTEXT.get(chat_id)
-        if ctx is None:
-            ctx = {"__builtins__": __builtins__, "__name__": "__main__"}
-            PY_CONTEXT[chat_id] = ctx
-        # Expose Telegram objects for direct use in code
-        ctx["update"] = _update
-        ctx["context"] = _context
-        return exec_python_in_context(src, ctx)
+        if PY_POOL is not None:
+            # אובייקטי טלגרם לא עוברים לתהליך נפרד; הביטוי האחרון מוערך בתוך ה-worker
+            return PY_POOL.execute(chat_id, src, TIMEOUT, eval_last=True)
+        with PY_CONTEXT.use(chat_id) as ctx:
+            # Expose Telegram objects for direct use in code
+            ctx["update"] = _update
+            ctx["context"] = _context
+            return exec_python_in_context(src, ctx)
 
     try:
         chat_id = _chat_id(update)
@@ -1316,15 +1398,17 @@ async def py_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
 
         resp = "\n".join(parts).strip()
 
-        # אם אין פלט – ננסה להעריך את הביטוי האחרון (כמו REPL)
-        if not resp:
+        # אם אין פלט – ננסה להעריך את הביטוי האחרון (כמו REPL).
+        # במצב PY_POOL ה-worker כבר העריך אותו (eval_last) – לא מריצים אותו שוב בתהליך הבוט
+        if not resp and PY_POOL is None:
             try:
                 mod = ast.parse(cleaned, mode="exec")
                 if getattr(mod, "body", None):
                     last = mod.body[-1]
                     if isinstance(last, ast.Expr):
                         expr_code = compile(ast.Expression(last.value), filename="<py>", mode="eval")
-                        ctx = PY_CONTEXT.get(chat_id) or {}
+                        # get() may restore a spilled context from disk – not on the event loop
+                        ctx = await asyncio.to_thread(PY_CONTEXT.get, chat_id) or {}
                         result = eval(expr_code, ctx, ctx)
                         if inspect.isawaitable(result):
                             result = await result
@@ -1358,7 +1442,7 @@ async def js_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
     sess = get_session(update)
 
     try:
-        p = await asyncio.to_thread(run_js_blocking, cleaned, sess["cwd"], sess["env"], TIMEOUT)
+        p = await asyncio.to_thread(run_js, _chat_id(update), cleaned, sess["cwd"], sess["env"], TIMEOUT)
         out = (p.stdout or "").rstrip()
         err = (p.stderr or "").rstrip()
         parts = [cleaned.rstrip() + "\n\n"]
@@ -1392,7 +1476,7 @@ async def java_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
     sess = get_session(update)
 
     try:
-        p = await asyncio.to_thread(run_java_blocking, cleaned, sess["cwd"], sess["env"], TIMEOUT)
+        p = await asyncio.to_thread(run_java, cleaned, sess["cwd"], sess["env"], TIMEOUT)
         out = (p.stdout or "").rstrip()
         err = (p.stderr or "").rstrip()
         parts = [cleaned.rstrip() + "\n\n"]
@@ -1410,6 +1494,40 @@ async def java_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
         await send_output(update, cleaned.rstrip() + f"\n\nERR:\n{e}", "java-output.txt")
 
 
+def _parse_call_arg(tok: str):
+    """ממיר ארגומנט טקסטואלי של /call ל-bool/int/float כשאפשר."""
+    try:
+        if tok.lower() in ("true", "false"):
+            return tok.lower() == "true"
+        if tok.startswith("0x"):
+            return int(tok, 16)
+        if tok.isdigit() or (tok.startswith("-") and tok[1:].isdigit()):
+            return int(tok)
+        return float(tok)
+    except Exception:
+        return tok
+
+
+async def _call_in_pool(update: Update, chat_id: int, func_name: str, raw_args: list[str]):
+    """/call כשההקשר חי בתהליך worker: קריאה רגילה עם ארגומנטים פוזיציוניים (ללא update/context)."""
+    try:
+        reply = await asyncio.to_thread(PY_POOL.call, chat_id, func_name, [_parse_call_arg(a) for a in raw_args], TIMEOUT)
+    except TimeoutError:
+        return await send_output(update, "⏱️ Timeout", "call-output.txt")
+    except Exception as e:
+        return await send_output(update, f"ERR:\n{e}", "call-output.txt")
+    if reply is None:
+        return await send_output(update, "ERR:\nPython worker process died; the context was reset.", "call-output.txt")
+    out, err, tb_text, result_text = reply
+    if result_text is None:
+        return await update.message.reply_text(f"❗ הפונקציה '{func_name}' לא נמצאה בהקשר הנוכחי. הגדר אותה קודם עם /py.")
+    parts = [p.rstrip() for p in (out, err, tb_text or "") if p and p.strip()]
+    if result_text.strip():
+        parts.append(result_text)
+    resp = "\n".join(parts).strip() or "✓ בוצע"
+    await send_output(update, truncate(resp), "call-output.txt")
+
+
 async def call_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
     """קורא לפונקציה בשם נתון מתוך הקשר /py של הצ'אט.
     שימוש: /call func_name [args...]
@@ -1437,7 +1555,9 @@ async def call_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
     raw_args = tokens[1:]
 
     chat_id = _chat_id(update)
-    ctx = PY_CONTEXT.get(chat_id)
+    if PY_POOL is not None:
+        return await _call_in_pool(update, chat_id, func_name, tokens[1:])
+    ctx = await asyncio.to_thread(PY_CONTEXT.get, chat_id)
     if ctx is None or func_name not in ctx:
         return await update.message.reply_text(f"❗ הפונקציה '{func_name}' לא נמצאה בהקשר הנוכחי. הגדר אותה קודם עם /py.")
 
@@ -1452,20 +1572,7 @@ async def call_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
         sig = None
 
     # בניית ארגומנטים
-    def _parse_arg(tok: str):
-        try:
-            if tok.lower() in ("true", "false"):
-                return tok.lower() == "true"
-            if tok.startswith("0x"):
-                return int(tok, 16)
-            if tok.isdigit() or (tok.startswith("-") and tok[1:].isdigit()):
-                return int(tok)
-            f = float(tok)
-            return f
-        except Exception:
-            return tok
-
-    pos_args = [_parse_arg(a) for a in raw_args]
+    pos_args = [_parse_call_arg(a) for a in raw_args]
     kw_args = {}
 
     has_update = False
@@ -1567,12 +1674,10 @@ async def py_run_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
 
     def _exec_basic(src: str, chat: int):
         """Execute Python in shared context without Telegram objects."""
-        global PY_CONTEXT
-        ctx = PY_CONTEXT.get(chat)
-        if ctx is None:
-            ctx = {"__builtins__": __builtins__}
-            PY_CONTEXT[chat] = ctx
-        return exec_python_in_context(src, ctx)
+        if PY_POOL is not None:
+            return PY_POOL.execute(chat, src, TIMEOUT)
+        with PY_CONTEXT.use(chat) as ctx:
+            return exec_python_in_context(src, ctx)
 
     try:
         out, err, tb_text = await asyncio.wait_for(asyncio.to_thread(_exec_basic, cleaned, chat_id), timeout=TIMEOUT)
@@ -1648,7 +1753,7 @@ async def reset_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
     if not allowed(update):
         return
     chat_id = _chat_id(update)
-    sessions.pop(chat_id, None)
+    sessions.drop(chat_id)
     await update.message.reply_text("♻️ הסשן אופס (cwd/env הוחזרו לברירת מחדל)")
 
 
@@ -1671,8 +1776,7 @@ async def clear_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
     }
 
     try:
-        if chat_id in sessions:
-            sessions.pop(chat_id, None)
+        if sessions.drop(chat_id):
             cleared["shell_session"] = True
     except Exception:
         pass
@@ -1681,6 +1785,16 @@ async def clear_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
         if chat_id in PY_CONTEXT:
             PY_CONTEXT.pop(chat_id, None)
             cleared["py_context"] = True
+        if PY_POOL is not None and PY_POOL.has_context(chat_id):
+            PY_POOL.reset(chat_id)
+            cleared["py_context"] = True
+    except Exception:
+        pass
+
+    try:
+        reset_js(chat_id)
+        if user_id:
+            reset_js(f"inline:{user_id}")
     except Exception:
         pass
 
@@ -1693,21 +1807,16 @@ async def clear_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
 
     try:
         if user_id:
-            if str(user_id) in INLINE_SESSIONS:
-                INLINE_SESSIONS.pop(str(user_id), None)
+            if INLINE_SESSIONS.drop(str(user_id)):
                 cleared["inline_session"] = True
             # ניקוי טוקנים של המשתמש מחנות ה-inline
             removed = 0
-            for k in list(INLINE_EXEC_STORE.keys()):
-                try:
-                    if INLINE_EXEC_STORE.get(k, {}).get("user_id") == user_id:
-                        INLINE_EXEC_STORE.pop(k, None)
-                        removed += 1
-                except Exception:
-                    pass
+            for k, rec in INLINE_EXEC_STORE.items():
+                if rec.get("user_id") == user_id:
+                    INLINE_EXEC_STORE.pop(k, None)
+                    removed += 1
             if removed:
                 cleared["inline_tokens_removed"] = removed
-            prune_inline_exec_store()
     except Exception:
         pass
 
@@ -1737,9 +1846,43 @@ async def health_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
         return
     try:
         socket.create_connection(("api.telegram.org", 443), timeout=3).close()
-        await update.message.reply_text("✅ OK")
+        lines = ["✅ OK"]
     except OSError:
-        await update.message.reply_text("❌ אין חיבור")
+        lines = ["❌ אין חיבור"]
+    st = INLINE_EXEC_STORE.stats()
+    lines.append(
+        f"טוקני אינליין: {st['size']}/{st['maxsize']}, hits {st['hits']}, "
+        f"פגו {st['expirations']}, נזרקו {st['evictions']}"
+    )
+    ss = SCHEDULER.stats()
+    lines.append(f"תור הרצות: רצות {ss['running']}/{ss['slots']}, ממתינות {sum(ss['queued'].values())}")
+    st = sessions.store.stats()
+    lines.append(f"סשנים: {st['sessions']} ({st['backend']})")
+    if PY_POOL is not None:
+        ps = PY_POOL.stats()
+        lines.append(
+            f"הקשרי Python: {ps['contexts']} ({ps['bytes'] / 1048576:.1f}MB) ב-{ps['alive']}/{ps['workers']} workers, "
+            f"פונו {ps['evictions']}, פונו (idle) {ps['idle_evictions']}"
+        )
+        sizes = PY_POOL.sizes()
+    else:
+        ps = PY_CONTEXT.stats()
+        lines.append(
+            f"הקשרי Python: {ps['contexts']} ({ps['bytes'] / 1048576:.1f}MB), פונו {ps['evictions']}, "
+            f"בדיסק {ps['spilled']}, שוחזרו {ps['restores']}"
+        )
+        sizes = PY_CONTEXT.sizes()
+    largest = sorted(sizes.items(), key=lambda kv: kv[1]["bytes"], reverse=True)[:5]
+    if largest:
+        lines.append("הקשרים הגדולים: " + ", ".join(f"{k} {v['bytes'] / 1048576:.1f}MB" for k, v in largest))
+    rs = reporter.stats()
+    if not rs["enabled"]:
+        lines.append("דיווח פעילות: כבוי")
+    elif rs["connected"]:
+        lines.append(f"דיווח פעילות: מחובר ({rs['connect_seconds']}s), בתור {rs['pending_events']}, נזרקו {rs['dropped']}")
+    else:
+        lines.append(f"דיווח פעילות: לא מחובר, בתור {rs['pending_events']}")
+    await update.message.reply_text("\n".join(lines))
 
 
 async def whoami_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
@@ -1783,7 +1926,102 @@ async def restart_cmd(update: Update, _: ContextTypes.DEFAULT_TYPE):
     os._exit(0)
 
 
+# ==== עיבוד עדכונים מקבילי ====
+class _RunningSlot:
+    """המקום של עדכון אחד בתקרת max_running. scheduled משחרר אותו בזמן ההמתנה בתור ולוקח מחדש כשמגיע תורו."""
+
+    def __init__(self, sem: asyncio.Semaphore):
+        self.sem = sem
+        self.held = False
+
+    async def acquire(self) -> None:
+        await self.sem.acquire()
+        self.held = True
+
+    def release(self) -> None:
+        if self.held:
+            self.held = False
+            self.sem.release()
+
+
+# המקום של העדכון שבטיפול כרגע (None מחוץ ל-ChatOrderedUpdateProcessor)
+_RUNNING_SLOT: contextvars.ContextVar = contextvars.ContextVar("running_slot", default=None)
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """עדכונים מצ'אטים שונים רצים במקביל, עדכונים מאותו צ'אט – לפי הסדר.
+    sessions/PY_CONTEXT של צ'אט תלויים בסדר הפקודות (cd ואז ls), לכן כל צ'אט מקבל נעילה משלו.
+    עדכונים בלי צ'אט (inline query, chosen inline, callback מהודעת אינליין) לא ממתינים לנעילה.
+    max_running הוא תקרת ההרצה הגלובלית; עדכון שממתין לנעילת הצ'אט שלו, או הרצה שממתינה בתור
+    של SCHEDULER, לא תופסים מקום בתקרה. /cancel עוקף גם את התקרה – הוא חייב לעבור כשהיא מלאה.
+    """
+
+    def __init__(self, max_running: int, max_pending: int = 1024):
+        # הסמפור של BaseUpdateProcessor משמש רק כגבול לעדכונים בטיפול (כולל ממתינים)
+        super().__init__(max(max_pending, max_running))
+        self.max_running = max(1, max_running)
+        self._running: asyncio.Semaphore | None = None
+        # chat_id -> [lock, מספר עדכונים שמחזיקים/ממתינים]
+        self._chat_locks: dict[int, list] = {}
+
+    async def initialize(self) -> None:
+        self._running = asyncio.Semaphore(self.max_running)
+
+    async def shutdown(self) -> None:
+        self._chat_locks.clear()
+
+    @staticmethod
+    def _is_cancel(update: object) -> bool:
+        msg = update.effective_message if isinstance(update, Update) else None
+        return msg is not None and (msg.text or "").split(" ", 1)[0].split("@", 1)[0] == "/cancel"
+
+    @staticmethod
+    def _chat_key(update: object) -> int | None:
+        chat = getattr(update, "effective_chat", None) if isinstance(update, Update) else None
+        return chat.id if chat else None
+
+    async def _run(self, coroutine) -> None:
+        slot = _RunningSlot(self._running)
+        await slot.acquire()
+        token = _RUNNING_SLOT.set(slot)
+        try:
+            await coroutine
+        finally:
+            _RUNNING_SLOT.reset(token)
+            slot.release()
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        if self._running is None:
+            await self.initialize()
+        if self._is_cancel(update):
+            # /cancel חייב לעקוף את ההרצה שהוא בא לבטל: בלי נעילת צ'אט ובלי תקרה
+            await coroutine
+            return
+        key = self._chat_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+        entry = self._chat_locks.get(key)
+        if entry is None:
+            entry = self._chat_locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._chat_locks.pop(key, None)
+
+
 # ==== main ====
+def _webhook_secret(token: str) -> str:
+    """הסוד של ה-webhook: BOT_WEBHOOK_SECRET, ואם לא הוגדר – נגזר מהטוקן (יציב בין הפעלות)."""
+    if WEBHOOK_SECRET:
+        return WEBHOOK_SECRET
+    return hashlib.sha256(f"webhook:{token}".encode("utf-8")).hexdigest()
+
+
 def main():
     # לוגים שקטים (רק ERROR) כדי למנוע ספאם
     import logging
@@ -1795,10 +2033,21 @@ def main():
     if not token:
         return
 
+    global BOT_DELIVERY_MODE
+    use_webhook = bool(WEBHOOK_URL)
     while True:
-        app = Application.builder().token(token).post_init(on_post_init).build()
-
-        app.add_handler(InlineQueryHandler(inline_query))
+        BOT_DELIVERY_MODE = "webhook" if use_webhook else "polling"
+        # run_polling/run_webhook סוגרים את הלולאה בסיום; ניסיון חוזר צריך לולאה חדשה
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        builder = Application.builder().token(token).post_init(on_post_init)
+        if BOT_CONCURRENCY > 1:
+            builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(BOT_CONCURRENCY))
+        if BOT_API_BASE_URL:
+            builder = builder.base_url(f"{BOT_API_BASE_URL}/bot").base_file_url(f"{BOT_API_BASE_URL}/file/bot")
+        app = builder.build()
+
+        # block=False: שאילתה חדשה לא מחכה לקודמת (שממתינה ל-debounce)
+        app.add_handler(InlineQueryHandler(inline_query, block=False))
         app.add_handler(ChosenInlineResultHandler(on_chosen_inline_result))
         app.add_handler(CallbackQueryHandler(handle_refresh_callback, pattern=r"^refresh:"))
         app.add_handler(CallbackQueryHandler(show_commands_callback, pattern=r"^show_commands$"))
@@ -1806,15 +2055,16 @@ def main():
         # קלטים בסיסיים
         app.add_handler(CommandHandler("start", start))
         app.add_handler(CommandHandler("webapp", webapp_cmd))
-        app.add_handler(CommandHandler("sh", sh_cmd))
-        app.add_handler(CommandHandler("py", py_cmd))
-        app.add_handler(CommandHandler("js", js_cmd))
-        app.add_handler(CommandHandler("java", java_cmd))
+        app.add_handler(CommandHandler("sh", scheduled("sh", sh_cmd)))
+        app.add_handler(CommandHandler("py", scheduled("py", py_cmd)))
+        app.add_handler(CommandHandler("js", scheduled("js", js_cmd)))
+        app.add_handler(CommandHandler("java", scheduled("java", java_cmd)))
         # פקודות כלליות בלבד; אין תלות בדוגמאות ספציפיות
         app.add_handler(CommandHandler("call", call_cmd))
         # איסוף קוד רב-הודעות
         app.add_handler(CommandHandler("py_start", py_start_cmd))
-        app.add_handler(CommandHandler("py_run", py_run_cmd))
+        app.add_handler(CommandHandler("py_run", scheduled("py", py_run_cmd)))
+        app.add_handler(CommandHandler("cancel", cancel_cmd))
         # איסוף הודעות טקסט רגילות בין /py_start ל-/py_run
         app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, collect_text_handler))
         app.add_handler(CommandHandler("env", env_cmd))
@@ -1831,11 +2081,32 @@ def main():
         app.add_handler(CommandHandler("update", update_allow_cmd))
 
         try:
-            app.run_polling(
-                drop_pending_updates=True,
-                poll_interval=1.5,
-                timeout=10,
-            )
+            if use_webhook:
+                # טלגרם שולח את הסוד בכותרת X-Telegram-Bot-Api-Secret-Token; PTB דוחה בקשות בלעדיו
+                app.run_webhook(
+                    listen=WEBHOOK_LISTEN,
+                    port=WEBHOOK_PORT,
+                    url_path=WEBHOOK_PATH,
+                    webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+                    secret_token=_webhook_secret(token),
+                    drop_pending_updates=True,
+                )
+            else:
+                app.run_polling(
+                    drop_pending_updates=True,
+                    poll_interval=1.5,
+                    timeout=10,
+                )
+        except (RuntimeError, OSError, BadRequest) as e:
+            # webhook לא זמין (חסר python-telegram-bot[webhooks], פורט תפוס, כתובת נדחתה) – חוזרים ל-polling
+            if use_webhook:
+                print(f"⚠️ webhook נכשל ({e}) – עובר ל-polling")
+                use_webhook = False
+                continue
+            if isinstance(e, BadRequest):
+                time.sleep(5)
+                continue
+            raise
         except Conflict:
             # אינסטנס אחר רץ – נחכה וננסה שוב
             time.sleep(int(os.getenv("CONFLICT_RETRY_DELAY", "120")))
@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Resident Java compile-and-run daemon for /java.
+
+Even with cached classes, every /java launches two JVMs (javac, then java).
+This module keeps one small Java helper (JavaRunnerDaemon) running. It
+compiles snippets in memory with the javax.tools API, caches the bytecode by
+source hash, and runs `main` in a fresh, isolated classloader for every run.
+
+Protocol (one line per message, fields separated by tabs, payloads base64):
+    request:  <id> <key> <className> <b64 source>
+    response: <id> <exitCode> <b64 stdout> <b64 stderr> <cached 0|1> <over budget 0|1>
+
+Output is kept within CAPTURE_HEAD_KB/CAPTURE_TAIL_KB inside the daemon; a
+run that writes more than CAPTURE_KILL_MB gets its response sent early and
+the daemon halts (like run_captured killing the process).
+
+Like the java launcher, a run ends when main and every non-daemon thread it
+started have finished. The Python side enforces the timeout by killing the
+daemon (a running Java thread cannot be stopped safely); the next run starts a
+new one. Whenever the daemon is unavailable (disabled, no JDK, busy, starting,
+or the snippet calls System.exit) run_java() falls back to
+shared_utils.run_java_blocking. A daemon that dies mid-run is reported as a
+failed run, never re-executed (the snippet may have had side effects).
+
+Enabled with JAVA_DAEMON=1.
+"""
+
+import os
+import re
+import time
+import base64
+import hashlib
+import threading
+import subprocess
+
+from shared_utils import (
+    CAPTURE_HEAD_BYTES,
+    CAPTURE_KILL_BYTES,
+    CAPTURE_TAIL_BYTES,
+    JAVA_CLASS_CACHE,
+    PipeLineReader,
+    java_class_name,
+    materialize_env,
+    on_cancel,
+    over_budget_note,
+    run_java_blocking,
+)
+
+
+JAVA_DAEMON_ENABLED = os.getenv("JAVA_DAEMON", "").lower() in ("1", "true", "yes", "on")
+JAVA_DAEMON_MAX = int(os.getenv("JAVA_DAEMON_MAX", "2"))
+JAVA_DAEMON_START_TIMEOUT = int(os.getenv("JAVA_DAEMON_START_TIMEOUT", "30"))
+# After a failed start (no JDK, helper compile error) wait this long before trying again
+JAVA_DAEMON_RETRY_SEC = 300
+
+# Snippets that end the JVM would take the daemon down with them
+_EXITS_JVM_RE = re.compile(r"System\s*\.\s*exit\s*\(|Runtime\s*\.\s*getRuntime\s*\(\s*\)\s*\.\s*(?:exit|halt)\s*\(")
+
+DAEMON_CLASS = "JavaRunnerDaemon"
+DAEMON_SOURCE = r"""
+import javax.tools.*;
+import java.io.*;
+import java.lang.reflect.*;
+import java.net.URI;
+import java.nio.charset.StandardCharsets;
+import java.util.*;
+
+public class JavaRunnerDaemon {
+    static final int CACHE_MAX = 64;
+    // Output limits, from the command line (CAPTURE_HEAD_KB / CAPTURE_TAIL_KB / CAPTURE_KILL_MB)
+    static int HEAD, TAIL;
+    static long KILL;
+    static PrintStream proto;
+    static String curId;
+    static boolean curCached;
+    static volatile Capture curOut, curErr;
+
+    // Keeps the first HEAD and the last TAIL bytes written and counts what falls
+    // in between (like shared_utils.BoundedCapture)
+    static final class Capture extends OutputStream {
+        final byte[] head = new byte[HEAD];
+        final byte[] tail = new byte[TAIL];  // ring buffer
+        int headLen, tailStart, tailLen;
+        long total;
+
+        @Override public void write(int b) { write(new byte[] {(byte) b}, 0, 1); }
+
+        @Override public void write(byte[] b, int off, int len) {
+            synchronized (this) {
+                total += len;
+                int room = Math.min(HEAD - headLen, len);
+                if (room > 0) {
+                    System.arraycopy(b, off, head, headLen, room);
+                    headLen += room;
+                    off += room;
+                    len -= room;
+                }
+                if (len >= TAIL) {
+                    System.arraycopy(b, off + len - TAIL, tail, 0, TAIL);
+                    tailStart = 0;
+                    tailLen = TAIL;
+                } else {
+                    for (int i = 0; i < len; i++) {
+                        tail[(tailStart + tailLen) % TAIL] = b[off + i];
+                        if (tailLen < TAIL) tailLen++;
+                        else tailStart = (tailStart + 1) % TAIL;
+                    }
+                }
+            }
+            checkBudget();
+        }
+
+        synchronized byte[] toByteArray() {
+            ByteArrayOutputStream r = new ByteArrayOutputStream();
+            r.write(head, 0, headLen);
+            byte[] t = new byte[tailLen];
+            for (int i = 0; i < tailLen; i++) t[i] = tail[(tailStart + i) % TAIL];
+            long dropped = total - headLen - tailLen;
+            int skip = 0;
+            if (dropped > 0 && tailLen > 0) {
+                // The cut may land inside a multi-byte character: skip its continuation bytes
+                while (skip < 3 && skip < t.length && (t[skip] & 0xC0) == 0x80) skip++;
+                r.writeBytes(("\n\u2026[" + dropped + " bytes dropped]\u2026\n").getBytes(StandardCharsets.UTF_8));
+            }
+            r.write(t, skip, t.length - skip);
+            return r.toByteArray();
+        }
+    }
+
+    // Output budget exceeded: report what was kept, then die like a killed process
+    static void checkBudget() {
+        Capture out = curOut, err = curErr;
+        if (KILL <= 0 || out == null || err == null || out.total + err.total <= KILL) return;
+        synchronized (JavaRunnerDaemon.class) {
+            if (curOut != out) return;  // the run already finished and replied
+            reply(curId, -9, out, err, curCached, true);
+            Runtime.getRuntime().halt(137);
+        }
+    }
+
+    static void reply(String id, int code, Capture out, Capture err, boolean cached, boolean overBudget) {
+        Base64.Encoder enc = Base64.getEncoder();
+        proto.println(id + "\t" + code + "\t" + enc.encodeToString(out.toByteArray()) + "\t"
+                + enc.encodeToString(err.toByteArray()) + "\t" + (cached ? 1 : 0) + "\t" + (overBudget ? 1 : 0));
+    }
+
+    static final class MemOut extends SimpleJavaFileObject {
+        final ByteArrayOutputStream bytes = new ByteArrayOutputStream();
+        MemOut(String name, Kind kind) {
+            super(URI.create("mem:///" + name.replace('.', '/') + kind.extension), kind);
+        }
+        @Override public OutputStream openOutputStream() { return bytes; }
+    }
+
+    static final class MemSrc extends SimpleJavaFileObject {
+        final String code;
+        MemSrc(String className, String code) {
+            super(URI.create("string:///" + className + Kind.SOURCE.extension), Kind.SOURCE);
+            this.code = code;
+        }
+        @Override public CharSequence getCharContent(boolean ignoreEncodingErrors) { return code; }
+    }
+
+    static final class MemManager extends ForwardingJavaFileManager<StandardJavaFileManager> {
+        final Map<String, MemOut> classes = new HashMap<>();
+        MemManager(StandardJavaFileManager m) { super(m); }
+        @Override public JavaFileObject getJavaFileForOutput(JavaFileManager.Location location, String className,
+                                                             JavaFileObject.Kind kind, FileObject sibling) {
+            MemOut out = new MemOut(className, kind);
+            classes.put(className, out);
+            return out;
+        }
+    }
+
+    static final class MemLoader extends ClassLoader {
+        final Map<String, byte[]> classes;
+        MemLoader(Map<String, byte[]> classes, ClassLoader parent) { super(parent); this.classes = classes; }
+        @Override protected Class<?> findClass(String name) throws ClassNotFoundException {
+            byte[] b = classes.get(name);
+            if (b == null) throw new ClassNotFoundException(name);
+            return defineClass(name, b, 0, b.length);
+        }
+    }
+
+    static final Map<String, Map<String, byte[]>> CACHE = new LinkedHashMap<String, Map<String, byte[]>>(16, 0.75f, true) {
+        @Override protected boolean removeEldestEntry(Map.Entry<String, Map<String, byte[]>> e) { return size() > CACHE_MAX; }
+    };
+
+    public static void main(String[] args) throws Exception {
+        HEAD = Integer.parseInt(args[0]);
+        TAIL = Integer.parseInt(args[1]);
+        KILL = Long.parseLong(args[2]);
+        proto = new PrintStream(new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+        // Snippets must never read the protocol stream
+        System.setIn(new ByteArrayInputStream(new byte[0]));
+        JavaCompiler compiler = ToolProvider.getSystemJavaCompiler();
+        if (compiler == null) {
+            proto.println("NOCOMPILER");
+            return;
+        }
+        proto.println("READY");
+        Base64.Decoder dec = Base64.getDecoder();
+        String line;
+        while ((line = in.readLine()) != null) {
+            String[] f = line.split("\t", -1);
+            if (f.length < 4) continue;
+            String id = f[0], key = f[1], className = f[2];
+            String src = new String(dec.decode(f[3]), StandardCharsets.UTF_8);
+            Capture out = new Capture();
+            Capture err = new Capture();
+            boolean cached = true;
+            Map<String, byte[]> classes = CACHE.get(key);
+            if (classes == null) {
+                cached = false;
+                classes = compile(compiler, className, src, err);
+                if (classes != null) CACHE.put(key, classes);
+            }
+            curId = id;
+            curCached = cached;
+            curOut = out;
+            curErr = err;
+            int code = classes == null ? 1 : run(classes, className, out, err);
+            synchronized (JavaRunnerDaemon.class) {
+                curOut = curErr = null;
+                reply(id, code, out, err, cached, false);
+            }
+        }
+    }
+
+    static Map<String, byte[]> compile(JavaCompiler compiler, String className, String src, OutputStream err) {
+        DiagnosticCollector<JavaFileObject> diags = new DiagnosticCollector<>();
+        StandardJavaFileManager std = compiler.getStandardFileManager(diags, null, StandardCharsets.UTF_8);
+        MemManager mm = new MemManager(std);
+        List<String> options = Arrays.asList("-classpath", System.getProperty("java.class.path"));
+        Boolean ok = compiler.getTask(null, mm, diags, options, null,
+                Collections.singletonList(new MemSrc(className, src))).call();
+        PrintStream p = new PrintStream(err, true, StandardCharsets.UTF_8);
+        for (Diagnostic<? extends JavaFileObject> d : diags.getDiagnostics()) {
+            String kind = d.getKind() == Diagnostic.Kind.ERROR ? "error" : "warning";
+            p.println(className + ".java:" + d.getLineNumber() + ": " + kind + ": " + d.getMessage(Locale.ROOT));
+        }
+        if (ok == null || !ok) return null;
+        Map<String, byte[]> classes = new HashMap<>();
+        for (Map.Entry<String, MemOut> e : mm.classes.entrySet()) classes.put(e.getKey(), e.getValue().bytes.toByteArray());
+        return classes;
+    }
+
+    static int run(Map<String, byte[]> classes, String className, OutputStream out, OutputStream err) {
+        PrintStream oldOut = System.out, oldErr = System.err;
+        PrintStream pOut = new PrintStream(out, true, StandardCharsets.UTF_8);
+        PrintStream pErr = new PrintStream(err, true, StandardCharsets.UTF_8);
+        final int[] code = {0};
+        System.setOut(pOut);
+        System.setErr(pErr);
+        try {
+            // Fresh loader per run: static state never leaks between runs
+            MemLoader loader = new MemLoader(classes, JavaRunnerDaemon.class.getClassLoader());
+            // Threads the snippet starts inherit this group, so they can be waited for
+            ThreadGroup group = new ThreadGroup("snippet");
+            Thread t = new Thread(group, () -> {
+                try {
+                    Class<?> cls = loader.loadClass(className);
+                    Method m = cls.getMethod("main", String[].class);
+                    m.setAccessible(true);
+                    m.invoke(null, (Object) new String[0]);
+                } catch (InvocationTargetException e) {
+                    pErr.print("Exception in thread \"main\" ");
+                    e.getCause().printStackTrace(pErr);
+                    code[0] = 1;
+                } catch (NoSuchMethodException e) {
+                    pErr.println("Error: Main method not found in class " + className
+                            + ", please define the main method as:\n   public static void main(String[] args)");
+                    code[0] = 1;
+                } catch (Throwable e) {
+                    e.printStackTrace(pErr);
+                    code[0] = 1;
+                }
+            }, "main");
+            t.setContextClassLoader(loader);
+            t.start();
+            // The Python side enforces the timeout by killing this process
+            t.join();
+            joinNonDaemon(group);
+        } catch (InterruptedException e) {
+            code[0] = 1;
+        } finally {
+            pOut.flush();
+            pErr.flush();
+            System.setOut(oldOut);
+            System.setErr(oldErr);
+        }
+        return code[0];
+    }
+
+    // Like the java launcher: wait until no non-daemon thread of the run is alive
+    static void joinNonDaemon(ThreadGroup group) throws InterruptedException {
+        while (true) {
+            Thread[] threads = new Thread[group.activeCount() + 16];
+            int n = group.enumerate(threads, true);
+            Thread next = null;
+            for (int i = 0; i < n; i++) {
+                if (!threads[i].isDaemon() && threads[i].isAlive()) {
+                    next = threads[i];
+                    break;
+                }
+            }
+            if (next == null) return;
+            next.join();
+        }
+    }
+}
+"""
+
+
+def _env_digest(env: dict) -> str:
+    h = hashlib.sha1()
+    for k, v in sorted(env.items()):
+        h.update(f"{k}={v}\0".encode("utf-8", errors="replace"))
+    return h.hexdigest()
+
+
+def _daemon_classes_dir(env: dict) -> str:
+    """Compile the helper once into the Java class cache dir; returns its classpath dir."""
+    digest = hashlib.sha256(DAEMON_SOURCE.encode("utf-8")).hexdigest()[:16]
+    out_dir = os.path.join(JAVA_CLASS_CACHE.root, f"daemon-{digest}")
+    if os.path.exists(os.path.join(out_dir, f"{DAEMON_CLASS}.class")):
+        return out_dir
+    os.makedirs(out_dir, exist_ok=True)
+    src_path = os.path.join(out_dir, f"{DAEMON_CLASS}.java")
+    with open(src_path, "w", encoding="utf-8") as fh:
+        fh.write(DAEMON_SOURCE)
+    proc = subprocess.run(
+        ["javac", "-d", out_dir, src_path],
+        capture_output=True,
+        text=True,
+        timeout=JAVA_DAEMON_START_TIMEOUT,
+        env=materialize_env(env),
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"failed to compile {DAEMON_CLASS}: {proc.stderr.strip()}")
+    return out_dir
+
+
+class JavaDaemon:
+    """One resident JVM bound to a (cwd, env) pair, since a JVM cannot change either."""
+
+    def __init__(self, cwd: str, env: dict):
+        classpath = _daemon_classes_dir(env)
+        if env.get("CLASSPATH"):
+            classpath += os.pathsep + env["CLASSPATH"]
+        self.proc = subprocess.Popen(
+            ["java", "-Xshare:auto", "-cp", classpath, DAEMON_CLASS,
+             str(CAPTURE_HEAD_BYTES), str(CAPTURE_TAIL_BYTES), str(CAPTURE_KILL_BYTES)],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=cwd,
+            env=materialize_env(env),
+            start_new_session=True,
+        )
+        self._reader = PipeLineReader(self.proc.stdout.fileno())
+        self._next_id = 0
+        self.lock = threading.Lock()
+        self.last_used = time.time()
+        self.runs = 0
+        hello = self._reader.readline(time.monotonic() + JAVA_DAEMON_START_TIMEOUT)
+        if hello != b"READY":
+            self.close()
+            raise RuntimeError("java daemon did not start" + (" (no compiler in this JDK)" if hello == b"NOCOMPILER" else ""))
+
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def run(self, key: str, class_name: str, src: str, timeout_sec: float) -> subprocess.CompletedProcess:
+        """Compile (or reuse) and run src. Raises TimeoutExpired (daemon killed) or RuntimeError (daemon died)."""
+        self._next_id += 1
+        req_id = str(self._next_id)
+        self.last_used = time.time()
+        line = "\t".join([req_id, key, class_name, base64.b64encode(src.encode("utf-8")).decode("ascii")]) + "\n"
+        try:
+            self.proc.stdin.write(line.encode("ascii"))
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            self.close()
+            raise RuntimeError("java daemon exited")
+        deadline = time.monotonic() + timeout_sec
+        while True:
+            try:
+                resp = self._reader.readline(deadline)
+            except ValueError:
+                self.close()
+                raise RuntimeError("java daemon reply too large")
+            if resp is None:
+                self.close()
+                raise subprocess.TimeoutExpired(["java", class_name], timeout_sec)
+            if resp == b"":
+                self.close()
+                raise RuntimeError("java daemon exited")
+            fields = resp.decode("ascii", errors="replace").split("\t")
+            if len(fields) < 4 or fields[0] != req_id:
+                continue
+            self.runs += 1
+            stderr = base64.b64decode(fields[3]).decode("utf-8", errors="replace")
+            if len(fields) > 5 and fields[5] == "1":
+                # The daemon halted after the run wrote more than CAPTURE_KILL_BYTES
+                self.close()
+                stderr += over_budget_note(CAPTURE_KILL_BYTES)
+            return subprocess.CompletedProcess(
+                ["java", class_name],
+                int(fields[1]),
+                base64.b64decode(fields[2]).decode("utf-8", errors="replace"),
+                stderr,
+            )
+
+    def close(self) -> None:
+        try:
+            os.killpg(self.proc.pid, 9)
+        except Exception:
+            try:
+                self.proc.kill()
+            except Exception:
+                pass
+        try:
+            self.proc.wait(timeout=1)
+        except Exception:
+            pass
+
+
+class JavaDaemonPool:
+    """Up to JAVA_DAEMON_MAX daemons keyed by (cwd, env digest), least recently used closed first."""
+
+    def __init__(self, max_daemons: int = JAVA_DAEMON_MAX):
+        self.max_daemons = max(1, max_daemons)
+        self._daemons: dict = {}
+        self._starting: set = set()
+        self._lock = threading.Lock()
+        self._failed_at = 0.0
+        self.fallbacks = 0
+        self.crashes = 0
+
+    def _get(self, cwd: str, env: dict) -> JavaDaemon | None:
+        """The daemon for (cwd, env), started if needed; None means "use a separate JVM"."""
+        slot = (cwd, _env_digest(env))
+        victims = []
+        with self._lock:
+            d = self._daemons.get(slot)
+            if d is not None and d.alive():
+                return d
+            self._daemons.pop(slot, None)
+            if slot in self._starting or time.time() - self._failed_at < JAVA_DAEMON_RETRY_SEC:
+                return None
+            while len(self._daemons) + len(self._starting) >= self.max_daemons:
+                idle = [k for k, v in self._daemons.items() if not v.lock.locked()]
+                if not idle:
+                    return None
+                oldest = min(idle, key=lambda k: self._daemons[k].last_used)
+                victims.append(self._daemons.pop(oldest))
+            self._starting.add(slot)
+        for victim in victims:
+            victim.close()
+        # Starting a JVM (and compiling the helper the first time) takes seconds:
+        # done outside the lock so other /java runs are not held up meanwhile
+        try:
+            d = JavaDaemon(cwd, env)
+        except Exception:
+            d = None
+        with self._lock:
+            self._starting.discard(slot)
+            if d is None:
+                self._failed_at = time.time()
+            else:
+                self._daemons[slot] = d
+        return d
+
+    def _drop(self, daemon: JavaDaemon) -> None:
+        with self._lock:
+            for slot, d in list(self._daemons.items()):
+                if d is daemon:
+                    self._daemons.pop(slot, None)
+
+    def run(self, src: str, cwd: str, env: dict, timeout_sec: int) -> subprocess.CompletedProcess:
+        daemon = None if _EXITS_JVM_RE.search(src) else self._get(cwd, env)
+        # A busy daemon would serialize unrelated runs – use a separate JVM instead
+        if daemon is None or not daemon.lock.acquire(blocking=False):
+            self.fallbacks += 1
+            return run_java_blocking(src, cwd, env, timeout_sec)
+        class_name = java_class_name(src)
+        try:
+            # Cancelling the run closes the daemon (its Java thread can't be stopped otherwise)
+            with on_cancel(daemon.close):
+                return daemon.run(JAVA_CLASS_CACHE.key_for(src), class_name, src, timeout_sec)
+        except subprocess.TimeoutExpired:
+            self._drop(daemon)
+            raise
+        except RuntimeError:
+            # Died mid-run (OOM, halt via reflection, ...). Report it like a crashed
+            # java would; rerunning could repeat the snippet's side effects.
+            self._drop(daemon)
+            self.crashes += 1
+            code = daemon.proc.returncode
+            return subprocess.CompletedProcess(
+                ["java", class_name],
+                code if code else 1,
+                "",
+                f"Error: the JVM exited unexpectedly during the run (exit status {code})\n",
+            )
+        finally:
+            daemon.lock.release()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            daemons = list(self._daemons.values())
+            self._daemons.clear()
+        for d in daemons:
+            d.close()
+
+
+_pool: JavaDaemonPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> JavaDaemonPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = JavaDaemonPool()
+        return _pool
+
+
+def run_java(src: str, cwd: str, env: dict, timeout_sec: int) -> subprocess.CompletedProcess:
+    """
+    Execute Java code (blocking, for use in thread).
+    Uses the resident daemon when JAVA_DAEMON=1, otherwise javac+java via run_java_blocking.
+    """
+    if not JAVA_DAEMON_ENABLED:
+        return run_java_blocking(src, cwd, env, timeout_sec)
+    return get_pool().run(src, cwd, env, timeout_sec)
@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Warm, persistent Node.js workers for /js.
+
+Instead of writing a temp file and booting a fresh `node` for every snippet,
+each session key (chat_id / user_id) gets a long-lived node process that
+evaluates snippets in one persistent `vm` context, so variables and functions
+survive between runs (like PY_CONTEXT does for /py).
+
+Snippets are sent as JSON lines on the worker's stdin; results come back as
+JSON lines on a dedicated pipe (not stdout), so nothing the user prints can
+break the protocol. Output is kept within CAPTURE_HEAD_KB/CAPTURE_TAIL_KB
+inside the worker, and a run that writes more than CAPTURE_KILL_MB kills it. A run that exceeds its timeout kills the worker; the next
+run starts a fresh one.
+
+Enabled with JS_WORKER=1; otherwise run_js() falls back to run_js_blocking.
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+import subprocess
+
+from shared_utils import (
+    CAPTURE_HEAD_BYTES,
+    CAPTURE_KILL_BYTES,
+    CAPTURE_TAIL_BYTES,
+    PipeLineReader,
+    on_cancel,
+    over_budget_note,
+    run_js_blocking,
+)
+
+
+JS_WORKER_ENABLED = os.getenv("JS_WORKER", "").lower() in ("1", "true", "yes", "on")
+JS_WORKER_MAX = int(os.getenv("JS_WORKER_MAX", "8"))
+JS_WORKER_IDLE_TTL = int(os.getenv("JS_WORKER_IDLE_TTL", "900"))
+
+# Runs inside node. Reads requests from stdin, writes results to the fd in JS_WORKER_FD.
+NODE_WORKER_SOURCE = r"""
+'use strict';
+const fs = require('fs');
+const vm = require('vm');
+const path = require('path');
+const util = require('util');
+const Module = require('module');
+const readline = require('readline');
+
+const OUT_FD = parseInt(process.env.JS_WORKER_FD, 10);
+// head bytes, tail bytes, kill bytes (CAPTURE_HEAD_KB / CAPTURE_TAIL_KB / CAPTURE_KILL_MB)
+const [HEAD, TAIL, KILL] = (process.env.JS_WORKER_LIMITS || '0,0,0').split(',').map(Number);
+delete process.env.JS_WORKER_FD;
+delete process.env.JS_WORKER_LIMITS;
+
+// Keeps the first HEAD and the last TAIL bytes of a stream and counts what
+// falls in between (like shared_utils.BoundedCapture)
+class Capture {
+  constructor() { this.head = []; this.headLen = 0; this.tail = []; this.tailLen = 0; this.total = 0; }
+  feed(text) {
+    let buf = Buffer.from(text, 'utf8');
+    this.total += buf.length;
+    const room = HEAD - this.headLen;
+    if (room > 0) {
+      const part = Buffer.from(buf.subarray(0, room));
+      this.head.push(part);
+      this.headLen += part.length;
+      buf = buf.subarray(room);
+    }
+    if (buf.length && TAIL > 0) {
+      this.tail.push(buf.length > TAIL ? Buffer.from(buf.subarray(buf.length - TAIL)) : Buffer.from(buf));
+      this.tailLen += Math.min(buf.length, TAIL);
+      while (this.tailLen - this.tail[0].length >= TAIL) this.tailLen -= this.tail.shift().length;
+    }
+  }
+  text() {
+    const head = Buffer.concat(this.head).toString('utf8');
+    let tail = Buffer.concat(this.tail);
+    if (tail.length > TAIL) tail = tail.subarray(tail.length - TAIL);
+    if (!tail.length) return head;
+    const dropped = this.total - this.headLen - tail.length;
+    if (!dropped) return head + tail.toString('utf8');
+    // The cut may land inside a multi-byte character: skip its continuation bytes
+    let i = 0;
+    while (i < 3 && i < tail.length && (tail[i] & 0xC0) === 0x80) i++;
+    return head + '\n…[' + dropped + ' bytes dropped]…\n' + tail.subarray(i).toString('utf8');
+  }
+}
+
+let cur = null;                 // capture buffers of the running snippet
+const active = new Set();       // timers/immediates created by snippets
+let wake = null;
+
+function reply(overBudget) {
+  const res = { id: cur.id, stdout: cur.stdout.text(), stderr: cur.stderr.text(), code: cur.code };
+  if (overBudget) { res.code = -9; res.over_budget = true; }
+  fs.writeSync(OUT_FD, JSON.stringify(res) + '\n');
+}
+function emit(stream, text) {
+  if (!cur) return;
+  cur[stream].feed(text);
+  if (KILL && cur.stdout.total + cur.stderr.total > KILL) {
+    // Output budget exceeded: report what was kept, then die like a killed process
+    reply(true);
+    process.kill(process.pid, 'SIGKILL');
+  }
+}
+function fmt(args) { return util.format.apply(null, args) + '\n'; }
+
+const sandboxConsole = {
+  log: (...a) => emit('stdout', fmt(a)),
+  info: (...a) => emit('stdout', fmt(a)),
+  debug: (...a) => emit('stdout', fmt(a)),
+  dir: (o) => emit('stdout', util.inspect(o) + '\n'),
+  table: (o) => emit('stdout', util.inspect(o) + '\n'),
+  warn: (...a) => emit('stderr', fmt(a)),
+  error: (...a) => emit('stderr', fmt(a)),
+  trace: (...a) => emit('stderr', fmt(a)),
+};
+process.stdout.write = (chunk) => { emit('stdout', String(chunk)); return true; };
+process.stderr.write = (chunk) => { emit('stderr', String(chunk)); return true; };
+
+class ExitSignal { constructor(code) { this.code = code || 0; } }
+const realExit = process.exit.bind(process);
+process.exit = (code) => { throw new ExitSignal(code); };
+
+function settle(h) {
+  if (active.delete(h) && active.size === 0 && wake) { const w = wake; wake = null; w(); }
+}
+function onError(err) {
+  if (!cur) return;
+  if (err instanceof ExitSignal) { cur.code = err.code; return; }
+  emit('stderr', (err && err.stack ? err.stack : String(err)) + '\n');
+  cur.code = 1;
+}
+process.on('uncaughtException', onError);
+process.on('unhandledRejection', onError);
+
+const sandbox = {
+  console: sandboxConsole, process, Buffer, URL, URLSearchParams,
+  TextEncoder, TextDecoder, queueMicrotask, structuredClone,
+  setTimeout: (fn, ms, ...args) => {
+    const h = setTimeout(() => { try { fn(...args); } catch (e) { onError(e); } finally { settle(h); } }, ms);
+    active.add(h); return h;
+  },
+  clearTimeout: (h) => { clearTimeout(h); settle(h); },
+  setInterval: (fn, ms, ...args) => {
+    const h = setInterval(() => { try { fn(...args); } catch (e) { onError(e); } }, ms);
+    active.add(h); return h;
+  },
+  clearInterval: (h) => { clearInterval(h); settle(h); },
+  setImmediate: (fn, ...args) => {
+    const h = setImmediate(() => { try { fn(...args); } catch (e) { onError(e); } finally { settle(h); } });
+    active.add(h); return h;
+  },
+  clearImmediate: (h) => { clearImmediate(h); settle(h); },
+};
+sandbox.globalThis = sandbox;
+if (typeof fetch === 'function') sandbox.fetch = fetch;
+const context = vm.createContext(sandbox);
+
+// Top-level let/const/class bindings live in the context's lexical scope, so a
+// second run of `const x = 5` fails with "Identifier 'x' has already been
+// declared". Rewrite them to var (a property of the context global): the value
+// persists and the next run may declare it again. Strings, template literals,
+// comments and regex literals are skipped; anything nested is left alone.
+const EXPR_KEYWORDS = new Set(['return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void',
+  'throw', 'case', 'do', 'else', 'yield', 'await', 'extends', 'default', 'export']);
+
+function skipString(src, i, quote) {
+  for (let j = i + 1; j < src.length; j++) {
+    const c = src[j];
+    if (c === '\\') j++;
+    else if (c === quote) return j + 1;
+    else if (c === '\n') return j;
+  }
+  return src.length;
+}
+function skipTemplate(src, j, stack) {   // j is just past '`' or the '}' closing a ${...}
+  for (; j < src.length; j++) {
+    const c = src[j];
+    if (c === '\\') j++;
+    else if (c === '`') return j + 1;
+    else if (c === '$' && src[j + 1] === '{') { stack.push('`'); return j + 2; }
+  }
+  return src.length;
+}
+function skipRegex(src, i) {
+  let inClass = false;
+  for (let j = i + 1; j < src.length; j++) {
+    const c = src[j];
+    if (c === '\\') j++;
+    else if (c === '\n') return j;
+    else if (c === '[') inClass = true;
+    else if (c === ']') inClass = false;
+    else if (c === '/' && !inClass) {
+      j++;
+      while (j < src.length && /\w/.test(src[j])) j++;
+      return j;
+    }
+  }
+  return src.length;
+}
+function regexAllowed(prev) {
+  if (prev === '' || EXPR_KEYWORDS.has(prev)) return true;
+  if (prev === 'value' || prev === ')' || prev === ']') return false;
+  return !/^[\w$]/.test(prev);
+}
+
+function rebindable(src) {
+  const edits = [];           // [index, length to replace, text]
+  const stack = [];           // open brackets; '`' marks a template ${...}
+  let prev = '';              // last significant token
+  let pendingClass = false;   // a rewritten class whose body hasn't opened yet
+  let inClass = false;        // inside that body: add ';' after its closing brace
+  let i = 0;
+  while (i < src.length) {
+    const c = src[i];
+    if (c === '/' && src[i + 1] === '/') { const e = src.indexOf('\n', i); i = e < 0 ? src.length : e; continue; }
+    if (c === '/' && src[i + 1] === '*') { const e = src.indexOf('*/', i + 2); i = e < 0 ? src.length : e + 2; continue; }
+    if (/\s/.test(c)) { i++; continue; }
+    if (c === '"' || c === "'") { i = skipString(src, i, c); prev = 'value'; continue; }
+    if (c === '`') { i = skipTemplate(src, i + 1, stack); prev = 'value'; continue; }
+    if (c === '/') {
+      if (regexAllowed(prev)) { i = skipRegex(src, i); prev = 'value'; } else { i++; prev = '/'; }
+      continue;
+    }
+    if (/[\w$]/.test(c) || c > '\x7f') {
+      let j = i;
+      while (j < src.length && (/[\w$]/.test(src[j]) || src[j] > '\x7f')) j++;
+      const word = src.slice(i, j);
+      if (stack.length === 0 && prev !== '.' && !/^\d/.test(word)) {
+        const rest = src.slice(j).match(/^\s*([\w$\u0080-\uffff]+|[\[{])?/);
+        const next = rest && rest[1];
+        if (word === 'const' && next) {
+          edits.push([i, 5, 'var  ']);
+        } else if (word === 'let' && next && next !== 'in' && next !== 'instanceof') {
+          edits.push([i, 3, 'var']);
+        } else if (word === 'class' && next && /^[\w$\u0080-\uffff]/.test(next) && next !== 'extends'
+                   && (prev === '' || prev === ';' || prev === '}' || prev === ')' || prev === ']'
+                       || prev === 'value' || (/^[\w$]/.test(prev) && !EXPR_KEYWORDS.has(prev)))) {
+          edits.push([i, 0, 'var ' + next + ' = ']);
+          pendingClass = true;
+        }
+      }
+      prev = /^\d/.test(word) ? 'value' : word;
+      i = j;
+      continue;
+    }
+    if (c === '(' || c === '[' || c === '{') {
+      stack.push(c);
+      if (c === '{' && pendingClass && stack.length === 1) { pendingClass = false; inClass = true; }
+    } else if (c === ')' || c === ']' || c === '}') {
+      if (c === '}' && stack[stack.length - 1] === '`') {
+        stack.pop();
+        i = skipTemplate(src, i + 1, stack);
+        prev = 'value';
+        continue;
+      }
+      stack.pop();
+      if (c === '}' && inClass && stack.length === 0) { inClass = false; edits.push([i + 1, 0, ';']); }
+    } else if ((c === '+' || c === '-') && src[i + 1] === c) {
+      i += 2; prev = 'value'; continue;   // x++ / 2 is a division
+    }
+    prev = c;
+    i++;
+  }
+  let out = '';
+  let at = 0;
+  for (const [index, len, text] of edits) {
+    out += src.slice(at, index) + text;
+    at = index + len;
+  }
+  return out + src.slice(at);
+}
+
+async function runOne(req) {
+  cur = { id: req.id, stdout: new Capture(), stderr: new Capture(), code: 0 };
+  try {
+    try { process.chdir(req.cwd); } catch (e) {}
+    const filename = path.join(process.cwd(), 'snippet.js');
+    sandbox.require = Module.createRequire(filename);
+    sandbox.module = { exports: {} };
+    sandbox.exports = sandbox.module.exports;
+    sandbox.__filename = filename;
+    sandbox.__dirname = process.cwd();
+    const code = rebindable(req.code);
+    let script;
+    try {
+      script = new vm.Script(code, { filename });
+    } catch (e) {
+      // Top-level await: run as an async function (declarations won't persist)
+      if (e instanceof SyntaxError && /await/.test(code)) {
+        script = new vm.Script('(async () => {\n' + code + '\n})()', { filename });
+      } else {
+        throw e;
+      }
+    }
+    const value = script.runInContext(context);
+    if (value && typeof value.then === 'function') await value;
+    // Wait for timers the snippet scheduled, like node would before exiting
+    while (active.size > 0) await new Promise((r) => { wake = r; });
+    await new Promise((r) => setImmediate(r));
+  } catch (e) {
+    onError(e);
+  }
+  reply(false);
+  cur = null;
+}
+
+let chain = Promise.resolve();
+readline.createInterface({ input: process.stdin }).on('line', (line) => {
+  let req;
+  try { req = JSON.parse(line); } catch (e) { return; }
+  chain = chain.then(() => runOne(req));
+}).on('close', () => realExit(0));
+"""
+
+
+class NodeWorker:
+    """One long-lived node process with a persistent vm context (spawned by start())."""
+
+    def __init__(self, env: dict):
+        self.env_digest = _env_digest(env)
+        self.proc = None
+        self._fd = -1
+        self._reader = None
+        self._next_id = 0
+        self.lock = threading.Lock()
+        self.users = 0  # runs holding or waiting for lock (guarded by the pool lock)
+        self.last_used = time.time()
+
+    def start(self, cwd: str, env: dict) -> None:
+        """Spawn the node process (caller holds self.lock)."""
+        read_fd, write_fd = os.pipe()
+        child_env = dict(env)
+        child_env["JS_WORKER_FD"] = str(write_fd)
+        child_env["JS_WORKER_LIMITS"] = f"{CAPTURE_HEAD_BYTES},{CAPTURE_TAIL_BYTES},{CAPTURE_KILL_BYTES}"
+        try:
+            self.proc = subprocess.Popen(
+                ["node", "-e", NODE_WORKER_SOURCE],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                cwd=cwd,
+                env=child_env,
+                pass_fds=(write_fd,),
+                start_new_session=True,
+            )
+        except Exception:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        self._fd = read_fd
+        self._reader = PipeLineReader(read_fd)
+
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def run(self, src: str, cwd: str, timeout_sec: float) -> subprocess.CompletedProcess:
+        """Evaluate src in the worker. Raises subprocess.TimeoutExpired (worker is killed)."""
+        self._next_id += 1
+        req_id = self._next_id
+        self.last_used = time.time()
+        payload = json.dumps({"id": req_id, "code": src, "cwd": cwd}) + "\n"
+        try:
+            self.proc.stdin.write(payload.encode("utf-8"))
+            self.proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            self.close()
+            raise RuntimeError("node worker exited")
+        deadline = time.monotonic() + timeout_sec
+        while True:
+            try:
+                line = self._reader.readline(deadline)
+            except ValueError:
+                self.close()
+                raise RuntimeError("node worker reply too large")
+            if line is None:
+                self.close()
+                raise subprocess.TimeoutExpired(["node"], timeout_sec)
+            if line == b"":
+                self.close()
+                raise RuntimeError("node worker exited")
+            try:
+                res = json.loads(line)
+            except ValueError:
+                continue
+            if res.get("id") == req_id:
+                stderr = res.get("stderr", "")
+                if res.get("over_budget"):
+                    # The worker killed itself after writing more than CAPTURE_KILL_BYTES
+                    self.close()
+                    stderr += over_budget_note(CAPTURE_KILL_BYTES)
+                return subprocess.CompletedProcess(["node"], int(res.get("code") or 0), res.get("stdout", ""), stderr)
+
+    def close(self) -> None:
+        if self.proc is None:
+            return
+        try:
+            os.killpg(self.proc.pid, 9)
+        except Exception:
+            try:
+                self.proc.kill()
+            except Exception:
+                pass
+        try:
+            self.proc.wait(timeout=1)
+        except Exception:
+            pass
+        try:
+            os.close(self._fd)
+        except Exception:
+            pass
+        self._fd = -1
+
+
+def _env_digest(env: dict) -> str:
+    h = hashlib.sha1()
+    for k, v in sorted(env.items()):
+        h.update(f"{k}={v}\0".encode("utf-8", errors="replace"))
+    return h.hexdigest()
+
+
+class NodeWorkerPool:
+    """Session key → NodeWorker, with idle expiry and a cap on live workers."""
+
+    def __init__(self, max_workers: int = JS_WORKER_MAX, idle_ttl: int = JS_WORKER_IDLE_TTL):
+        self.max_workers = max(1, max_workers)
+        self.idle_ttl = idle_ttl
+        self._workers: dict = {}
+        self._lock = threading.Lock()
+
+    def _evict(self) -> list:
+        """Pop idle workers, then the least recently used ones above the cap (caller holds _lock, closes them after)."""
+        now = time.time()
+        victims = []
+        for key, w in list(self._workers.items()):
+            if not w.users and (not w.alive() or now - w.last_used > self.idle_ttl):
+                victims.append(self._workers.pop(key))
+        while len(self._workers) >= self.max_workers:
+            idle = [(w.last_used, k) for k, w in self._workers.items() if not w.users]
+            if not idle:
+                break
+            _, key = min(idle)
+            victims.append(self._workers.pop(key))
+        return victims
+
+    def _get(self, key, env: dict) -> NodeWorker:
+        """
+        key's worker, marked in use under the pool lock so _evict can't close it
+        before run() locks it. A new worker is only a placeholder here: run()
+        spawns node under the worker's own lock, so a slow start doesn't hold up
+        the runs of other keys.
+        """
+        victims = []
+        with self._lock:
+            w = self._workers.get(key)
+            if w is not None and not w.users and (not w.alive() or w.env_digest != _env_digest(env)):
+                # Environment changed via export/unset: restart so process.env matches
+                victims.append(self._workers.pop(key))
+                w = None
+            if w is None:
+                victims += self._evict()
+                w = NodeWorker(env)
+                self._workers[key] = w
+            w.users += 1
+        for victim in victims:
+            victim.close()
+        return w
+
+    def _forget(self, key, w: NodeWorker) -> None:
+        with self._lock:
+            if self._workers.get(key) is w:
+                self._workers.pop(key, None)
+
+    def run(self, key, src: str, cwd: str, env: dict, timeout_sec: float) -> subprocess.CompletedProcess:
+        w = self._get(key, env)
+        try:
+            with w.lock:
+                if not w.alive():
+                    w.close()
+                    try:
+                        w.start(cwd, env)
+                    except Exception:
+                        self._forget(key, w)
+                        raise
+                with on_cancel(w.close):
+                    try:
+                        return w.run(src, cwd, timeout_sec)
+                    except (subprocess.TimeoutExpired, RuntimeError):
+                        self._forget(key, w)
+                        raise
+        finally:
+            with self._lock:
+                w.users -= 1
+
+    def reset(self, key) -> None:
+        with self._lock:
+            w = self._workers.pop(key, None)
+        if w is not None:
+            w.close()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            workers = list(self._workers.values())
+            self._workers.clear()
+        for w in workers:
+            w.close()
+
+
+_pool: NodeWorkerPool | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> NodeWorkerPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = NodeWorkerPool()
+        return _pool
+
+
+def run_js(key, src: str, cwd: str, env: dict, timeout_sec: int) -> subprocess.CompletedProcess:
+    """
+    Execute JS for a session (blocking, for use in thread).
+    Uses the warm worker of key when JS_WORKER=1, otherwise a fresh node per run.
+    """
+    if not JS_WORKER_ENABLED:
+        return run_js_blocking(src, cwd, env, timeout_sec)
+    return get_pool().run(key, src, cwd, env, timeout_sec)
+
+
+def reset_js(key) -> None:
+    """Drop the persistent JS state of key (no-op when workers are disabled)."""
+    if _pool is not None:
+        _pool.reset(key)
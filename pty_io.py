@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Event-driven PTY output for the threaded Web App server.
+
+One reactor thread watches every PTY master fd with selectors (epoll on
+Linux) and blocks without a timeout while all terminals are idle. Output is
+coalesced per terminal: the first bytes open a PTY_FRAME_LATENCY_MS window,
+and a frame is flushed when the window closes or PTY_FRAME_MAX bytes have
+piled up, so `cat bigfile` becomes a few large frames instead of thousands of
+4 KB messages.
+
+Frames are delivered by a small shared sender pool (a WebSocket send can
+block on a slow client; the reactor never does). A terminal whose client lags
+more than PTY_MAX_BUFFER bytes is unregistered until it catches up, which
+blocks the shell on write instead of growing memory.
+"""
+
+import os
+import time
+import struct
+import threading
+import selectors
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+PTY_FRAME_LATENCY_MS = float(os.getenv("PTY_FRAME_LATENCY_MS", "5"))
+PTY_FRAME_MAX = int(os.getenv("PTY_FRAME_MAX", str(64 * 1024)))
+PTY_MAX_BUFFER = int(os.getenv("PTY_MAX_BUFFER", str(1 << 20)))
+PTY_SENDER_THREADS = int(os.getenv("PTY_SENDER_THREADS", "4"))
+
+
+# ==== Binary /ws/terminal protocol ====
+# Negotiated in the auth message: the client sends {"type": "auth", ..., "binary": 1}
+# and the server answers {"type": "auth_ok", ..., "binary": true}. From then on
+# both sides may send binary WebSocket messages: one type byte + payload.
+# Output/input payloads are the raw terminal bytes (no JSON, no UTF-8 round trip;
+# the client decodes with a streaming TextDecoder). JSON text messages stay valid.
+OP_OUTPUT = 0x00  # server -> client, raw PTY bytes
+OP_INPUT = 0x01   # client -> server, raw bytes for the PTY
+OP_RESIZE = 0x02  # client -> server, rows:u16 cols:u16 (big endian)
+OP_PING = 0x03
+OP_PONG = 0x04
+OP_EXIT = 0x05    # server -> client, the shell ended
+
+BINARY_PROTOCOL_VERSION = 1
+
+
+def wants_binary(auth_msg: dict) -> bool:
+    """True if the client's auth message asks for the binary protocol (a version we speak)."""
+    try:
+        return int(auth_msg.get("binary") or 0) >= BINARY_PROTOCOL_VERSION
+    except (TypeError, ValueError):
+        return False
+
+
+def encode_frame(op: int, payload: bytes = b"") -> bytes:
+    return bytes((op,)) + payload
+
+
+def decode_frame(message: bytes) -> tuple[int | None, bytes]:
+    """(op, payload) of a binary message; op None if empty."""
+    if not message:
+        return None, b""
+    return message[0], bytes(message[1:])
+
+
+def decode_resize(payload: bytes) -> tuple[int, int] | None:
+    if len(payload) < 4:
+        return None
+    return struct.unpack(">HH", payload[:4])
+
+
+class _Stream:
+    __slots__ = ("fd", "send", "on_close", "chunks", "nbytes", "deadline",
+                 "frames", "queued", "sending", "paused", "eof", "closed", "notified")
+
+    def __init__(self, fd: int, send, on_close):
+        self.fd = fd
+        self.send = send
+        self.on_close = on_close
+        self.chunks: list[bytes] = []  # read but not yet framed
+        self.nbytes = 0
+        self.deadline = None           # flush time of the open latency window
+        self.frames: deque = deque()   # framed, waiting for the sender
+        self.queued = 0                # bytes in frames
+        self.sending = False
+        self.paused = False
+        self.eof = False
+        self.closed = False
+        self.notified = False          # on_close already called
+
+
+class PtyReactor:
+    """Shared reader for PTY master fds. add() a terminal, remove() it before closing its fd."""
+
+    def __init__(self, latency_ms: float = PTY_FRAME_LATENCY_MS, frame_max: int = PTY_FRAME_MAX,
+                 max_buffer: int = PTY_MAX_BUFFER, sender_threads: int = PTY_SENDER_THREADS):
+        self.latency = max(0.0, latency_ms) / 1000.0
+        self.frame_max = max(1024, frame_max)
+        self.max_buffer = max(self.frame_max, max_buffer)
+        self._sel = selectors.DefaultSelector()
+        self._streams: dict[int, _Stream] = {}
+        self._lock = threading.Lock()
+        self._pending: list = []  # (action, stream, done_event) for the reactor thread
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._sel.register(self._wake_r, selectors.EVENT_READ)
+        self._senders = ThreadPoolExecutor(max_workers=max(1, sender_threads), thread_name_prefix="pty-send")
+        self._thread = None
+        self.frames_sent = 0
+        self.bytes_sent = 0
+
+    # ---- public API (any thread) ----
+    def add(self, fd: int, send, on_close=None) -> None:
+        """
+        Start forwarding fd. send(data: bytes) gets each frame, in order, from a
+        sender thread; on_close() runs once after the last frame when the PTY ends.
+        """
+        os.set_blocking(fd, False)
+        stream = _Stream(fd, send, on_close)
+        with self._lock:
+            self._streams[fd] = stream
+        self._ensure_thread()
+        self._call("add", stream)
+
+    def remove(self, fd: int, timeout: float = 2.0) -> None:
+        """
+        Stop watching fd; returns once the reactor no longer touches it (safe to
+        close). Pending frames are dropped and on_close() runs if it has not yet.
+        """
+        with self._lock:
+            stream = self._streams.pop(fd, None)
+            if stream is None:
+                return
+            stream.closed = True
+            stream.frames.clear()
+            notify = stream.on_close is not None and not stream.notified
+            stream.notified = True
+        if self._thread is None or threading.current_thread() is self._thread:
+            self._unregister(stream)
+        else:
+            self._call("remove", stream, wait=timeout)
+        if notify:
+            self._senders.submit(self._notify, stream.on_close)
+
+    @staticmethod
+    def _notify(on_close):
+        try:
+            on_close()
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "terminals": len(self._streams),
+                "paused": sum(1 for s in self._streams.values() if s.paused),
+                "queued_bytes": sum(s.queued for s in self._streams.values()),
+                "frames_sent": self.frames_sent,
+                "bytes_sent": self.bytes_sent,
+            }
+
+    # ---- reactor thread ----
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="pty-reactor", daemon=True)
+                self._thread.start()
+
+    def _call(self, action: str, stream: _Stream, wait: float | None = None):
+        done = threading.Event() if wait else None
+        with self._lock:
+            self._pending.append((action, stream, done))
+        try:
+            os.write(self._wake_w, b"\0")
+        except BlockingIOError:
+            pass  # already woken
+        if done is not None:
+            done.wait(wait)
+
+    def _unregister(self, stream: _Stream):
+        try:
+            self._sel.unregister(stream.fd)
+        except (KeyError, ValueError, OSError):
+            pass
+
+    def _run(self):
+        while True:
+            timeout = None
+            now = time.monotonic()
+            with self._lock:
+                deadlines = [s.deadline for s in self._streams.values() if s.deadline is not None]
+            if deadlines:
+                timeout = max(0.0, min(deadlines) - now)
+            for key, _ in self._sel.select(timeout):
+                if key.fd == self._wake_r:
+                    self._drain_wakeups()
+                else:
+                    self._on_readable(key.data)
+            now = time.monotonic()
+            with self._lock:
+                due = [s for s in self._streams.values() if s.deadline is not None and s.deadline <= now]
+            for stream in due:
+                self._flush(stream)
+
+    def _drain_wakeups(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for action, stream, done in pending:
+            if action == "add" and not stream.closed:
+                self._sel.register(stream.fd, selectors.EVENT_READ, stream)
+            elif action == "resume" and stream.paused and not stream.closed and not stream.eof:
+                stream.paused = False
+                self._sel.register(stream.fd, selectors.EVENT_READ, stream)
+            elif action == "remove":
+                self._unregister(stream)
+            if done is not None:
+                done.set()
+
+    def _on_readable(self, stream: _Stream):
+        try:
+            data = os.read(stream.fd, self.frame_max)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""  # EIO: the shell exited
+        if not data:
+            stream.eof = True
+            self._unregister(stream)
+            self._flush(stream)
+            return
+        stream.chunks.append(data)
+        stream.nbytes += len(data)
+        if stream.nbytes >= self.frame_max or self.latency == 0:
+            self._flush(stream)
+        elif stream.deadline is None:
+            stream.deadline = time.monotonic() + self.latency
+
+    def _flush(self, stream: _Stream):
+        """Turn buffered bytes into frames (<= frame_max) and hand them to the sender."""
+        data = b"".join(stream.chunks)
+        stream.chunks.clear()
+        stream.nbytes = 0
+        stream.deadline = None
+        with self._lock:
+            if stream.closed:
+                return
+            for i in range(0, len(data), self.frame_max):
+                frame = data[i:i + self.frame_max]
+                stream.frames.append(frame)
+                stream.queued += len(frame)
+            if stream.eof:
+                stream.frames.append(None)  # end marker -> on_close
+            if stream.queued > self.max_buffer and not stream.paused and not stream.eof:
+                stream.paused = True
+                self._unregister(stream)
+            if stream.frames and not stream.sending:
+                stream.sending = True
+                self._senders.submit(self._send_frames, stream)
+
+    # ---- sender threads ----
+    def _send_frames(self, stream: _Stream):
+        while True:
+            with self._lock:
+                if not stream.frames or stream.closed:
+                    stream.sending = False
+                    return
+                frame = stream.frames.popleft()
+                if frame is not None:
+                    stream.queued -= len(frame)
+                resume = stream.paused and stream.queued <= self.max_buffer // 2
+            if resume:
+                self._call("resume", stream)
+            try:
+                if frame is None:
+                    with self._lock:
+                        notify = stream.on_close is not None and not stream.notified
+                        stream.notified = True
+                    if notify:
+                        stream.on_close()
+                    continue
+                stream.send(frame)
+                self.frames_sent += 1
+                self.bytes_sent += len(frame)
+            except Exception:
+                # Client gone; the WebSocket handler cleans up via remove()
+                with self._lock:
+                    stream.frames.clear()
+                    stream.queued = 0
+
+
+_REACTOR = None
+_REACTOR_LOCK = threading.Lock()
+
+
+def get_reactor() -> PtyReactor:
+    """Process-wide reactor, created on first use."""
+    global _REACTOR
+    if _REACTOR is None:
+        with _REACTOR_LOCK:
+            if _REACTOR is None:
+                _REACTOR = PtyReactor()
+    return _REACTOR
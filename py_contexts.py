@@ -0,0 +1,411 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent /py namespaces with idle expiry and a memory budget.
+
+PythonContexts replaces the plain PY_CONTEXT dicts of bot.py and
+webapp_server.py (same get / [] / pop / in API). Each namespace records when
+it was last used and its approximate deep size, measured after every run.
+
+  PY_CONTEXT_IDLE_TTL  - seconds without use before a namespace is evicted (0 = never)
+  PY_CONTEXT_MAX_MB    - total budget; above it the least recently used idle
+                         namespaces are evicted (0 = no budget)
+  PY_CONTEXT_SPILL_DIR - if set, evicted namespaces are pickled here (dill when
+                         installed) and restored transparently on the next use;
+                         values that can't be pickled are dropped
+
+Eviction is checked on access (like the JS worker pool), never for a
+namespace that is running code. Spilling happens outside the lock, streaming
+one value at a time to the file; a namespace used again while it is being
+spilled is simply taken back. Restoring also reads the file outside the lock;
+other callers for the same key wait for that restore.
+"""
+
+import os
+import re
+import sys
+import time
+import types
+import importlib
+import threading
+import contextlib
+
+try:
+    import dill as _pickle  # functions/lambdas/classes defined in /py survive a spill
+except ImportError:
+    import pickle as _pickle
+
+
+PY_CONTEXT_IDLE_TTL = int(os.getenv("PY_CONTEXT_IDLE_TTL", "3600"))
+PY_CONTEXT_MAX_MB = int(os.getenv("PY_CONTEXT_MAX_MB", "1024"))
+PY_CONTEXT_SPILL_DIR = os.getenv("PY_CONTEXT_SPILL_DIR", "").strip()
+# Sizing walks at most this many objects per namespace (keeps accounting O(1)-ish for huge graphs)
+PY_CONTEXT_SIZE_LIMIT = int(os.getenv("PY_CONTEXT_SIZE_LIMIT", "200000"))
+
+# Names injected by the bot (Telegram objects); never measured or spilled
+SKIP_NAMES = frozenset(("__builtins__", "update", "context"))
+
+_SHARED_TYPES = (types.ModuleType, type, types.FunctionType, types.BuiltinFunctionType, types.MethodType)
+
+
+def deep_sizeof(ns: dict, limit: int = PY_CONTEXT_SIZE_LIMIT) -> int:
+    """
+    Approximate bytes held by the values of a namespace: sys.getsizeof over the
+    object graph (containers, instance __dict__/__slots__), each object once.
+    Modules, classes and functions are shared code and not counted. Objects
+    with their own __sizeof__ (numpy arrays, pandas frames) report their buffers.
+
+    Another thread may be running code in ns (or mutating what it holds), so
+    the walk works on snapshots and skips any object that fails to measure:
+    the result is an estimate, never an exception.
+    """
+    seen = set()
+    try:
+        stack = [v for k, v in list(ns.items()) if k not in SKIP_NAMES]
+    except RuntimeError:  # changed size while being copied
+        return 0
+    total = 0
+    while stack and len(seen) < limit:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+        try:
+            total += sys.getsizeof(obj)
+            if isinstance(obj, (str, bytes, bytearray, int, float, complex, bool)):
+                continue
+            if isinstance(obj, dict):
+                items = list(obj.items())
+                stack.extend(k for k, _ in items)
+                stack.extend(v for _, v in items)
+            elif isinstance(obj, (list, tuple, set, frozenset)):
+                stack.extend(list(obj))
+            else:
+                if type(obj).__module__ in ("numpy", "pandas.core.frame", "pandas.core.series"):
+                    continue  # __sizeof__ already covers the data; don't walk internals
+                d = getattr(obj, "__dict__", None)
+                if isinstance(d, dict):
+                    stack.append(d)
+                for slot in getattr(type(obj), "__slots__", ()):
+                    try:
+                        stack.append(getattr(obj, slot))
+                    except AttributeError:
+                        pass
+        except Exception:
+            continue  # mutated mid-walk, or a property/__sizeof__ that raises
+    return total
+
+
+def new_namespace() -> dict:
+    return {"__builtins__": __builtins__, "__name__": "__main__"}
+
+
+class PythonContexts:
+    """Key (chat_id / user_id) → /py namespace, with accounting and eviction."""
+
+    def __init__(self, idle_ttl: int = PY_CONTEXT_IDLE_TTL, max_mb: int = PY_CONTEXT_MAX_MB,
+                 spill_dir: str = PY_CONTEXT_SPILL_DIR):
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max(0, max_mb) * 1024 * 1024
+        self.spill_dir = spill_dir
+        self._ns: dict = {}
+        self._last_used: dict = {}
+        self._sizes: dict = {}
+        self._busy: dict = {}
+        self._spilling: dict = {}  # key -> namespace being written out (still reclaimable)
+        self._restoring: dict = {}  # key -> Event set when its spill file has been read back
+        self._lock = threading.RLock()
+        self.evictions = 0
+        self.spills = 0
+        self.restores = 0
+        self.dropped_names = 0
+
+    # ---- dict API (what the handlers used before) ----
+    def get(self, key, default=None):
+        ns, victims = self._load(key)
+        self._spill_all(victims)
+        return default if ns is None else ns
+
+    def _load(self, key, create: bool = False, busy: bool = False) -> tuple:
+        """
+        key's namespace from memory, a spill in progress or disk (a new one if
+        create and there is none), marked busy if asked. Returns (ns | None,
+        victims to spill). Called without _lock: a restore reads the file
+        outside it so other keys aren't held up, and other callers for the
+        same key wait for that restore instead of starting their own.
+        """
+        victims = []
+        while True:
+            path = None
+            with self._lock:
+                victims += self._evict_idle()
+                ns = self._ns.get(key)
+                if ns is None:
+                    ns = self._reclaim(key)
+                restoring = self._restoring.get(key)
+                if ns is None and restoring is None:
+                    path = self._spill_path(key)
+                    if path and os.path.exists(path):
+                        restoring = self._restoring[key] = threading.Event()
+                    else:
+                        path = None
+                        if create:
+                            ns = new_namespace()
+                            self[key] = ns
+                if ns is not None:
+                    self._last_used[key] = time.time()
+                    if busy:
+                        self._busy[key] = self._busy.get(key, 0) + 1
+                    return ns, victims
+                if restoring is None:
+                    return None, victims
+            if path is None:
+                restoring.wait()  # another thread is restoring key
+                continue
+            ns, dropped = None, 0
+            try:
+                ns, dropped = self._read_spill(key, path)
+            finally:
+                with self._lock:
+                    self.dropped_names += dropped
+                    # pop() during the restore discards what was read
+                    if self._restoring.get(key) is restoring:
+                        del self._restoring[key]
+                        if ns is not None and key not in self._ns:
+                            self._ns[key] = ns
+                            self._sizes[key] = 0  # measured after the next run
+                            self.restores += 1
+                restoring.set()
+
+    def __getitem__(self, key):
+        ns = self.get(key)
+        if ns is None:
+            raise KeyError(key)
+        return ns
+
+    def __setitem__(self, key, ns: dict) -> None:
+        with self._lock:
+            self._ns[key] = ns
+            self._last_used[key] = time.time()
+            self._sizes.setdefault(key, 0)
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            if key in self._ns or key in self._spilling or key in self._restoring:
+                return True
+            return os.path.exists(self._spill_path(key) or "")
+
+    def pop(self, key, default=None):
+        """Forget key's namespace, in memory and on disk."""
+        with self._lock:
+            ns = self._ns.pop(key, None)
+            spilling = self._spilling.pop(key, None)  # its writer sees this and discards the file
+            self._restoring.pop(key, None)  # likewise for a restore in progress
+            ns = spilling if ns is None else ns
+            self._last_used.pop(key, None)
+            self._sizes.pop(key, None)
+            path = self._spill_path(key)
+        if path:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+        return default if ns is None else ns
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._ns)
+
+    # ---- running code ----
+    @contextlib.contextmanager
+    def use(self, key):
+        """
+        The namespace of key (created if missing) for one run. It is not
+        evicted while in use; afterwards its size is measured and the budget
+        enforced.
+        """
+        ns, victims = self._load(key, create=True, busy=True)
+        self._spill_all(victims)
+        try:
+            yield ns
+        finally:
+            with self._lock:
+                self._busy[key] -= 1
+                if not self._busy[key]:
+                    del self._busy[key]
+            self.account(key, ns)
+
+    def account(self, key, ns: dict | None = None) -> int:
+        """Measure key's namespace now, then evict others if over budget. Returns its size."""
+        if ns is None:
+            with self._lock:
+                ns = self._ns.get(key)
+            if ns is None:
+                return 0
+        size = deep_sizeof(ns)
+        with self._lock:
+            if self._ns.get(key) is ns:
+                self._sizes[key] = size
+                self._last_used[key] = time.time()
+            victims = self._enforce_budget(keep=key)
+        self._spill_all(victims)
+        return size
+
+    # ---- eviction ----
+    # _evict_idle/_enforce_budget only detach namespaces (caller holds _lock);
+    # the caller spills the returned victims after releasing it.
+    def _evict_idle(self) -> list:
+        if self.idle_ttl <= 0:
+            return []
+        cutoff = time.time() - self.idle_ttl
+        keys = [k for k, t in self._last_used.items() if t < cutoff and k not in self._busy]
+        return [v for v in map(self._detach, keys) if v is not None]
+
+    def _enforce_budget(self, keep=None) -> list:
+        victims = []
+        if self.max_bytes <= 0:
+            return victims
+        while sum(self._sizes.values()) > self.max_bytes:
+            idle = [(t, k) for k, t in self._last_used.items() if k != keep and k not in self._busy]
+            if not idle:
+                break  # a single namespace over budget is left alone while its owner uses it
+            victim = self._detach(min(idle)[1])
+            if victim is not None:
+                victims.append(victim)
+        return victims
+
+    def _detach(self, key):
+        """Take key's namespace out of memory (caller holds _lock). Returns (key, ns) or None."""
+        if key in self._busy:
+            return None
+        ns = self._ns.pop(key, None)
+        self._last_used.pop(key, None)
+        self._sizes.pop(key, None)
+        if ns is None:
+            return None
+        self.evictions += 1
+        if self.spill_dir:
+            self._spilling[key] = ns
+        return key, ns
+
+    def _spill_all(self, victims: list) -> None:
+        if self.spill_dir:
+            for key, ns in victims:
+                self._spill(key, ns)
+
+    def evict(self, key) -> bool:
+        """Drop key's namespace from memory (spilling it to disk if enabled)."""
+        with self._lock:
+            victim = self._detach(key)
+        if victim is None:
+            return False
+        self._spill_all([victim])
+        return True
+
+    def _reclaim(self, key):
+        """A namespace still being spilled goes straight back to memory (caller holds _lock)."""
+        ns = self._spilling.pop(key, None)
+        if ns is not None:
+            self._ns[key] = ns
+            self._sizes[key] = 0  # measured after the next run
+        return ns
+
+    # ---- spill ----
+    def _spill_path(self, key) -> str | None:
+        if not self.spill_dir:
+            return None
+        return os.path.join(self.spill_dir, re.sub(r"[^\w-]", "_", str(key)) + ".pkl")
+
+    def _spill(self, key, ns: dict) -> None:
+        """
+        Write ns to its spill file without holding _lock: a header, then one
+        (name, value) pickle per value, streamed to the file. A value that can't
+        be pickled is cut off the file again and dropped.
+        """
+        path = self._spill_path(key)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        items = [(k, v) for k, v in list(ns.items()) if k not in SKIP_NAMES]
+        modules = {k: v.__name__ for k, v in items if isinstance(v, types.ModuleType)}
+        dropped = 0
+        try:
+            os.makedirs(self.spill_dir, mode=0o700, exist_ok=True)
+            with open(tmp, "wb") as fh:
+                _pickle.dump({"saved_at": time.time(), "modules": modules}, fh)
+                for name, value in items:
+                    if name in modules:
+                        continue
+                    pos = fh.tell()
+                    try:
+                        _pickle.dump((name, value), fh)
+                    except Exception:
+                        fh.seek(pos)
+                        fh.truncate()
+                        dropped += 1
+            with self._lock:
+                if self._spilling.get(key) is ns:
+                    os.replace(tmp, path)
+                    del self._spilling[key]
+                    self.spills += 1
+                    self.dropped_names += dropped
+                    return
+            os.remove(tmp)  # taken back (or popped) while we were writing
+        except Exception as e:
+            print(f"⚠️ py context spill failed for {key}: {e}")
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+            with self._lock:
+                if self._spilling.get(key) is ns:
+                    del self._spilling[key]
+
+    def _read_spill(self, key, path: str) -> tuple:
+        """Load a spilled namespace back, without holding _lock. The file is removed. Returns (ns | None, dropped)."""
+        ns = new_namespace()
+        dropped = 0
+        try:
+            with open(path, "rb") as fh:
+                header = _pickle.load(fh)
+                for name, modname in header.get("modules", {}).items():
+                    with contextlib.suppress(Exception):
+                        ns[name] = importlib.import_module(modname)
+                while True:
+                    try:
+                        name, value = _pickle.load(fh)
+                    except EOFError:
+                        break
+                    except Exception:
+                        dropped += 1  # e.g. a class that no longer exists
+                        break
+                    ns[name] = value
+        except Exception as e:
+            print(f"⚠️ py context restore failed for {key}: {e}")
+            ns = None
+        with contextlib.suppress(OSError):
+            os.remove(path)
+        return ns, dropped
+
+    # ---- visibility ----
+    def sizes(self) -> dict:
+        """key -> {"bytes", "idle_sec"} for namespaces in memory."""
+        now = time.time()
+        with self._lock:
+            return {
+                k: {"bytes": self._sizes.get(k, 0), "idle_sec": int(now - self._last_used.get(k, now))}
+                for k in self._ns
+            }
+
+    def stats(self) -> dict:
+        with self._lock:
+            spilled = 0
+            if self.spill_dir and os.path.isdir(self.spill_dir):
+                spilled = sum(1 for f in os.listdir(self.spill_dir) if f.endswith(".pkl"))
+            return {
+                "contexts": len(self._ns),
+                "bytes": sum(self._sizes.values()),
+                "budget_bytes": self.max_bytes,
+                "idle_ttl": self.idle_ttl,
+                "busy": len(self._busy),
+                "spilled": spilled,
+                "evictions": self.evictions,
+                "spills": self.spills,
+                "restores": self.restores,
+                "dropped_names": self.dropped_names,
+                "pickler": _pickle.__name__,
+            }
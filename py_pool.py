@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Process-isolated Python execution pool.
+
+Each key (chat_id / user_id) gets its own worker process, forked on first use,
+which holds that key's persistent /py namespace. Output is captured inside the
+worker, so concurrent runs never mix their stdout, and a run that exceeds its
+timeout is stopped by killing the worker (only that key's namespace is lost;
+the next run starts a fresh one). PY_WORKERS caps the live workers.
+
+Each exec/call reply carries the namespace's deep size, so the pool keeps the
+same accounting as py_contexts.PythonContexts: per-key sizes for /health and
+the PY_CONTEXT_MAX_MB budget (least recently used idle workers are closed).
+
+Used by bot.py and webapp_server.py when PY_WORKERS > 0.
+"""
+
+import os
+import sys
+import ast
+import time
+import asyncio
+import inspect
+import importlib
+import threading
+import multiprocessing
+
+from shared_utils import exec_python_in_context, on_cancel
+from py_contexts import PY_CONTEXT_IDLE_TTL, PY_CONTEXT_MAX_MB, deep_sizeof
+
+
+# ==== Worker process ====
+def _new_namespace() -> dict:
+    return {"__builtins__": __builtins__, "__name__": "__main__"}
+
+
+def _eval_last_expression(src: str, ns: dict) -> str:
+    """Evaluate the last expression of src (REPL style). Returns '' if none."""
+    try:
+        mod = ast.parse(src, mode="exec")
+        if not getattr(mod, "body", None) or not isinstance(mod.body[-1], ast.Expr):
+            return ""
+        expr_code = compile(ast.Expression(mod.body[-1].value), filename="<py>", mode="eval")
+        value = eval(expr_code, ns, ns)
+        if inspect.isawaitable(value):
+            value = asyncio.run(value)
+        return "" if value is None else str(value)
+    except Exception:
+        return ""
+
+
+def _call_in_namespace(ns: dict, func_name: str, args: list) -> tuple[str, str, str | None, str]:
+    """Call ns[func_name](*args) with output capture. Returns (stdout, stderr, tb, result_text)."""
+    result_box = {"value": None}
+
+    def _runner():
+        value = ns[func_name](*args)
+        if inspect.isawaitable(value):
+            value = asyncio.run(value)
+        result_box["value"] = value
+
+    ns["__pool_call__"] = _runner
+    try:
+        out, err, tb_text = exec_python_in_context("__pool_call__()\n", ns)
+    finally:
+        ns.pop("__pool_call__", None)
+    value = result_box["value"]
+    return out, err, tb_text, ("" if value is None else str(value))
+
+
+def _worker_main(conn) -> None:
+    """Worker loop: receives requests over a pipe and answers each one."""
+    namespaces: dict = {}
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError, KeyboardInterrupt):
+            break
+        op = msg[0]
+        try:
+            if op == "exec":
+                _, key, src, eval_last = msg
+                ns = namespaces.setdefault(key, _new_namespace())
+                # Packages installed by pip since the worker started should be importable
+                importlib.invalidate_caches()
+                out, err, tb_text = exec_python_in_context(src, ns)
+                if eval_last and not out.strip() and not err.strip() and not tb_text:
+                    out = _eval_last_expression(src, ns)
+                conn.send((out, err, tb_text, deep_sizeof(ns)))
+            elif op == "call":
+                _, key, func_name, args = msg
+                ns = namespaces.get(key) or {}
+                if not callable(ns.get(func_name)):
+                    conn.send(("", "", None, None, deep_sizeof(ns)))
+                else:
+                    conn.send(_call_in_namespace(ns, func_name, args) + (deep_sizeof(ns),))
+            elif op == "reset":
+                namespaces.pop(msg[1], None)
+                conn.send(True)
+            elif op == "ping":
+                conn.send(os.getpid())
+        except Exception as e:
+            # Unpicklable results etc. – never let the worker loop die, and
+            # answer in the shape the op's caller unpacks
+            try:
+                conn.send(_error_reply(op, namespaces.get(msg[1]) if len(msg) > 1 else None, e))
+            except Exception:
+                break
+
+
+def _error_reply(op: str, ns: dict | None, exc: Exception):
+    tb_text = f"{type(exc).__name__}: {exc}\n"
+    try:
+        size = deep_sizeof(ns) if ns else 0
+    except Exception:
+        size = 0
+    if op == "exec":
+        return ("", "", tb_text, size)
+    if op == "call":
+        return ("", "", tb_text, "", size)
+    return None
+
+
+# ==== Pool ====
+class _Worker:
+    """One worker process, owned by a single key."""
+
+    def __init__(self):
+        self.process = None
+        self.conn = None
+        self.lock = threading.Lock()  # one request at a time
+        self.users = 0  # requests holding or waiting for lock; never evicted while > 0
+        self.started_at = time.time()
+        self.last_used = time.time()
+        self.runs = 0
+        self.ns_bytes = 0  # deep size of the namespace after the last run
+
+    def start(self, mp, name: str) -> None:
+        parent_conn, child_conn = mp.Pipe()
+        proc = mp.Process(target=_worker_main, args=(child_conn,), daemon=True, name=name)
+        proc.start()
+        child_conn.close()
+        self.process, self.conn = proc, parent_conn
+        self.started_at = time.time()
+        self.ns_bytes = 0
+
+    def alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def kill(self) -> None:
+        if self.process is None:
+            return
+        try:
+            self.process.kill()
+            self.process.join(1)
+        except Exception:
+            pass
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+
+
+class PythonWorkerPool:
+    """
+    One worker process per key (chat_id / user_id), spawned on first use, at
+    most max_workers alive. When the cap is reached the least recently used
+    idle worker is closed (its namespace is lost, like a /py idle eviction);
+    if every worker is busy the request waits for one to finish.
+
+    Killing a worker on timeout only affects the key that owned it, and keys
+    never wait behind each other's runs.
+
+    execute() is blocking and thread-safe; call it from a thread (bot) or a
+    request thread (webapp). Raises TimeoutError when a run exceeds timeout_sec.
+    """
+
+    def __init__(self, max_workers: int = 8, idle_ttl: int = PY_CONTEXT_IDLE_TTL, max_mb: int = PY_CONTEXT_MAX_MB):
+        self.max_workers = max(1, int(max_workers))
+        self.idle_ttl = idle_ttl
+        self.max_bytes = max(0, max_mb) * 1024 * 1024
+        methods = multiprocessing.get_all_start_methods()
+        self._mp = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+        self._workers: dict = {}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._spawned = 0
+        self.restarts = 0
+        self.timeouts = 0
+        self.idle_evictions = 0
+        self.evictions = 0
+
+    # ---- lifecycle ----
+    def shutdown(self) -> None:
+        with self._lock:
+            workers = list(self._workers.values())
+            self._workers.clear()
+        for worker in workers:
+            worker.kill()
+
+    def _evict_idle(self) -> list:
+        """Pop workers unused for idle_ttl seconds (caller holds _lock, kills them after)."""
+        if self.idle_ttl <= 0:
+            return []
+        cutoff = time.time() - self.idle_ttl
+        idle = [k for k, w in self._workers.items() if not w.users and w.last_used < cutoff]
+        self.idle_evictions += len(idle)
+        return [self._workers.pop(k) for k in idle]
+
+    def _checkout(self, key, deadline: float) -> _Worker:
+        """key's worker with its lock held, started if needed. Raises TimeoutError."""
+        while True:
+            victims = []
+            try:
+                with self._cond:
+                    victims += self._evict_idle()
+                    worker = self._workers.get(key)
+                    while worker is None:
+                        if len(self._workers) < self.max_workers:
+                            worker = self._workers[key] = _Worker()
+                            break
+                        idle = [(w.last_used, k) for k, w in self._workers.items() if not w.users]
+                        if idle:
+                            victims.append(self._workers.pop(min(idle)[1]))
+                            self.evictions += 1
+                            continue
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise TimeoutError(f"All {self.max_workers} Python workers are busy")
+                        self._cond.wait(remaining)
+                        worker = self._workers.get(key)
+                    worker.users += 1
+            finally:
+                for victim in victims:
+                    victim.kill()
+
+            if not worker.lock.acquire(timeout=max(0.0, deadline - time.monotonic())):
+                self._checkin(worker)
+                raise TimeoutError("Python worker busy")
+            with self._lock:
+                current = self._workers.get(key) is worker
+            if not current:
+                # reset() dropped it while we waited; take a fresh one
+                worker.lock.release()
+                self._checkin(worker)
+                continue
+            if not worker.alive():
+                if worker.process is not None:
+                    worker.kill()
+                    self.restarts += 1
+                with self._lock:
+                    self._spawned += 1
+                    n = self._spawned
+                try:
+                    worker.start(self._mp, f"py-worker-{n}")
+                except Exception:
+                    worker.lock.release()
+                    self._checkin(worker)
+                    raise
+            return worker
+
+    def _checkin(self, worker: _Worker) -> None:
+        with self._cond:
+            worker.users -= 1
+            worker.last_used = time.time()
+            victims = self._enforce_budget(keep=worker)
+            self._cond.notify_all()
+        for victim in victims:
+            victim.kill()
+
+    def _enforce_budget(self, keep: _Worker) -> list:
+        """Pop least recently used idle workers while over max_bytes (caller holds _lock, kills them after)."""
+        victims = []
+        if self.max_bytes <= 0:
+            return victims
+        while sum(w.ns_bytes for w in self._workers.values()) > self.max_bytes:
+            idle = [(w.last_used, k) for k, w in self._workers.items() if not w.users and w is not keep]
+            if not idle:
+                break
+            victims.append(self._workers.pop(min(idle)[1]))
+            self.evictions += 1
+        return victims
+
+    def _request(self, key, msg: tuple, timeout_sec: float):
+        deadline = time.monotonic() + timeout_sec
+        worker = self._checkout(key, deadline)
+        try:
+            # Cancelling the run (RunCanceller) kills the worker, like a timeout
+            with on_cancel(worker.kill):
+                worker.conn.send(msg)
+                if not worker.conn.poll(max(0.0, deadline - time.monotonic())):
+                    # The only reliable way to stop running Python code: kill the process.
+                    # Only this key's namespace goes with it; the next request respawns.
+                    self.timeouts += 1
+                    worker.kill()
+                    raise TimeoutError(f"Python execution timed out after {timeout_sec}s")
+                reply = worker.conn.recv()
+            worker.runs += 1
+            if msg[0] in ("exec", "call"):
+                worker.ns_bytes, reply = reply[-1], reply[:-1]
+            return reply
+        except TimeoutError:
+            raise  # an OSError subclass, but not a dead worker
+        except (EOFError, OSError):
+            # Worker died mid-run (os._exit, segfault, OOM kill)
+            worker.kill()
+            return None
+        finally:
+            worker.lock.release()
+            self._checkin(worker)
+
+    # ---- API ----
+    def execute(self, key, src: str, timeout_sec: float, eval_last: bool = False) -> tuple[str, str, str | None]:
+        """
+        Execute src in the namespace of key.
+        Returns (stdout, stderr, traceback_text | None) like exec_python_in_context.
+        With eval_last=True and no output, the value of the last expression is returned as stdout.
+        """
+        reply = self._request(key, ("exec", key, src, eval_last), timeout_sec)
+        if reply is None:
+            return "", "", "Python worker process died; the context was reset.\n"
+        return reply
+
+    def call(self, key, func_name: str, args: list, timeout_sec: float) -> tuple[str, str, str | None, str | None] | None:
+        """
+        Call a function defined earlier in key's namespace.
+        Returns (stdout, stderr, traceback_text | None, result_text), with result_text None
+        if func_name is not a callable in the namespace; None if the worker died.
+        """
+        return self._request(key, ("call", key, func_name, list(args)), timeout_sec)
+
+    def reset(self, key) -> None:
+        """Drop key's namespace by closing its worker (a run in progress ends as "died")."""
+        with self._cond:
+            worker = self._workers.pop(key, None)
+            self._cond.notify_all()
+        if worker is not None:
+            worker.kill()
+
+    def sizes(self) -> dict:
+        """key -> {"bytes", "idle_sec"}, as measured after each key's last run."""
+        now = time.time()
+        with self._lock:
+            return {k: {"bytes": w.ns_bytes, "idle_sec": int(now - w.last_used)} for k, w in self._workers.items()}
+
+    def has_context(self, key) -> bool:
+        with self._lock:
+            return key in self._workers
+
+    def stats(self) -> dict:
+        with self._lock:
+            workers = list(self._workers.values())
+        return {
+            "workers": self.max_workers,
+            "alive": sum(1 for w in workers if w.alive()),
+            "contexts": len(workers),
+            "bytes": sum(w.ns_bytes for w in workers),
+            "budget_bytes": self.max_bytes,
+            "busy": sum(1 for w in workers if w.users),
+            "runs": sum(w.runs for w in workers),
+            "timeouts": self.timeouts,
+            "restarts": self.restarts,
+            "idle_evictions": self.idle_evictions,
+            "evictions": self.evictions,
+        }
+
+
+def create_pool_from_env(default_size: int) -> PythonWorkerPool | None:
+    """Returns a pool capped at PY_WORKERS live workers (0 disables and keeps in-process exec)."""
+    try:
+        size = int(os.getenv("PY_WORKERS", str(default_size)))
+    except ValueError:
+        size = default_size
+    if size <= 0 or sys.platform == "win32":
+        return None
+    return PythonWorkerPool(size)
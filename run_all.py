@@ -8,6 +8,8 @@ Usage:
     python run_all.py --bot-only   # Run only the bot
     python run_all.py --web-only   # Run only the web server
     python run_all.py --web-only --dev  # Run web server in dev mode (no auth)
+    python run_all.py --prod       # Web App under gunicorn in a supervised child process
+    WEBAPP_SERVER=aiohttp python run_all.py --prod  # ...or the async server (webapp_async.py)
 
 Environment Variables:
     BOT_TOKEN       - Telegram Bot Token (required for bot)
@@ -16,16 +18,33 @@ Environment Variables:
     WEBAPP_PORT     - Port for the web server (default: 8080)
     WEBAPP_HOST     - Host for the web server (default: 0.0.0.0)
     WEBAPP_DEV_MODE - Set to 1 to skip authentication (for development)
+    WEBAPP_SERVER   - "flask" (dev server in a bot thread, default), "gunicorn" (same as --prod)
+                      or "aiohttp" (async server: idle terminals cost no threads)
+    WEBAPP_THREADS  - gunicorn request threads (default: 16; each open terminal WebSocket holds one)
+    WEBAPP_RESTART_MAX_BACKOFF - Max seconds between restarts of a crashing web server (default: 30)
+
+Production mode runs gunicorn with ONE gthread worker: sessions, Python
+contexts and PTY terminals live in memory, so every request of a user must
+reach the same process. One worker + threads gives that affinity for free,
+while the separate process keeps web traffic off the bot's interpreter/GIL.
 """
 
 import os
 import sys
 import argparse
+import subprocess
 import threading
 import signal
 import time
 
 
+WEBAPP_SERVER = os.getenv("WEBAPP_SERVER", "flask").strip().lower()
+WEBAPP_THREADS = int(os.getenv("WEBAPP_THREADS", "16"))
+WEBAPP_RESTART_MAX_BACKOFF = float(os.getenv("WEBAPP_RESTART_MAX_BACKOFF", "30"))
+# A child that stayed up this long is considered healthy (backoff resets)
+WEBAPP_STABLE_AFTER = 60.0
+
+
 def run_webapp_in_thread():
     """Run the Flask web server in a background thread."""
     try:
@@ -38,6 +57,115 @@ def run_webapp_in_thread():
         print(f"❌ Web App error: {e}")
 
 
+def gunicorn_command(host: str, port: int) -> list:
+    """gunicorn argv for the Web App: 1 worker (in-memory sessions), gthread for concurrency."""
+    return [
+        sys.executable, "-m", "gunicorn",
+        "--workers", "1",
+        "--worker-class", "gthread",
+        "--threads", str(max(2, WEBAPP_THREADS)),
+        "--bind", f"{host}:{port}",
+        "--graceful-timeout", "10",
+        "webapp_server:app",
+    ]
+
+
+def webapp_command(host: str, port: int) -> list | None:
+    """argv of the supervised Web App process, or None if its server package is not installed."""
+    if WEBAPP_SERVER == "aiohttp":
+        try:
+            import aiohttp  # noqa: F401
+        except ImportError:
+            print("⚠️ aiohttp is not installed - falling back to the Flask dev server")
+            return None
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "webapp_async.py")
+        return [sys.executable, script, "--host", host, "--port", str(port)]
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        print("⚠️ gunicorn is not installed - falling back to the Flask dev server")
+        return None
+    return gunicorn_command(host, port)
+
+
+def _die_with_parent():
+    """Linux: SIGTERM the child when run_all.py dies (e.g. os._exit from /restart), so the port is freed."""
+    try:
+        import ctypes
+        ctypes.CDLL("libc.so.6", use_errno=True).prctl(1, signal.SIGTERM)  # PR_SET_PDEATHSIG
+    except Exception:
+        pass
+
+
+class WebAppSupervisor:
+    """Keeps the Web App server process running: restarts it with exponential backoff when it exits."""
+
+    def __init__(self, cmd: list, max_backoff: float = WEBAPP_RESTART_MAX_BACKOFF, stable_after: float = WEBAPP_STABLE_AFTER):
+        self.cmd = cmd
+        self.max_backoff = max(1.0, max_backoff)
+        self.stable_after = stable_after
+        self.proc = None
+        self.restarts = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Supervise in a background thread."""
+        self._thread = threading.Thread(target=self.run, daemon=True, name="webapp-supervisor")
+        self._thread.start()
+
+    def run(self):
+        """Supervise in the current thread until stop()."""
+        backoff = 1.0
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.proc = subprocess.Popen(self.cmd, preexec_fn=_die_with_parent)
+            except OSError as e:
+                print(f"❌ Web App failed to start: {e}")
+                code = None
+            else:
+                code = self.proc.wait()
+            if self._stop.is_set():
+                break
+            if time.monotonic() - started >= self.stable_after:
+                backoff = 1.0
+            self.restarts += 1
+            print(f"⚠️ Web App exited (code {code}), restarting in {backoff:.0f}s")
+            if self._stop.wait(backoff):
+                break
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def is_running(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def stop(self, timeout: float = 15.0):
+        """Stop supervising and shut the server down (SIGTERM = gunicorn graceful shutdown)."""
+        self._stop.set()
+        proc = self.proc
+        if proc is not None and proc.poll() is None:
+            proc.terminate()
+            try:
+                proc.wait(timeout)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=5)
+
+
+def start_webapp_process():
+    """Start the supervised Web App process. Returns None if its server is not installed."""
+    host = os.getenv("WEBAPP_HOST", "0.0.0.0")
+    port = int(os.getenv("WEBAPP_PORT", "8080"))
+    cmd = webapp_command(host, port)
+    if cmd is None:
+        return None
+    supervisor = WebAppSupervisor(cmd)
+    supervisor.start()
+    return supervisor
+
+
 def run_bot_in_main():
     """Run the Telegram bot in the main thread (required for signal handlers)."""
     print("🤖 Starting Telegram Bot...")
@@ -45,13 +173,24 @@ def run_bot_in_main():
     bot.main()
 
 
-def run_webapp_only():
-    """Run only the Flask web server."""
+def run_webapp_only(prod: bool = False):
+    """Run only the web server (supervised gunicorn/aiohttp in prod mode, Flask otherwise)."""
     print("🌐 Starting Web App Server...")
+    host = os.getenv("WEBAPP_HOST", "0.0.0.0")
+    port = int(os.getenv("WEBAPP_PORT", "8080"))
+    cmd = webapp_command(host, port) if prod else None
+    if cmd is not None:
+        supervisor = WebAppSupervisor(cmd)
+        signal.signal(signal.SIGTERM, lambda *_: supervisor.stop())
+        try:
+            supervisor.run()
+        except KeyboardInterrupt:
+            print("\n⏹️ Shutting down...")
+        finally:
+            supervisor.stop()
+        return
     try:
         import webapp_server
-        host = os.getenv("WEBAPP_HOST", "0.0.0.0")
-        port = int(os.getenv("WEBAPP_PORT", "8080"))
         webapp_server.run_server(host=host, port=port)
     except Exception as e:
         print(f"❌ Web App error: {e}")
@@ -63,7 +202,9 @@ def main():
     parser.add_argument("--bot-only", action="store_true", help="Run only the Telegram bot")
     parser.add_argument("--web-only", action="store_true", help="Run only the Web App server")
     parser.add_argument("--dev", action="store_true", help="Enable dev mode (skip auth for web app)")
+    parser.add_argument("--prod", action="store_true", help="Serve the Web App with gunicorn in a supervised process")
     args = parser.parse_args()
+    prod = args.prod or WEBAPP_SERVER in ("gunicorn", "aiohttp")
     
     # Set dev mode environment variable if --dev flag is used
     if args.dev:
@@ -82,20 +223,26 @@ def main():
         return
     
     if args.web_only:
-        run_webapp_only()
+        run_webapp_only(prod)
         return
     
-    # Run both: Web App in thread, Bot in main thread
+    # Run both: Web App in thread (or a supervised gunicorn process), Bot in main thread
     # (Bot MUST be in main thread for signal handlers to work)
     
-    print("🌐 Starting Web App Server in background...")
-    web_thread = threading.Thread(target=run_webapp_in_thread, daemon=True, name="webapp")
-    web_thread.start()
-    
-    # Give the web server a moment to start
-    time.sleep(1)
+    supervisor = start_webapp_process() if prod else None
+    if supervisor is not None:
+        print(f"🌐 Starting Web App Server ({'aiohttp' if WEBAPP_SERVER == 'aiohttp' else 'gunicorn'}) in a separate process...")
+        time.sleep(1)
+        web_ok = supervisor.is_running()
+    else:
+        print("🌐 Starting Web App Server in background...")
+        web_thread = threading.Thread(target=run_webapp_in_thread, daemon=True, name="webapp")
+        web_thread.start()
+        # Give the web server a moment to start
+        time.sleep(1)
+        web_ok = web_thread.is_alive()
     
-    if web_thread.is_alive():
+    if web_ok:
         print(f"✅ Web App running on http://0.0.0.0:{os.getenv('WEBAPP_PORT', '8080')}")
     else:
         print("⚠️ Web App failed to start")
@@ -110,6 +257,9 @@ def main():
     except Exception as e:
         print(f"❌ Bot crashed: {e}")
         sys.exit(1)
+    finally:
+        if supervisor is not None:
+            supervisor.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,393 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared execution scheduler (admission control) for bot.py and webapp_server.py.
+
+Jobs do not run inside the scheduler. A front end asks for a slot (a Ticket),
+waits until it is granted (blocking in a request thread, or awaiting on the
+bot's event loop), runs the job exactly as before and releases the slot.
+
+- Lanes: interactive (quick commands) < normal < heavy (builds, installs,
+  Java). A lower lane is always dispatched first; heavy tickets that waited
+  longer than SCHED_AGING_SEC are treated as normal so they cannot starve.
+- Fairness: inside a lane users are served round robin, and no user runs more
+  than SCHED_PER_USER jobs at once.
+- SCHED_INTERACTIVE_RESERVED of the SCHED_SLOTS slots are only used by the
+  interactive lane, so quick commands stay fast while heavy jobs run.
+- Queued tickets report their position; queued and running tickets can be
+  cancelled (running ones through a hook installed by the front end).
+"""
+
+import os
+import time
+import shlex
+import asyncio
+import itertools
+import threading
+from collections import OrderedDict, deque
+
+
+SCHED_SLOTS = int(os.getenv("SCHED_SLOTS", "4"))
+SCHED_INTERACTIVE_RESERVED = int(os.getenv("SCHED_INTERACTIVE_RESERVED", "1"))
+SCHED_PER_USER = int(os.getenv("SCHED_PER_USER", "2"))
+SCHED_HEAVY_MAX = int(os.getenv("SCHED_HEAVY_MAX", "2"))
+SCHED_MAX_QUEUED_PER_USER = int(os.getenv("SCHED_MAX_QUEUED_PER_USER", "10"))
+SCHED_AGING_SEC = float(os.getenv("SCHED_AGING_SEC", "30"))
+
+LANE_INTERACTIVE, LANE_NORMAL, LANE_HEAVY = 0, 1, 2
+LANE_NAMES = ("interactive", "normal", "heavy")
+
+# First shell token -> lane
+INTERACTIVE_CMDS = {
+    "cd", "export", "unset", "ls", "pwd", "echo", "cat", "head", "tail", "wc", "env",
+    "whoami", "id", "date", "uname", "uptime", "hostname", "stat", "file", "which",
+    "realpath", "readlink", "df", "free", "nproc", "printf", "true", "false", "ps",
+}
+HEAVY_CMDS = {
+    "pip", "pip3", "poetry", "uv", "npm", "npx", "yarn", "pnpm", "make", "cmake",
+    "gcc", "g++", "cc", "clang", "rustc", "cargo", "go", "javac", "mvn", "gradle",
+    "tsc", "pytest", "tar", "zip", "unzip", "7z", "git", "wget", "docker",
+}
+
+
+def classify(kind: str, code: str) -> int:
+    """Lane for a job: kind is sh/py/js/java, code is the command or snippet."""
+    if kind == "java":
+        return LANE_HEAVY
+    if kind != "sh":
+        return LANE_NORMAL
+    try:
+        parts = shlex.split(code or "", posix=True)
+    except ValueError:
+        parts = (code or "").split()
+    first = os.path.basename(parts[0]) if parts else ""
+    if first in INTERACTIVE_CMDS and not any(c in code for c in "|;&`$("):
+        return LANE_INTERACTIVE
+    if first in HEAVY_CMDS:
+        return LANE_HEAVY
+    return LANE_NORMAL
+
+
+class JobCancelled(Exception):
+    """The ticket was cancelled before (or while) it ran."""
+
+
+class QueueFull(Exception):
+    """The user already has SCHED_MAX_QUEUED_PER_USER queued jobs."""
+
+
+class Ticket:
+    """A job's place in the scheduler. Release it when the job finishes (also usable as a context manager)."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, scheduler: "Scheduler", user_id, lane: int, label: str):
+        self.id = next(self._ids)
+        self.user_id = user_id
+        self.lane = lane
+        self.label = label
+        self.state = "queued"  # queued -> running -> done, or cancelled
+        self.created = time.time()
+        self.started: float | None = None
+        self._scheduler = scheduler
+        self._event = threading.Event()
+        self._waiters: list = []
+        self._cancel_hook = None
+
+    @property
+    def granted(self) -> bool:
+        return self.state == "running"
+
+    @property
+    def cancelled(self) -> bool:
+        return self.state == "cancelled"
+
+    def position(self) -> int:
+        """1-based place in the queue (0 once running or finished)."""
+        return self._scheduler.position(self)
+
+    def set_cancel_hook(self, fn) -> None:
+        """
+        fn() is called (from any thread) if the ticket is cancelled while running,
+        or right away if that already happened before the hook was set.
+        """
+        with self._scheduler._lock:
+            self._cancel_hook = fn
+            fire = self.state == "cancelled" and self.started is not None
+        if fire:
+            try:
+                fn()
+            except Exception:
+                pass
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Block until granted. False on timeout; raises JobCancelled if cancelled."""
+        self._event.wait(timeout)
+        if self.state == "cancelled":
+            raise JobCancelled()
+        return self.state == "running"
+
+    async def wait_async(self) -> None:
+        """Await until granted; raises JobCancelled if cancelled."""
+        if not self._event.is_set():
+            loop = asyncio.get_running_loop()
+            fut = loop.create_future()
+
+            def _wake():
+                loop.call_soon_threadsafe(lambda: fut.done() or fut.set_result(None))
+
+            with self._scheduler._lock:
+                if not self._event.is_set():
+                    self._waiters.append(_wake)
+                else:
+                    fut.set_result(None)
+            try:
+                await fut
+            except asyncio.CancelledError:
+                self.cancel()
+                raise
+        if self.state == "cancelled":
+            raise JobCancelled()
+
+    def cancel(self) -> bool:
+        return self._scheduler.cancel(self)
+
+    def release(self) -> None:
+        self._scheduler.release(self)
+
+    def info(self) -> dict:
+        return {
+            "id": self.id,
+            "lane": LANE_NAMES[self.lane],
+            "label": self.label,
+            "state": self.state,
+            "position": self.position(),
+            "waited": round((self.started or time.time()) - self.created, 3),
+        }
+
+    def __enter__(self) -> "Ticket":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.release()
+
+
+class Scheduler:
+    def __init__(
+        self,
+        slots: int = SCHED_SLOTS,
+        interactive_reserved: int = SCHED_INTERACTIVE_RESERVED,
+        per_user: int = SCHED_PER_USER,
+        heavy_max: int = SCHED_HEAVY_MAX,
+        max_queued_per_user: int = SCHED_MAX_QUEUED_PER_USER,
+        aging_sec: float = SCHED_AGING_SEC,
+    ):
+        self.slots = max(1, slots)
+        self.interactive_reserved = min(max(0, interactive_reserved), self.slots - 1)
+        self.per_user = max(1, per_user)
+        self.heavy_max = max(1, heavy_max)
+        self.max_queued_per_user = max(1, max_queued_per_user)
+        self.aging_sec = aging_sec
+        self._lock = threading.Lock()
+        # lane -> OrderedDict(user_id -> deque[Ticket]); dict order is the round-robin order
+        self._queues = [OrderedDict() for _ in LANE_NAMES]
+        self._running: set[Ticket] = set()
+        self._running_by_user: dict = {}
+        self._queued_by_user: dict = {}
+        self.completed = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    # ---- admission ----
+    def submit(self, user_id, lane: int = LANE_NORMAL, label: str = "") -> Ticket:
+        """Queue a job; it may be granted immediately. Raises QueueFull."""
+        with self._lock:
+            if self._queued_by_user.get(user_id, 0) >= self.max_queued_per_user:
+                self.rejected += 1
+                raise QueueFull(f"too many queued jobs ({self.max_queued_per_user})")
+            ticket = Ticket(self, user_id, lane, label)
+            self._queues[lane].setdefault(user_id, deque()).append(ticket)
+            self._queued_by_user[user_id] = self._queued_by_user.get(user_id, 0) + 1
+            self._dispatch()
+            return ticket
+
+    def _can_run(self, t: Ticket) -> bool:
+        if self._running_by_user.get(t.user_id, 0) >= self.per_user:
+            return False
+        if t.lane == LANE_INTERACTIVE:
+            return True
+        non_interactive = sum(1 for r in self._running if r.lane != LANE_INTERACTIVE)
+        if non_interactive >= self.slots - self.interactive_reserved:
+            return False
+        if t.lane == LANE_HEAVY and sum(1 for r in self._running if r.lane == LANE_HEAVY) >= self.heavy_max:
+            return False
+        return True
+
+    def _lane_order(self) -> list[int]:
+        heavy = self._queues[LANE_HEAVY]
+        if heavy and self.aging_sec > 0:
+            oldest = min(q[0].created for q in heavy.values())
+            if time.time() - oldest > self.aging_sec:
+                return [LANE_INTERACTIVE, LANE_HEAVY, LANE_NORMAL]
+        return [LANE_INTERACTIVE, LANE_NORMAL, LANE_HEAVY]
+
+    def _user_order(self, lane: int) -> list:
+        """Users with queued tickets in lane: fewest running jobs first, then round robin."""
+        return sorted(self._queues[lane], key=lambda u: self._running_by_user.get(u, 0))
+
+    def _dispatch(self) -> None:
+        """Grant queued tickets while slots are free (caller holds _lock)."""
+        while len(self._running) < self.slots:
+            picked = None
+            for lane in self._lane_order():
+                for user_id in self._user_order(lane):
+                    if self._can_run(self._queues[lane][user_id][0]):
+                        picked = (lane, user_id)
+                        break
+                if picked:
+                    break
+            if picked is None:
+                return
+            lane, user_id = picked
+            queue = self._queues[lane]
+            ticket = queue[user_id].popleft()
+            if queue[user_id]:
+                queue.move_to_end(user_id)  # round robin: this user goes last
+            else:
+                del queue[user_id]
+            self._start(ticket)
+
+    def _start(self, ticket: Ticket) -> None:
+        self._dequeued(ticket)
+        ticket.state = "running"
+        ticket.started = time.time()
+        self._running.add(ticket)
+        self._running_by_user[ticket.user_id] = self._running_by_user.get(ticket.user_id, 0) + 1
+        self._wake(ticket)
+
+    def _dequeued(self, ticket: Ticket) -> None:
+        n = self._queued_by_user.get(ticket.user_id, 0) - 1
+        if n > 0:
+            self._queued_by_user[ticket.user_id] = n
+        else:
+            self._queued_by_user.pop(ticket.user_id, None)
+
+    @staticmethod
+    def _wake(ticket: Ticket) -> None:
+        ticket._event.set()
+        waiters, ticket._waiters = ticket._waiters, []
+        for w in waiters:
+            try:
+                w()
+            except Exception:
+                pass
+
+    # ---- completion ----
+    def release(self, ticket: Ticket) -> None:
+        with self._lock:
+            if ticket.state == "queued":
+                self._cancel_queued(ticket)
+            elif ticket in self._running:
+                self._running.discard(ticket)
+                n = self._running_by_user.get(ticket.user_id, 0) - 1
+                if n > 0:
+                    self._running_by_user[ticket.user_id] = n
+                else:
+                    self._running_by_user.pop(ticket.user_id, None)
+                if ticket.state == "running":
+                    ticket.state = "done"
+                    self.completed += 1
+            self._dispatch()
+
+    def _cancel_queued(self, ticket: Ticket) -> None:
+        queue = self._queues[ticket.lane]
+        tickets = queue.get(ticket.user_id)
+        if tickets is not None:
+            try:
+                tickets.remove(ticket)
+            except ValueError:
+                pass
+            if not tickets:
+                del queue[ticket.user_id]
+        self._dequeued(ticket)
+        ticket.state = "cancelled"
+        self.cancelled += 1
+        self._wake(ticket)
+
+    def cancel(self, ticket: Ticket) -> bool:
+        """Cancel a queued ticket, or ask a running one to stop via its hook. False if already finished."""
+        hook = None
+        with self._lock:
+            if ticket.state == "queued":
+                self._cancel_queued(ticket)
+                return True
+            if ticket.state != "running":
+                return False
+            ticket.state = "cancelled"
+            self.cancelled += 1
+            hook = ticket._cancel_hook
+        # The slot stays taken until the front end calls release()
+        if hook is not None:
+            try:
+                hook()
+            except Exception:
+                pass
+        return True
+
+    def cancel_user(self, user_id, job_id: int | None = None) -> int:
+        """Cancel the user's jobs (or only job_id). Returns how many were cancelled."""
+        with self._lock:
+            mine = [t for t in self._running if t.user_id == user_id]
+            for queue in self._queues:
+                mine.extend(queue.get(user_id, ()))
+        if job_id is not None:
+            mine = [t for t in mine if t.id == job_id]
+        return sum(1 for t in mine if self.cancel(t))
+
+    # ---- introspection ----
+    def position(self, ticket: Ticket) -> int:
+        """Estimated 1-based queue position: earlier lanes first, then round robin within the lane."""
+        with self._lock:
+            if ticket.state != "queued":
+                return 0
+            order = self._lane_order()
+            ahead = 0
+            for lane in order:
+                queue = self._queues[lane]
+                if lane != ticket.lane:
+                    ahead += sum(len(q) for q in queue.values())
+                    continue
+                users = self._user_order(lane)
+                mine = queue.get(ticket.user_id) or deque()
+                idx = mine.index(ticket) if ticket in mine else 0
+                my_rank = users.index(ticket.user_id) if ticket.user_id in users else len(users)
+                for rank, user_id in enumerate(users):
+                    if user_id == ticket.user_id:
+                        ahead += idx
+                    else:
+                        ahead += min(len(queue[user_id]), idx + (1 if rank < my_rank else 0))
+                break
+            return ahead + 1
+
+    def user_jobs(self, user_id) -> list[dict]:
+        with self._lock:
+            mine = sorted((t for t in self._running if t.user_id == user_id), key=lambda t: t.id)
+            for queue in self._queues:
+                mine.extend(queue.get(user_id, ()))
+        return [t.info() for t in mine]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "slots": self.slots,
+                "running": len(self._running),
+                "queued": {LANE_NAMES[i]: sum(len(q) for q in queue.values()) for i, queue in enumerate(self._queues)},
+                "completed": self.completed,
+                "cancelled": self.cancelled,
+                "rejected": self.rejected,
+            }
+
+
+# One scheduler per process; bot and webapp share it when run_all.py runs the
+# Web App in a bot thread (with --prod each process has its own)
+SCHEDULER = Scheduler()
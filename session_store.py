@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared shell-session store for the bot and the Web App.
+
+A shell session is {"cwd", "prev_cwd", "env"}, with env an EnvOverlay over
+os.environ. The store keeps it as a small record: the cwd values plus the
+overlay's diff ({"set": {...}, "unset": [...]}), so an untouched session costs
+a few bytes instead of a full dict(os.environ) copy.
+
+Backends (SESSION_STORE):
+  memory  - process-local dict (default). The bot and the Web App share it when
+            they run in one process (run_all.py without --prod).
+  sqlite  - SESSION_DB file. Survives /restart and is shared between the bot
+            and a separately supervised Web App process.
+
+Sessions are namespaced: "shell" is keyed by chat/user id and used by both
+front ends (a private chat's id is the user's id, so /sh and the Web App see
+the same cwd/env); "inline" holds inline-mode sessions.
+"""
+
+import abc
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from shared_utils import EnvOverlay
+
+
+SESSION_STORE = os.getenv("SESSION_STORE", "memory").strip().lower()
+SESSION_DB = os.getenv("SESSION_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "sessions.db"))
+
+
+# ==== Env diff ====
+def env_diff(env) -> dict:
+    """{"set": {k: v}, "unset": [k]} turning os.environ into env."""
+    if isinstance(env, EnvOverlay):
+        return env.diff()
+    base = os.environ
+    changed = {k: v for k, v in env.items() if base.get(k) != v}
+    removed = sorted(k for k in base if k not in env)
+    return {"set": changed, "unset": removed}
+
+
+# ==== Backends ====
+class SessionStore(abc.ABC):
+    """Record storage by (namespace, key). Records are JSON-serializable dicts."""
+
+    backend = "base"
+
+    @abc.abstractmethod
+    def load(self, namespace: str, key) -> dict | None:
+        ...
+
+    @abc.abstractmethod
+    def save(self, namespace: str, key, record: dict) -> None:
+        ...
+
+    @abc.abstractmethod
+    def delete(self, namespace: str, key) -> bool:
+        ...
+
+    @abc.abstractmethod
+    def count(self, namespace: str | None = None) -> int:
+        ...
+
+    def close(self) -> None:
+        pass
+
+    def stats(self) -> dict:
+        return {"backend": self.backend, "sessions": self.count()}
+
+
+class MemorySessionStore(SessionStore):
+    backend = "memory"
+
+    def __init__(self):
+        self._data: dict[tuple[str, str], str] = {}  # stored as JSON, like sqlite: no shared mutable state
+        self._lock = threading.Lock()
+
+    def load(self, namespace: str, key) -> dict | None:
+        with self._lock:
+            raw = self._data.get((namespace, str(key)))
+        return json.loads(raw) if raw is not None else None
+
+    def save(self, namespace: str, key, record: dict) -> None:
+        raw = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._data[(namespace, str(key))] = raw
+
+    def delete(self, namespace: str, key) -> bool:
+        with self._lock:
+            return self._data.pop((namespace, str(key)), None) is not None
+
+    def count(self, namespace: str | None = None) -> int:
+        with self._lock:
+            if namespace is None:
+                return len(self._data)
+            return sum(1 for ns, _ in self._data if ns == namespace)
+
+
+class SQLiteSessionStore(SessionStore):
+    backend = "sqlite"
+
+    def __init__(self, path: str = SESSION_DB):
+        self.path = path
+        self._lock = threading.Lock()
+        # One connection shared by threads (serialized by the lock). WAL lets the bot
+        # and the Web App process read and write the same file concurrently.
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " namespace TEXT NOT NULL, key TEXT NOT NULL, data TEXT NOT NULL, updated REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+
+    def load(self, namespace: str, key) -> dict | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM sessions WHERE namespace = ? AND key = ?", (namespace, str(key))
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, namespace: str, key, record: dict) -> None:
+        raw = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sessions (namespace, key, data, updated) VALUES (?, ?, ?, ?)"
+                " ON CONFLICT (namespace, key) DO UPDATE SET data = excluded.data, updated = excluded.updated",
+                (namespace, str(key), raw, time.time()),
+            )
+
+    def delete(self, namespace: str, key) -> bool:
+        with self._lock:
+            cur = self._conn.execute("DELETE FROM sessions WHERE namespace = ? AND key = ?", (namespace, str(key)))
+        return cur.rowcount > 0
+
+    def count(self, namespace: str | None = None) -> int:
+        with self._lock:
+            if namespace is None:
+                row = self._conn.execute("SELECT COUNT(*) FROM sessions").fetchone()
+            else:
+                row = self._conn.execute("SELECT COUNT(*) FROM sessions WHERE namespace = ?", (namespace,)).fetchone()
+        return row[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        return {**super().stats(), "path": self.path}
+
+
+def create_store_from_env() -> SessionStore:
+    """Backend from SESSION_STORE; falls back to memory if the SQLite file can't be opened."""
+    if SESSION_STORE == "sqlite":
+        try:
+            return SQLiteSessionStore(SESSION_DB)
+        except sqlite3.Error as e:
+            print(f"⚠️ SESSION_STORE=sqlite unavailable ({e}); using memory")
+    return MemorySessionStore()
+
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_store() -> SessionStore:
+    """Process-wide store, created on first use (the bot and Web App share it)."""
+    global _STORE
+    if _STORE is None:
+        with _STORE_LOCK:
+            if _STORE is None:
+                _STORE = create_store_from_env()
+    return _STORE
+
+
+# ==== Shell sessions ====
+class ShellSessions:
+    """
+    cwd/env sessions in one namespace of the store.
+
+    get() returns a plain session dict ({"cwd", "prev_cwd", "env"}) that callers
+    read and that handle_builtins may change; call save() after a change.
+    """
+
+    def __init__(self, namespace: str, store: SessionStore | None = None):
+        self.namespace = namespace
+        self._store = store
+
+    @property
+    def store(self) -> SessionStore:
+        return self._store or get_store()
+
+    def get(self, key) -> dict:
+        record = self.store.load(self.namespace, key)
+        if record is None:
+            return {"cwd": os.getcwd(), "prev_cwd": None, "env": EnvOverlay()}
+        cwd = record.get("cwd") or os.getcwd()
+        if not os.path.isdir(cwd):
+            cwd = os.getcwd()  # e.g. a temp dir gone after a restart
+        return {"cwd": cwd, "prev_cwd": record.get("prev_cwd"), "env": EnvOverlay.from_diff(record.get("env"))}
+
+    def save(self, key, sess: dict) -> None:
+        self.store.save(self.namespace, key, {
+            "cwd": sess.get("cwd"),
+            "prev_cwd": sess.get("prev_cwd"),
+            "env": env_diff(sess.get("env", {})),
+        })
+
+    def drop(self, key) -> bool:
+        """Forget the session (back to defaults). True if one existed."""
+        return self.store.delete(self.namespace, key)
+
+    def __contains__(self, key) -> bool:
+        return self.store.load(self.namespace, key) is not None
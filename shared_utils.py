@@ -9,14 +9,35 @@ bot.py and webapp_server.py to avoid code duplication.
 
 import os
 import re
+import sys
 import io
+import time
 import shlex
+import shutil
+import signal
+import select
+import selectors
+import bisect
+import ctypes
+import hashlib
+import functools
+import threading
+import contextvars
+import codecs
+import asyncio
+import contextlib
 import tempfile
 import textwrap
 import traceback
 import subprocess
-import contextlib
 import unicodedata
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
+
+try:
+    import fcntl
+except ImportError:  # Windows: Java cache entries are only pinned within this process
+    fcntl = None
 
 
 # ==== Default Owner ID ====
@@ -71,6 +92,120 @@ DEFAULT_ALLOWED_CMDS = parse_cmds_string(DEFAULT_ALLOWED_CMDS_STR)
 ALLOWED_CMDS_FILE = os.getenv("ALLOWED_CMDS_FILE", "allowed_cmds.txt")
 
 
+class CommandIndex:
+    """
+    Incrementally maintained search index over command names (inline suggestions).
+
+    - a sorted list of (lowercase, name) answers prefix queries with bisect
+    - postings of every 1..3-character n-gram answer substring queries:
+      queries up to 3 chars are a single lookup, longer ones intersect their
+      trigram postings and verify the candidates
+    - ranked results (prefix matches first, then other substring matches,
+      each alphabetically) are cached per query until the index changes,
+      so paging through next_offset is a slice
+    """
+
+    GRAM = 3
+
+    def __init__(self, cmds=(), cache_size: int = 128):
+        self._sorted: list[tuple[str, str]] = []
+        self._names: set[str] = set()
+        self._postings: dict[str, set[str]] = {}
+        self._results: OrderedDict[str, list[str]] = OrderedDict()
+        self._cache_size = cache_size
+        self.update(cmds)
+
+    def _grams(self, low: str) -> set[str]:
+        return {low[i:i + n] for n in range(1, self.GRAM + 1) for i in range(len(low) - n + 1)}
+
+    def add(self, cmd: str) -> None:
+        if not cmd or cmd in self._names:
+            return
+        low = cmd.lower()
+        self._names.add(cmd)
+        bisect.insort(self._sorted, (low, cmd))
+        for g in self._grams(low):
+            self._postings.setdefault(g, set()).add(cmd)
+        self._results.clear()
+
+    def discard(self, cmd: str) -> None:
+        if cmd not in self._names:
+            return
+        low = cmd.lower()
+        self._names.discard(cmd)
+        i = bisect.bisect_left(self._sorted, (low, cmd))
+        if i < len(self._sorted) and self._sorted[i] == (low, cmd):
+            del self._sorted[i]
+        for g in self._grams(low):
+            names = self._postings.get(g)
+            if names is not None:
+                names.discard(cmd)
+                if not names:
+                    del self._postings[g]
+        self._results.clear()
+
+    def update(self, cmds) -> None:
+        for c in cmds:
+            self.add(c)
+
+    def replace(self, cmds) -> None:
+        """Make the index hold exactly cmds (adds/removes only the difference)."""
+        new = set(cmds)
+        for c in self._names - new:
+            self.discard(c)
+        self.update(new - self._names)
+
+    def __contains__(self, cmd) -> bool:
+        return cmd in self._names
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def _prefix_matches(self, ql: str) -> list[str]:
+        i = bisect.bisect_left(self._sorted, (ql, ""))
+        out = []
+        while i < len(self._sorted) and self._sorted[i][0].startswith(ql):
+            out.append(self._sorted[i][1])
+            i += 1
+        return out
+
+    def _substring_candidates(self, ql: str) -> set[str]:
+        if len(ql) <= self.GRAM:
+            return set(self._postings.get(ql, ()))
+        grams = sorted((ql[i:i + self.GRAM] for i in range(len(ql) - self.GRAM + 1)),
+                       key=lambda g: len(self._postings.get(g, ())))
+        cands = set(self._postings.get(grams[0], ()))
+        for g in grams[1:]:
+            if not cands:
+                break
+            cands &= self._postings.get(g, set())
+        return {c for c in cands if ql in c.lower()}
+
+    def search(self, query: str) -> list[str]:
+        """All commands matching query (case-insensitive), prefix matches first."""
+        ql = (query or "").lower()
+        cached = self._results.get(ql)
+        if cached is not None:
+            self._results.move_to_end(ql)
+            return cached
+        if not ql:
+            result = [name for _low, name in self._sorted]
+        else:
+            prefix = self._prefix_matches(ql)
+            seen = set(prefix)
+            rest = sorted((c for c in self._substring_candidates(ql) if c not in seen), key=lambda c: (c.lower(), c))
+            result = prefix + rest
+        self._results[ql] = result
+        while len(self._results) > self._cache_size:
+            self._results.popitem(last=False)
+        return result
+
+    def page(self, query: str, offset: int, limit: int) -> tuple[list[str], int]:
+        """One page of search(query). Returns (items, total)."""
+        result = self.search(query)
+        return result[offset: offset + limit], len(result)
+
+
 def load_allowed_cmds() -> set:
     """
     Load allowed commands from environment variable and/or file.
@@ -149,6 +284,214 @@ def truncate(s: str, max_output: int = 10000) -> str:
     return s[:max_output] + f"\n\n…[truncated {len(s) - max_output} chars]"
 
 
+# ==== TTL Cache ====
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Dict-like store whose entries expire ttl seconds after they were set,
+    capped at maxsize entries (oldest evicted first).
+
+    Entries are kept in an OrderedDict in set order. Since every entry gets the
+    same ttl, that is also expiry order, so expiring and evicting only ever
+    pop from the front: set/get/pop/expire are all O(1) amortized.
+    """
+
+    def __init__(self, ttl: float, maxsize: int, clock=time.monotonic):
+        self.ttl = float(ttl)
+        self.maxsize = max(1, int(maxsize))
+        self._clock = clock
+        self._data: OrderedDict = OrderedDict()  # key -> (expires_at, value), oldest first
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def __setitem__(self, key, value) -> None:
+        with self._lock:
+            now = self._clock()
+            self._data[key] = (now + self.ttl, value)
+            self._data.move_to_end(key)
+            self._expire(now)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            if item[0] <= self._clock():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.hits += 1
+            return item[1]
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and item[0] > self._clock()
+
+    def touch(self, key) -> bool:
+        """Restart the ttl of a live entry. Returns False if it is missing or expired."""
+        with self._lock:
+            value = self.get(key, _MISSING)
+            if value is _MISSING:
+                return False
+            self[key] = value
+            return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or item[0] <= self._clock():
+                return default
+            return item[1]
+
+    def __delitem__(self, key) -> None:
+        with self._lock:
+            del self._data[key]
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._expire(self._clock())
+            return len(self._data)
+
+    def items(self) -> list:
+        """Snapshot of the live (key, value) pairs, oldest first."""
+        with self._lock:
+            self._expire(self._clock())
+            return [(k, v) for k, (_exp, v) in self._data.items()]
+
+    def keys(self) -> list:
+        return [k for k, _v in self.items()]
+
+    def values(self) -> list:
+        return [v for _k, v in self.items()]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def _expire(self, now: float) -> int:
+        removed = 0
+        while self._data:
+            key, (expires_at, _value) = next(iter(self._data.items()))
+            if expires_at > now:
+                break
+            del self._data[key]
+            removed += 1
+        self.expirations += removed
+        return removed
+
+    def prune(self) -> int:
+        """Drop expired entries now. Returns how many were removed."""
+        with self._lock:
+            return self._expire(self._clock())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+            }
+
+
+# ==== Environment overlay ====
+class EnvOverlay(MutableMapping):
+    """
+    Session environment as a layer over a base mapping (os.environ by default).
+
+    Writes go to a per-session set/unset layer; reads fall through to the base,
+    so a session costs only what it changed and follows later changes to the
+    base. materialize() builds the full dict, which is done only when a
+    process is spawned (see materialize_env).
+    """
+
+    __slots__ = ("base", "_set", "_unset")
+
+    def __init__(self, base: Mapping | None = None, overrides: dict | None = None, removed=None):
+        self.base = os.environ if base is None else base
+        self._set: dict[str, str] = dict(overrides or {})
+        self._unset: set[str] = {k for k in (removed or ()) if k not in self._set}
+
+    @classmethod
+    def from_diff(cls, diff: dict | None, base: Mapping | None = None) -> "EnvOverlay":
+        diff = diff or {}
+        return cls(base, diff.get("set"), diff.get("unset"))
+
+    def diff(self) -> dict:
+        """{"set": {...}, "unset": [...]} relative to the base (JSON-friendly)."""
+        return {"set": dict(self._set), "unset": sorted(k for k in self._unset if k in self.base)}
+
+    def __getitem__(self, key):
+        if key in self._set:
+            return self._set[key]
+        if key in self._unset:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __setitem__(self, key, value) -> None:
+        self._set[key] = value
+        self._unset.discard(key)
+
+    def __delitem__(self, key) -> None:
+        if key not in self:
+            raise KeyError(key)
+        self._set.pop(key, None)
+        if key in self.base:
+            self._unset.add(key)
+
+    def __contains__(self, key) -> bool:
+        if key in self._set:
+            return True
+        return key not in self._unset and key in self.base
+
+    def __iter__(self):
+        for key in list(self.base):
+            if key not in self._unset and key not in self._set:
+                yield key
+        yield from list(self._set)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def copy(self) -> "EnvOverlay":
+        return EnvOverlay(self.base, self._set, self._unset)
+
+    def materialize(self) -> dict:
+        env = {k: v for k, v in self.base.items() if k not in self._unset}
+        env.update(self._set)
+        return env
+
+    def __repr__(self) -> str:
+        return f"EnvOverlay(set={self._set!r}, unset={sorted(self._unset)!r})"
+
+
+def materialize_env(env):
+    """Plain dict for subprocess/exec (EnvOverlay is expanded; None and dicts pass through)."""
+    if isinstance(env, EnvOverlay):
+        return env.materialize()
+    return env
+
+
 # ==== Validation ====
 SAFE_PIP_NAME_RE = re.compile(r'^(?![.-])[a-zA-Z0-9_.-]+$')
 
@@ -158,28 +501,320 @@ def is_safe_pip_name(name: str) -> bool:
     return bool(SAFE_PIP_NAME_RE.match(name))
 
 
+# ==== Cancelling runs ====
+class RunCancelled(BaseException):
+    """Raised inside in-thread Python code whose run was cancelled (not an Exception, so
+    a bare `except Exception` in the snippet doesn't swallow it)."""
+
+
+class RunCanceller:
+    """
+    Stops a run whose work happens in threads (to_thread / executor), where
+    cancelling the awaiting task or request does not stop anything.
+
+    Executors wrap the part that can be stopped in on_cancel(fn): fn kills what
+    they started (process group, worker process, the thread's Python code).
+    cancel() calls every registered fn, and fns registered afterwards fire at
+    once. The canceller is found through a context variable (set with
+    cancellable()), which asyncio.to_thread and copy_context().run carry into
+    worker threads.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._kills: list = []
+        self.cancelled = False
+
+    @property
+    def active(self) -> int:
+        """Executors currently inside on_cancel()."""
+        with self._cond:
+            return len(self._kills)
+
+    def cancel(self) -> None:
+        with self._cond:
+            self.cancelled = True
+            kills = list(self._kills)
+        for fn in kills:
+            try:
+                fn()
+            except Exception:
+                pass
+
+    @contextlib.contextmanager
+    def on_cancel(self, fn):
+        with self._cond:
+            self._kills.append(fn)
+            fire = self.cancelled
+        if fire:
+            try:
+                fn()
+            except Exception:
+                pass
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._kills.remove(fn)
+                self._cond.notify_all()
+
+    def wait_idle(self, timeout: float) -> bool:
+        """Block until no executor is inside on_cancel(). False on timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._kills, timeout)
+
+    def finish(self, timeout: float) -> bool:
+        """Cancel whatever still runs (e.g. a thread left behind by a timeout) and wait for it to stop."""
+        if self.active:
+            self.cancel()
+        return self.wait_idle(timeout)
+
+
+_CURRENT_RUN: contextvars.ContextVar = contextvars.ContextVar("current_run", default=None)
+
+
+@contextlib.contextmanager
+def cancellable(canceller: RunCanceller):
+    """Make canceller the current run for code (and threads started with its context) in the block."""
+    token = _CURRENT_RUN.set(canceller)
+    try:
+        yield canceller
+    finally:
+        _CURRENT_RUN.reset(token)
+
+
+@contextlib.contextmanager
+def on_cancel(fn):
+    """fn() is called if the current run (if any) is cancelled while inside the block."""
+    canceller = _CURRENT_RUN.get()
+    if canceller is None:
+        yield
+        return
+    with canceller.on_cancel(fn):
+        yield
+
+
+class _ThreadInterrupt:
+    """Raises RunCancelled in the thread that created it, only while its code is still running."""
+
+    def __init__(self):
+        self.tid = threading.get_ident()
+        self._lock = threading.Lock()
+        self._running = True
+        self._sent = False
+
+    def interrupt(self) -> None:
+        with self._lock:
+            if self._running and not self._sent:
+                self._sent = True
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self.tid), ctypes.py_object(RunCancelled))
+
+    def done(self) -> None:
+        with self._lock:
+            self._running = False
+            if self._sent:
+                # Sent after the code returned and not raised yet: drop it
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self.tid), None)
+
+
 # ==== Code Execution ====
 def exec_python_in_context(src: str, ctx: dict) -> tuple[str, str, str | None]:
     """
     Execute Python code in a given context dict.
     Returns (stdout, stderr, traceback_text | None)
+    If the current run is cancelled, RunCancelled is raised inside the code (it
+    takes effect between bytecodes, so not during a long blocking C call).
     """
     ctx.setdefault("__builtins__", __builtins__)
     ctx.setdefault("__name__", "__main__")
-    
+
     stdout_buffer = io.StringIO()
     stderr_buffer = io.StringIO()
     tb_text = None
-    
+
+    _install_thread_streams()
+    _capture_target.out = stdout_buffer
+    _capture_target.err = stderr_buffer
+    interrupt = _ThreadInterrupt()
     try:
-        with contextlib.redirect_stdout(stdout_buffer), contextlib.redirect_stderr(stderr_buffer):
-            exec(src, ctx, ctx)
-    except Exception:
-        tb_text = traceback.format_exc()
-    
+        with on_cancel(interrupt.interrupt):
+            try:
+                exec(src, ctx, ctx)
+            except Exception:
+                tb_text = traceback.format_exc()
+            finally:
+                interrupt.done()
+    except RunCancelled:
+        tb_text = "RunCancelled: the run was cancelled\n"
+    finally:
+        _capture_target.out = None
+        _capture_target.err = None
+
     return stdout_buffer.getvalue(), stderr_buffer.getvalue(), tb_text
 
 
+# Per-thread capture: concurrent exec_python_in_context calls (bot chats handled in
+# parallel, webapp request threads) each get their own output instead of all
+# racing on a redirected global sys.stdout.
+_capture_target = threading.local()
+_streams_lock = threading.Lock()
+
+
+class _ThreadRoutedStream:
+    """sys.stdout/sys.stderr stand-in: writes go to the calling thread's capture buffer, if any."""
+
+    def __init__(self, attr: str, original):
+        self._attr = attr
+        self._original = original
+
+    def _target(self):
+        return getattr(_capture_target, self._attr, None) or self._original
+
+    def write(self, s):
+        return self._target().write(s)
+
+    def writelines(self, lines):
+        return self._target().writelines(lines)
+
+    def flush(self):
+        try:
+            return self._target().flush()
+        except Exception:
+            pass
+
+    def __getattr__(self, name):
+        return getattr(self._original, name)
+
+
+def _install_thread_streams() -> None:
+    if isinstance(sys.stdout, _ThreadRoutedStream) and isinstance(sys.stderr, _ThreadRoutedStream):
+        return
+    with _streams_lock:
+        if not isinstance(sys.stdout, _ThreadRoutedStream):
+            sys.stdout = _ThreadRoutedStream("out", sys.stdout)
+        if not isinstance(sys.stderr, _ThreadRoutedStream):
+            sys.stderr = _ThreadRoutedStream("err", sys.stderr)
+
+
+# ==== Bounded output capture ====
+CAPTURE_HEAD_BYTES = int(os.getenv("CAPTURE_HEAD_KB", "64")) * 1024
+CAPTURE_TAIL_BYTES = int(os.getenv("CAPTURE_TAIL_KB", "64")) * 1024
+# Kill the process once it has written this much (stdout + stderr); 0 = never
+CAPTURE_KILL_BYTES = int(float(os.getenv("CAPTURE_KILL_MB", "0")) * 1024 * 1024)
+
+
+class BoundedCapture:
+    """
+    Keeps the first head_bytes and the last tail_bytes of a byte stream and
+    counts what falls in between, so memory per stream never exceeds
+    head_bytes + tail_bytes however much the process writes.
+    """
+
+    def __init__(self, head_bytes: int = CAPTURE_HEAD_BYTES, tail_bytes: int = CAPTURE_TAIL_BYTES):
+        self.head_bytes = max(0, head_bytes)
+        self.tail_bytes = max(0, tail_bytes)
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def feed(self, chunk: bytes) -> None:
+        self.total += len(chunk)
+        room = self.head_bytes - len(self.head)
+        if room > 0:
+            self.head += chunk[:room]
+            chunk = chunk[room:]
+        if chunk and self.tail_bytes:
+            self.tail += chunk
+            if len(self.tail) > self.tail_bytes:
+                del self.tail[: len(self.tail) - self.tail_bytes]
+
+    @property
+    def dropped(self) -> int:
+        return self.total - len(self.head) - len(self.tail)
+
+    def text(self) -> str:
+        head = bytes(self.head).decode("utf-8", errors="replace")
+        if not self.tail:
+            return head
+        tail = bytes(self.tail)
+        if self.dropped:
+            # The cut may land inside a multi-byte character: skip its continuation bytes
+            i = 0
+            while i < 3 and i < len(tail) and 0x80 <= tail[i] < 0xC0:
+                i += 1
+            tail = tail[i:]
+            return head + f"\n…[{self.dropped} bytes dropped]…\n" + tail.decode("utf-8", errors="replace")
+        return head + tail.decode("utf-8", errors="replace")
+
+
+def over_budget_note(kill_bytes: int) -> str:
+    return f"\n[output limit of {kill_bytes} bytes exceeded – process killed]\n"
+
+
+def run_captured(argv: list, cwd: str, env: dict, timeout_sec: float, kill_bytes: int = CAPTURE_KILL_BYTES, on_start=None) -> subprocess.CompletedProcess:
+    """
+    subprocess.run(argv, capture_output=True, text=True, timeout=...) with a hard
+    memory ceiling: both pipes are read incrementally into BoundedCapture buffers.
+    The process gets its own process group; on timeout (or when it writes more
+    than kill_bytes) the whole group is killed. Raises subprocess.TimeoutExpired.
+    on_start(pid), if given, is called right after the process starts (e.g. to
+    let another thread cancel it with _kill_process_group).
+    """
+    proc = subprocess.Popen(
+        argv,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=cwd,
+        env=materialize_env(env),
+        start_new_session=True,
+    )
+    if on_start is not None:
+        on_start(proc.pid)
+    out, err = BoundedCapture(), BoundedCapture()
+    deadline = time.monotonic() + timeout_sec
+    over_budget = False
+    sel = selectors.DefaultSelector()
+    # /cancel of the run (see RunCanceller) kills the whole group
+    with on_cancel(functools.partial(_kill_process_group, proc.pid)):
+        try:
+            sel.register(proc.stdout, selectors.EVENT_READ, out)
+            sel.register(proc.stderr, selectors.EVENT_READ, err)
+            while sel.get_map():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                for key, _events in sel.select(remaining):
+                    chunk = os.read(key.fd, 65536)
+                    if not chunk:
+                        sel.unregister(key.fileobj)
+                        continue
+                    key.data.feed(chunk)
+                if kill_bytes and not over_budget and out.total + err.total > kill_bytes:
+                    over_budget = True
+                    _kill_process_group(proc.pid)
+            try:
+                if sel.get_map():
+                    # Deadline hit with a pipe still open (the process or a child of it still runs)
+                    raise subprocess.TimeoutExpired(argv, timeout_sec)
+                proc.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                _kill_process_group(proc.pid)
+                proc.wait()
+                raise subprocess.TimeoutExpired(argv, timeout_sec, out.text(), err.text())
+        finally:
+            sel.close()
+            if proc.poll() is None:
+                _kill_process_group(proc.pid)
+                proc.wait()
+            proc.stdout.close()
+            proc.stderr.close()
+    stderr_text = err.text()
+    if over_budget:
+        stderr_text += over_budget_note(kill_bytes)
+    return subprocess.CompletedProcess(argv, proc.returncode, out.text(), stderr_text)
+
+
 def run_js_blocking(src: str, cwd: str, env: dict, timeout_sec: int) -> subprocess.CompletedProcess:
     """Execute JS code via node on a temp file (blocking, for use in thread)."""
     tmp_path = None
@@ -187,14 +822,7 @@ def run_js_blocking(src: str, cwd: str, env: dict, timeout_sec: int) -> subproce
         with tempfile.NamedTemporaryFile("w", delete=False, suffix=".js", encoding="utf-8") as tf:
             tf.write(src)
             tmp_path = tf.name
-        return subprocess.run(
-            ["node", tmp_path],
-            capture_output=True,
-            text=True,
-            timeout=timeout_sec,
-            cwd=cwd,
-            env=env,
-        )
+        return run_captured(["node", tmp_path], cwd, env, timeout_sec)
     finally:
         try:
             if tmp_path and os.path.exists(tmp_path):
@@ -203,72 +831,388 @@ def run_js_blocking(src: str, cwd: str, env: dict, timeout_sec: int) -> subproce
             pass
 
 
-def run_java_blocking(src: str, cwd: str, env: dict, timeout_sec: int) -> subprocess.CompletedProcess:
+# ==== Java class cache ====
+JAVA_CACHE_DIR = os.getenv("JAVA_CACHE_DIR", os.path.join(tempfile.gettempdir(), "java_class_cache"))
+JAVA_CACHE_MAX_BYTES = int(float(os.getenv("JAVA_CACHE_MAX_MB", "64")) * 1024 * 1024)
+
+
+def _dir_size(path: str) -> int:
+    total = 0
+    for root, _dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class JavaClassCache:
     """
-    Execute Java code via javac+java on a temp file (blocking, for use in thread).
-    Finds public class name in code to determine filename, defaults to Main.
+    Content-addressed cache of compiled Java classes.
+    sha256(normalized source, classpath) -> directory with the .class files, evicted LRU by total size.
+    The directory lives on disk, so bot.py and webapp_server.py (even as separate
+    processes) share compiled classes.
+
+    An entry in use holds a shared flock on <key>.lock; eviction takes it
+    exclusively (non-blocking) before removing the directory, so one process
+    never deletes classes another process is running.
     """
-    tmp_dir = None
+
+    def __init__(self, root: str = JAVA_CACHE_DIR, max_bytes: int = JAVA_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict[str, int] = OrderedDict()  # key -> size, oldest first
+        self._in_use: dict[str, list] = {}  # key -> open lock fds, one per user
+        self._lock = threading.Lock()
+        self._loaded = False
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key_for(src: str, classpath: str = "") -> str:
+        """
+        Hash of the source with trailing whitespace and blank edges removed, and
+        of the classpath it is compiled against (the same source may resolve
+        to different classes after `export CLASSPATH=...`).
+        """
+        lines = [ln.rstrip() for ln in normalize_code(src).strip().split("\n")]
+        h = hashlib.sha256("\n".join(lines).encode("utf-8"))
+        if classpath:
+            h.update(b"\0classpath=" + classpath.encode("utf-8", errors="replace"))
+        return h.hexdigest()
+
+    def _load(self) -> None:
+        """Index entries left on disk by earlier runs (oldest mtime first)."""
+        if self._loaded:
+            return
+        self._loaded = True
+        os.makedirs(self.root, exist_ok=True)
+        found = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if len(name) == 64 and os.path.isdir(path):
+                found.append((os.path.getmtime(path), name, _dir_size(path)))
+        for _mtime, name, size in sorted(found):
+            self._entries[name] = size
+
+    def _lock_shared(self, key: str) -> int | None:
+        """
+        Open key's lock file and take a shared flock on it. Called without
+        _lock: flock blocks while another process evicts the entry, and that
+        must not hold up lookups of other keys.
+        """
+        if fcntl is None:
+            return None
+        os.makedirs(self.root, exist_ok=True)
+        lock_path = os.path.join(self.root, key + ".lock")
+        while True:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+                    return fd
+            except OSError:
+                pass
+            os.close(fd)  # evicted (and unlinked) while we waited; lock the new file
+
+    def _pin(self, key: str, fd: int | None) -> None:
+        """Record fd (from _lock_shared) as one user of key (caller holds _lock)."""
+        self._in_use.setdefault(key, []).append(fd)
+
+    def _unpin(self, key: str) -> None:
+        fds = self._in_use.get(key)
+        if not fds:
+            return
+        fd = fds.pop()
+        if not fds:
+            del self._in_use[key]
+        if fd is not None:
+            os.close(fd)
+
+    def get(self, key: str) -> str | None:
+        """Return the class directory for key and mark it in use, or None on a miss."""
+        path = os.path.join(self.root, key)
+        with self._lock:
+            self._load()
+            known = key in self._entries
+            if not known:
+                self.misses += 1
+                return None
+        fd = self._lock_shared(key)
+        with self._lock:
+            self._pin(key, fd)
+            if key in self._entries and os.path.isdir(path):  # pinned: no process can evict it now
+                self._entries.move_to_end(key)
+                self.hits += 1
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+                return path
+            self._unpin(key)
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def put(self, key: str, build_dir: str) -> str:
+        """Move a freshly compiled build_dir into the cache and mark it in use."""
+        path = os.path.join(self.root, key)
+        fd = self._lock_shared(key)
+        with self._lock:
+            self._load()
+            self._pin(key, fd)
+            try:
+                os.rename(build_dir, path)
+            except OSError:
+                # Another thread/process cached the same source first
+                shutil.rmtree(build_dir, ignore_errors=True)
+            self._entries[key] = _dir_size(path)
+            self._entries.move_to_end(key)
+            self._evict()
+        return path
+
+    def release(self, key: str) -> None:
+        with self._lock:
+            self._unpin(key)
+
+    def _evict(self) -> None:
+        total = sum(self._entries.values())
+        for key in list(self._entries.keys()):
+            if total <= self.max_bytes:
+                break
+            if self._in_use.get(key) or not self._remove(key):
+                continue
+            total -= self._entries.pop(key)
+
+    def _remove(self, key: str) -> bool:
+        """Delete key's classes unless some process has them pinned."""
+        path = os.path.join(self.root, key)
+        if fcntl is None:
+            shutil.rmtree(path, ignore_errors=True)
+            return True
+        lock_path = path + ".lock"
+        try:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False  # running in another process
+        try:
+            shutil.rmtree(path, ignore_errors=True)
+            with contextlib.suppress(OSError):
+                os.unlink(lock_path)
+        finally:
+            os.close(fd)
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+JAVA_CLASS_CACHE = JavaClassCache()
+
+
+def java_class_name(src: str) -> str:
+    """Find public class name in code to determine filename, defaults to Main."""
     try:
-        # Create temp directory for compilation
-        tmp_dir = tempfile.mkdtemp()
-        
-        # Find public class name
-        class_name = "Main"
+        match = re.search(r'public\s+(?:final\s+|abstract\s+|static\s+)*class\s+(\w+)', src)
+        if match:
+            return match.group(1)
+    except Exception:
+        pass
+    return "Main"
+
+
+def java_classpath(cwd: str, env: dict | None) -> str:
+    """The session's CLASSPATH with relative entries resolved against cwd ("" if unset)."""
+    raw = (env or {}).get("CLASSPATH") or ""
+    entries = [os.path.normpath(os.path.join(cwd, e)) if e else cwd for e in raw.split(os.pathsep)] if raw else []
+    return os.pathsep.join(entries)
+
+
+def run_java_blocking(src: str, cwd: str, env: dict, timeout_sec: int) -> subprocess.CompletedProcess:
+    """
+    Execute Java code via javac+java (blocking, for use in thread).
+    Compiled classes are cached by source hash (JAVA_CLASS_CACHE), so rerunning
+    an unchanged snippet skips javac and only starts java.
+    """
+    class_name = java_class_name(src)
+    user_classpath = java_classpath(cwd, env)
+    key = JAVA_CLASS_CACHE.key_for(src, user_classpath)
+    class_dir = JAVA_CLASS_CACHE.get(key)
+    if class_dir is None:
+        # Compile in a temp dir next to the cache so the final move is an atomic rename
+        os.makedirs(JAVA_CLASS_CACHE.root, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix="build-", dir=JAVA_CLASS_CACHE.root)
         try:
-            match = re.search(r'public\s+(?:final\s+|abstract\s+|static\s+)*class\s+(\w+)', src)
-            if match:
-                class_name = match.group(1)
-        except Exception:
-            pass
-        
-        # Write code to file
-        java_file = os.path.join(tmp_dir, f"{class_name}.java")
-        with open(java_file, "w", encoding="utf-8") as f:
-            f.write(src)
-        
-        # Compile
-        compile_proc = subprocess.run(
-            ["javac", java_file],
-            capture_output=True,
-            text=True,
-            timeout=timeout_sec,
-            cwd=tmp_dir,
-            env=env,
-        )
-        
+            java_file = os.path.join(tmp_dir, f"{class_name}.java")
+            with open(java_file, "w", encoding="utf-8") as f:
+                f.write(src)
+            javac = ["javac", "-cp", user_classpath, java_file] if user_classpath else ["javac", java_file]
+            compile_proc = run_captured(javac, tmp_dir, env, timeout_sec)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
         if compile_proc.returncode != 0:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
             return compile_proc
-        
-        # Run
-        return subprocess.run(
-            ["java", class_name],
-            capture_output=True,
-            text=True,
-            timeout=timeout_sec,
-            cwd=tmp_dir,
-            env=env,
-        )
+        class_dir = JAVA_CLASS_CACHE.put(key, tmp_dir)
+
+    classpath = class_dir
+    if user_classpath:
+        classpath += os.pathsep + user_classpath
+    try:
+        return run_captured(["java", "-cp", classpath, class_name], cwd, env, timeout_sec)
     finally:
-        # Clean up temp files
+        JAVA_CLASS_CACHE.release(key)
+
+
+# Longest worker reply line: the bounded stdout and stderr, escaped (JSON/base64), plus framing
+PIPE_LINE_MAX = 16 * (CAPTURE_HEAD_BYTES + CAPTURE_TAIL_BYTES) + 65536
+
+
+class PipeLineReader:
+    """Reads newline-terminated records from a raw pipe fd with a deadline (for worker protocols)."""
+
+    def __init__(self, fd: int, max_line: int = PIPE_LINE_MAX):
+        self.fd = fd
+        self.max_line = max_line
+        self._buf = bytearray()
+
+    def readline(self, deadline: float) -> bytes | None:
+        """
+        Return one line without the newline; None on timeout, b'' on EOF.
+        Raises ValueError if a line grows beyond max_line (the worker is broken).
+        """
+        while True:
+            nl = self._buf.find(b"\n")
+            if nl >= 0:
+                line = bytes(self._buf[:nl])
+                del self._buf[: nl + 1]
+                return line
+            if len(self._buf) > self.max_line:
+                self._buf.clear()
+                raise ValueError(f"worker reply line longer than {self.max_line} bytes")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if not readable:
+                return None
+            chunk = os.read(self.fd, 65536)
+            if not chunk:
+                return b""
+            self._buf.extend(chunk)
+
+
+def run_shell_blocking(shell_exec: str, cmd: str, cwd: str, env: dict, timeout_sec: int, on_start=None) -> subprocess.CompletedProcess:
+    """Execute shell command (blocking, for use in thread). Output is bounded (see run_captured)."""
+    return run_captured([shell_exec, "-c", cmd], cwd, env, timeout_sec, on_start=on_start)
+
+
+def _kill_process_group(pid: int) -> None:
+    """Kill a whole process group started with start_new_session=True."""
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+    except Exception:
         try:
-            if tmp_dir and os.path.exists(tmp_dir):
-                import shutil
-                shutil.rmtree(tmp_dir)
+            os.kill(pid, signal.SIGKILL)
         except Exception:
             pass
 
 
-def run_shell_blocking(shell_exec: str, cmd: str, cwd: str, env: dict, timeout_sec: int) -> subprocess.CompletedProcess:
-    """Execute shell command (blocking, for use in thread)."""
-    return subprocess.run(
-        [shell_exec, "-c", cmd],
-        capture_output=True,
-        text=True,
-        timeout=timeout_sec,
+async def stream_shell_async(
+    shell_exec: str,
+    cmd: str,
+    cwd: str,
+    env: dict,
+    timeout_sec: int,
+    on_output=None,
+) -> subprocess.CompletedProcess:
+    """
+    Execute shell command on the event loop, reading stdout/stderr incrementally.
+    on_output(text, is_stderr) is called for every decoded chunk as it arrives.
+    The returned output is bounded like run_captured (head + tail, optional
+    CAPTURE_KILL_BYTES budget).
+    The command runs in its own process group; on timeout or cancellation the
+    whole group is killed. Raises subprocess.TimeoutExpired on timeout.
+    """
+    argv = [shell_exec, "-c", cmd]
+    proc = await asyncio.create_subprocess_exec(
+        *argv,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
         cwd=cwd,
-        env=env,
+        env=materialize_env(env),
+        start_new_session=True,
+    )
+    out, err = BoundedCapture(), BoundedCapture()
+    over_budget = False
+
+    async def _pump(stream, capture: BoundedCapture, is_stderr: bool) -> None:
+        nonlocal over_budget
+        # Incremental decoder so multi-byte chars split across reads stay intact
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace") if on_output is not None else None
+        while True:
+            chunk = await stream.read(4096)
+            capture.feed(chunk)
+            if decoder is not None:
+                text = decoder.decode(chunk, final=not chunk)
+                if text:
+                    on_output(text, is_stderr)
+            if not chunk:
+                break
+            if CAPTURE_KILL_BYTES and not over_budget and out.total + err.total > CAPTURE_KILL_BYTES:
+                over_budget = True
+                _kill_process_group(proc.pid)
+
+    gathered = asyncio.gather(
+        _pump(proc.stdout, out, False),
+        _pump(proc.stderr, err, True),
+        proc.wait(),
     )
+    # On cancellation the gather ends with CancelledError nobody awaits; mark it retrieved
+    gathered.add_done_callback(lambda f: f.cancelled() or f.exception())
+    try:
+        await asyncio.wait_for(gathered, timeout=timeout_sec)
+    except asyncio.TimeoutError:
+        _kill_process_group(proc.pid)
+        await proc.wait()
+        raise subprocess.TimeoutExpired(argv, timeout_sec, out.text(), err.text())
+    except asyncio.CancelledError:
+        _kill_process_group(proc.pid)
+        # Reap the killed process before propagating (no zombie, transport closed);
+        # shielded so a second cancel can't abandon it, bounded in case it is stuck in D state
+        with contextlib.suppress(asyncio.TimeoutError, asyncio.CancelledError):
+            await asyncio.wait_for(asyncio.shield(proc.wait()), timeout=5)
+        raise
+    stderr_text = err.text()
+    if over_budget:
+        stderr_text += over_budget_note(CAPTURE_KILL_BYTES)
+    return subprocess.CompletedProcess(argv, proc.returncode, out.text(), stderr_text)
+
+
+async def run_shell_async(shell_exec: str, cmd: str, cwd: str, env: dict, timeout_sec: int) -> subprocess.CompletedProcess:
+    """
+    Execute shell command on the event loop without blocking it.
+    The command runs in its own process group; on timeout or cancellation the
+    whole group is killed (so `sleep 50 &` children die too).
+    Raises subprocess.TimeoutExpired on timeout, like run_shell_blocking.
+    """
+    return await stream_shell_async(shell_exec, cmd, cwd, env, timeout_sec)
 
 
 # ==== Shell Builtins ====
@@ -291,7 +1235,7 @@ def handle_builtins(sess: dict, cmdline: str) -> str | None:
     Only handles simple commands (no ;, &&, ||, |, or newlines).
     Returns response string if handled, None otherwise.
     
-    Session dict should have 'cwd', 'env', and optionally 'prev_cwd' keys.
+    Session dict should have 'cwd', 'env' (dict or EnvOverlay), and optionally 'prev_cwd' keys.
     """
     # Don't handle compound commands - let shell process them
     if any(x in cmdline for x in (";", "&&", "||", "|", "\n")):
@@ -0,0 +1,70 @@
+import os
+import shutil
+
+import pytest
+
+import js_worker
+from js_worker import NodeWorkerPool
+from shared_utils import BoundedCapture
+
+pytestmark = pytest.mark.skipif(shutil.which("node") is None, reason="node is not installed")
+
+
+@pytest.fixture
+def pool():
+    p = NodeWorkerPool(max_workers=2, idle_ttl=60)
+    yield p
+    p.shutdown()
+
+
+def run(pool, src, key=1):
+    return pool.run(key, src, os.getcwd(), dict(os.environ), 10)
+
+
+def test_rerunning_a_snippet_with_declarations(pool):
+    src = "const x = 5; let y = x + 1; class A { get v() { return y; } }\nconsole.log(x, new A().v)"
+    for _ in range(2):
+        res = run(pool, src)
+        assert (res.returncode, res.stdout, res.stderr) == (0, "5 6\n", "")
+
+
+def test_declarations_persist_between_runs(pool):
+    run(pool, "const greeting = `hi ${ {name: 'bob'}.name }`; class Counter { constructor() { this.n = 1; } }")
+    res = run(pool, "console.log(greeting, new Counter().n)")
+    assert (res.returncode, res.stdout) == (0, "hi bob 1\n")
+    assert run(pool, "console.log(typeof greeting)", key=2).stdout == "undefined\n"
+
+
+def test_nested_and_literal_declarations_are_left_alone(pool):
+    src = (
+        "const re = /const [}]/g; const s = 'let a = 1';\n"
+        "function f() { const inner = 2; return inner; }\n"
+        "for (let i = 0; i < 2; i++) { const q = i; }\n"
+        "console.log(f(), re.test('const }'), s, typeof inner, typeof q)"
+    )
+    for _ in range(2):
+        res = run(pool, src)
+        assert (res.returncode, res.stdout) == (0, "2 true let a = 1 undefined undefined\n")
+
+
+def test_output_is_bounded_like_bounded_capture(pool, monkeypatch):
+    monkeypatch.setattr(js_worker, "CAPTURE_HEAD_BYTES", 100)
+    monkeypatch.setattr(js_worker, "CAPTURE_TAIL_BYTES", 50)
+    res = run(pool, "for (let i = 0; i < 1000; i++) console.log('line ' + i + ' é')")
+    expected = BoundedCapture(100, 50)
+    expected.feed("".join(f"line {i} é\n" for i in range(1000)).encode("utf-8"))
+    assert (res.returncode, res.stdout) == (0, expected.text())
+    assert "bytes dropped" in res.stdout
+
+
+def test_output_over_kill_budget_kills_the_worker(pool, monkeypatch):
+    monkeypatch.setattr(js_worker, "CAPTURE_HEAD_BYTES", 64)
+    monkeypatch.setattr(js_worker, "CAPTURE_TAIL_BYTES", 64)
+    monkeypatch.setattr(js_worker, "CAPTURE_KILL_BYTES", 100000)
+    res = run(pool, "globalThis.kept = 1; while (true) console.log('x'.repeat(100))")
+    assert res.returncode == -9
+    assert "output limit" in res.stderr
+    assert len(res.stdout) < 300
+    # The next run gets a fresh worker
+    res = run(pool, "console.log(typeof kept)")
+    assert (res.returncode, res.stdout) == (0, "undefined\n")
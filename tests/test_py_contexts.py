@@ -0,0 +1,95 @@
+import threading
+import time
+
+import py_contexts
+from py_contexts import PythonContexts, deep_sizeof
+
+
+def test_deep_sizeof_counts_nested_values_once():
+    shared = list(range(1000))
+    small = deep_sizeof({"a": 1})
+    one = deep_sizeof({"a": shared})
+    assert one > small
+    assert deep_sizeof({"a": shared, "b": shared}) == one
+    assert deep_sizeof({"a": [shared, {"k": shared}]}) > one
+
+
+def test_use_creates_and_keeps_a_namespace():
+    contexts = PythonContexts(idle_ttl=0, max_mb=0)
+    with contexts.use(1) as ns:
+        ns["x"] = 1
+    assert contexts.get(1)["x"] == 1
+    assert 1 in contexts and 2 not in contexts
+    assert contexts.get(2) is None
+    assert contexts.pop(1)["x"] == 1
+    assert 1 not in contexts
+
+
+def test_idle_namespaces_are_evicted_on_access():
+    contexts = PythonContexts(idle_ttl=60, max_mb=0)
+    with contexts.use(1) as ns:
+        ns["x"] = 1
+    contexts._last_used[1] -= 120
+    contexts.get(2)
+    assert 1 not in contexts
+    assert contexts.evictions == 1
+
+
+def test_budget_evicts_least_recently_used_idle_namespace():
+    contexts = PythonContexts(idle_ttl=0, max_mb=1)
+    for key in (1, 2):
+        with contexts.use(key) as ns:
+            ns["blob"] = bytearray(400 * 1024)
+    with contexts.use(3) as ns:
+        ns["blob"] = bytearray(400 * 1024)
+    assert 1 not in contexts
+    assert 2 in contexts and 3 in contexts
+
+
+def test_spilled_namespace_is_restored(tmp_path):
+    contexts = PythonContexts(idle_ttl=0, max_mb=0, spill_dir=str(tmp_path))
+    with contexts.use(1) as ns:
+        exec("import json\nx = [1, 2]\ngen = (i for i in range(3))", ns)
+    assert contexts.evict(1)
+    assert 1 in contexts and len(contexts) == 0
+    ns = contexts.get(1)
+    assert ns["x"] == [1, 2]
+    assert ns["json"].dumps(ns["x"]) == "[1, 2]"
+    assert "gen" not in ns  # can't be pickled: dropped
+    assert (contexts.spills, contexts.restores, contexts.dropped_names) == (1, 1, 1)
+    assert not list(tmp_path.iterdir())
+
+
+def test_restore_runs_outside_the_lock(tmp_path, monkeypatch):
+    contexts = PythonContexts(idle_ttl=0, max_mb=0, spill_dir=str(tmp_path))
+    with contexts.use(1) as ns:
+        ns["x"] = 1
+    with contexts.use(2) as ns:
+        ns["y"] = 2
+    contexts.evict(1)
+
+    reading = threading.Event()
+    release = threading.Event()
+    real_load = py_contexts._pickle.load
+
+    def slow_load(fh):
+        reading.set()
+        release.wait(5)
+        return real_load(fh)
+
+    monkeypatch.setattr(py_contexts._pickle, "load", slow_load)
+    results = {}
+    readers = [threading.Thread(target=lambda i=i: results.setdefault(i, contexts.get(1))) for i in range(2)]
+    for t in readers:
+        t.start()
+    assert reading.wait(5)
+    # Other keys are served while key 1 is being read back
+    started = time.monotonic()
+    assert contexts.get(2)["y"] == 2
+    assert time.monotonic() - started < 1
+    release.set()
+    for t in readers:
+        t.join(5)
+    assert results[0] is results[1]
+    assert results[0]["x"] == 1
+    assert contexts.restores == 1
@@ -0,0 +1,49 @@
+import pytest
+
+from py_pool import PythonWorkerPool
+
+
+@pytest.fixture
+def pool():
+    p = PythonWorkerPool(max_workers=2, idle_ttl=60, max_mb=0)
+    yield p
+    p.shutdown()
+
+
+def test_execute_keeps_state_per_key(pool):
+    assert pool.execute(1, "x = 21\n", 10) == ("", "", None)
+    assert pool.execute(1, "x * 2\n", 10, eval_last=True) == ("42", "", None)
+    out, _err, tb_text = pool.execute(2, "x\n", 10)
+    assert out == "" and "NameError" in tb_text
+
+
+def test_call_returns_the_result_text(pool):
+    pool.execute(1, "def double(n):\n    print('doubling')\n    return n * 2\n", 10)
+    assert pool.call(1, "double", [4], 10) == ("doubling\n", "", None, "8")
+    assert pool.call(1, "missing", [], 10) == ("", "", None, None)
+
+
+def test_call_error_reply_has_the_call_shape(pool):
+    src = (
+        "class Bad:\n"
+        "    def __str__(self):\n"
+        "        raise RuntimeError('no text')\n"
+        "def make():\n"
+        "    return Bad()\n"
+    )
+    pool.execute(1, src, 10)
+    out, err, tb_text, result_text = pool.call(1, "make", [], 10)
+    assert (out, err, result_text) == ("", "", "")
+    assert tb_text == "RuntimeError: no text\n"
+    # The worker survives and keeps the namespace
+    assert pool.call(1, "make", [], 10)[2] == "RuntimeError: no text\n"
+    assert pool.stats()["restarts"] == 0
+
+
+def test_timeout_only_resets_that_key(pool):
+    pool.execute(1, "kept = 1\n", 10)
+    pool.execute(2, "lost = 1\n", 10)
+    with pytest.raises(TimeoutError):
+        pool.execute(2, "while True: pass\n", 0.5)
+    assert pool.execute(1, "kept\n", 10, eval_last=True) == ("1", "", None)
+    assert "NameError" in pool.execute(2, "lost\n", 10)[2]
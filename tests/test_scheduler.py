@@ -0,0 +1,122 @@
+import asyncio
+import threading
+
+import pytest
+
+from scheduler import (
+    LANE_HEAVY, LANE_INTERACTIVE, LANE_NORMAL, JobCancelled, QueueFull, Scheduler, classify,
+)
+
+
+def test_classify():
+    assert classify("sh", "ls -la") == LANE_INTERACTIVE
+    assert classify("sh", "/bin/cat a.txt") == LANE_INTERACTIVE
+    assert classify("sh", "ls | sort") == LANE_NORMAL
+    assert classify("sh", "pip install requests") == LANE_HEAVY
+    assert classify("sh", "python x.py") == LANE_NORMAL
+    assert classify("sh", "echo 'unterminated") == LANE_INTERACTIVE
+    assert classify("py", "print(1)") == LANE_NORMAL
+    assert classify("java", "class A {}") == LANE_HEAVY
+
+
+def test_per_user_limit_and_round_robin():
+    s = Scheduler(slots=4, interactive_reserved=0, per_user=1)
+    a1, a2, a3 = (s.submit("a") for _ in range(3))
+    b1 = s.submit("b")
+    assert a1.granted and b1.granted and not a2.granted
+    assert a2.position() == 1 and a3.position() == 2
+    a1.release()
+    assert a2.granted and a1.state == "done"
+    assert s.stats()["completed"] == 1
+
+
+def test_interactive_slots_are_reserved():
+    s = Scheduler(slots=2, interactive_reserved=1, per_user=5, heavy_max=5)
+    heavy = s.submit("a", LANE_HEAVY)
+    normal = s.submit("b", LANE_NORMAL)
+    quick = s.submit("c", LANE_INTERACTIVE)
+    assert heavy.granted and not normal.granted and quick.granted
+
+
+def test_lower_lane_first_and_heavy_aging():
+    s = Scheduler(slots=1, interactive_reserved=0, per_user=5, aging_sec=30)
+    first = s.submit("x", LANE_NORMAL)
+    heavy = s.submit("a", LANE_HEAVY)
+    normal = s.submit("b", LANE_NORMAL)
+    first.release()
+    assert normal.granted and not heavy.granted
+    s.submit("c", LANE_NORMAL)
+    heavy.created -= 60  # waited longer than aging_sec: goes before normal
+    normal.release()
+    assert heavy.granted
+
+
+def test_queue_full():
+    s = Scheduler(slots=1, interactive_reserved=0, max_queued_per_user=2)
+    s.submit("a")
+    s.submit("a")
+    s.submit("a")
+    with pytest.raises(QueueFull):
+        s.submit("a")
+    assert s.stats()["rejected"] == 1
+
+
+def test_cancel_queued_and_running():
+    s = Scheduler(slots=1, interactive_reserved=0)
+    running = s.submit("a")
+    queued = s.submit("a")
+    assert queued.cancel() is True
+    with pytest.raises(JobCancelled):
+        queued.wait(0)
+
+    hooked = []
+    running.set_cancel_hook(lambda: hooked.append(1))
+    assert s.cancel_user("a") == 1
+    assert hooked == [1] and running.cancelled
+    follow = s.submit("a")
+    assert not follow.granted  # the slot is held until release()
+    running.release()
+    assert follow.granted
+    assert running.cancel() is False
+
+
+def test_hook_set_after_cancel_fires_immediately():
+    s = Scheduler(slots=1)
+    t = s.submit("a")
+    t.cancel()
+    fired = []
+    t.set_cancel_hook(lambda: fired.append(1))
+    assert fired == [1]
+
+
+def test_wait_from_another_thread():
+    s = Scheduler(slots=1, interactive_reserved=0)
+    first = s.submit("a")
+    second = s.submit("b")
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(second.wait(5)))
+    waiter.start()
+    first.release()
+    waiter.join(5)
+    assert got == [True]
+
+
+def test_wait_async_and_task_cancel():
+    s = Scheduler(slots=1, interactive_reserved=0)
+
+    async def main():
+        first = s.submit("a")
+        second = s.submit("b")
+        third = s.submit("c")
+        waiting = asyncio.create_task(third.wait_async())
+        granted = asyncio.create_task(second.wait_async())
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert third.cancelled
+        first.release()
+        await asyncio.wait_for(granted, 5)
+        assert second.granted
+
+    asyncio.run(main())
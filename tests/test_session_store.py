@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from session_store import MemorySessionStore, SessionStore, ShellSessions, SQLiteSessionStore, env_diff
+from shared_utils import EnvOverlay
+
+
+def test_incomplete_backend_cannot_be_instantiated():
+    class Partial(SessionStore):
+        def load(self, namespace, key):
+            return None
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    s = MemorySessionStore() if request.param == "memory" else SQLiteSessionStore(str(tmp_path / "sessions.db"))
+    yield s
+    s.close()
+
+
+def test_round_trip_delete_and_count(store):
+    assert store.load("shell", 1) is None
+    store.save("shell", 1, {"cwd": "/tmp", "env": {"set": {"A": "1"}, "unset": []}})
+    store.save("inline", 1, {"cwd": "/"})
+    assert store.load("shell", "1") == {"cwd": "/tmp", "env": {"set": {"A": "1"}, "unset": []}}
+    assert store.count() == 2 and store.count("shell") == 1
+    assert store.delete("shell", 1) is True
+    assert store.delete("shell", 1) is False
+    assert store.load("shell", 1) is None
+    assert store.stats()["sessions"] == 1
+
+
+def test_loaded_record_is_a_copy(store):
+    store.save("shell", 1, {"cwd": "/tmp"})
+    store.load("shell", 1)["cwd"] = "/"
+    assert store.load("shell", 1) == {"cwd": "/tmp"}
+
+
+def test_shell_sessions_keep_cwd_and_env_diff(tmp_path):
+    sessions = ShellSessions("shell", MemorySessionStore())
+    sess = sessions.get(7)
+    assert sess["cwd"] == os.getcwd() and isinstance(sess["env"], EnvOverlay)
+    assert 7 not in sessions
+
+    sess["cwd"], sess["prev_cwd"] = str(tmp_path), os.getcwd()
+    sess["env"]["SESSION_STORE_TEST"] = "yes"
+    sessions.save(7, sess)
+    assert 7 in sessions
+    again = sessions.get(7)
+    assert again["cwd"] == str(tmp_path) and again["prev_cwd"] == os.getcwd()
+    assert again["env"]["SESSION_STORE_TEST"] == "yes"
+
+    assert sessions.drop(7) is True
+    assert sessions.get(7)["cwd"] == os.getcwd()
+
+
+def test_shell_sessions_fall_back_when_cwd_is_gone(tmp_path):
+    store = MemorySessionStore()
+    store.save("shell", 1, {"cwd": str(tmp_path / "gone"), "prev_cwd": None, "env": None})
+    assert ShellSessions("shell", store).get(1)["cwd"] == os.getcwd()
+
+
+def test_env_diff_of_plain_dict(monkeypatch):
+    monkeypatch.setenv("SESSION_STORE_KEEP", "1")
+    monkeypatch.setenv("SESSION_STORE_DROP", "1")
+    env = dict(os.environ)
+    env["SESSION_STORE_KEEP"] = "2"
+    env["SESSION_STORE_NEW"] = "3"
+    del env["SESSION_STORE_DROP"]
+    assert env_diff(env) == {"set": {"SESSION_STORE_KEEP": "2", "SESSION_STORE_NEW": "3"}, "unset": ["SESSION_STORE_DROP"]}
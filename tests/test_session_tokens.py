@@ -0,0 +1,46 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip("flask")
+os.environ.setdefault("BOT_TOKEN", "123456:test-token")
+os.environ.setdefault("PY_WORKERS", "0")
+
+import webapp_server as core  # noqa: E402
+
+
+def test_issued_token_verifies():
+    token, expires_at = core.issue_session_token(1001, {"id": 1001, "first_name": "A"})
+    assert expires_at > time.time()
+    assert core.verify_session_token(token) == 1001
+    assert core.resolve_user("", token) == (1001, {"id": 1001, "first_name": "A"}, "token")
+
+
+def test_tampered_or_malformed_tokens_are_rejected():
+    token, _ = core.issue_session_token(1002)
+    body, sig = token.rsplit(".", 1)
+    other = body.replace("1002.", "1003.", 1)
+    for bad in (f"{other}.{sig}", f"{body}.{sig[:-1]}", "", "garbage", "1.2.3", None):
+        assert core.verify_session_token(bad) is None
+
+
+def test_non_ascii_signature_is_rejected_not_an_error():
+    token, _ = core.issue_session_token(1004)
+    body = token.rsplit(".", 1)[0]
+    assert core.verify_session_token(f"{body}.סיסמה") is None
+    assert core.verify_session_token(f"{body}.\udcff") is None
+
+
+def test_expired_token_is_rejected(monkeypatch):
+    monkeypatch.setattr(core, "SESSION_TOKEN_TTL", -1)
+    token, _ = core.issue_session_token(1005)
+    assert core.verify_session_token(token) is None
+
+
+def test_revoke_invalidates_earlier_tokens():
+    old, _ = core.issue_session_token(1006)
+    core.revoke_session_tokens(1006)
+    new, _ = core.issue_session_token(1006)
+    assert core.verify_session_token(old) is None
+    assert core.verify_session_token(new) == 1006
@@ -0,0 +1,183 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+from shared_utils import (
+    CAPTURE_HEAD_BYTES, CAPTURE_TAIL_BYTES, BoundedCapture, CommandIndex, JavaClassCache, PipeLineReader, TTLCache,
+    fcntl, java_classpath, run_captured,
+)
+
+
+def test_pipe_line_reader_splits_lines_and_reports_eof():
+    r, w = os.pipe()
+    reader = PipeLineReader(r)
+    os.write(w, b"one\ntwo\nthr")
+    deadline = time.monotonic() + 1
+    assert reader.readline(deadline) == b"one"
+    assert reader.readline(deadline) == b"two"
+    assert reader.readline(time.monotonic() + 0.05) is None
+    os.write(w, b"ee\n")
+    os.close(w)
+    assert reader.readline(deadline) == b"three"
+    assert reader.readline(deadline) == b""
+    os.close(r)
+
+
+def test_pipe_line_reader_rejects_overlong_lines():
+    r, w = os.pipe()
+    reader = PipeLineReader(r, max_line=1000)
+    os.write(w, b"x" * 5000)
+    with pytest.raises(ValueError):
+        reader.readline(time.monotonic() + 1)
+    os.close(w)
+    os.close(r)
+
+
+def _build(cache, name):
+    build = tempfile.mkdtemp(prefix="build-", dir=cache.root)
+    with open(os.path.join(build, f"{name}.class"), "wb") as fh:
+        fh.write(b"\xca\xfe\xba\xbe")
+    return build
+
+
+def test_java_class_cache_key_depends_on_classpath():
+    src = "public class Main { public static void main(String[] a) {} }"
+    assert JavaClassCache.key_for(src) == JavaClassCache.key_for(src + "\n\n")
+    assert JavaClassCache.key_for(src, "/opt/lib/a.jar") != JavaClassCache.key_for(src)
+    assert JavaClassCache.key_for(src, "/opt/lib/a.jar") != JavaClassCache.key_for(src, "/opt/lib/b.jar")
+
+
+def test_java_classpath_resolves_relative_entries():
+    assert java_classpath("/work", {}) == ""
+    assert java_classpath("/work", {"CLASSPATH": os.pathsep.join(["lib/a.jar", "/abs/b.jar", ""])}) == os.pathsep.join(
+        ["/work/lib/a.jar", "/abs/b.jar", "/work"]
+    )
+
+
+def test_java_class_cache_put_get_release(tmp_path):
+    cache = JavaClassCache(str(tmp_path), max_bytes=1 << 20)
+    key = JavaClassCache.key_for("class A {}")
+    assert cache.get(key) is None
+    path = cache.put(key, _build(cache, "A"))
+    cache.release(key)
+    assert cache.get(key) == path
+    cache.release(key)
+    assert cache.stats()["entries"] == 1 and cache.hits == 1
+
+
+@pytest.mark.skipif(fcntl is None, reason="needs fcntl")
+def test_java_class_cache_lookup_not_blocked_by_an_entry_being_evicted(tmp_path):
+    cache = JavaClassCache(str(tmp_path), max_bytes=1 << 20)
+    busy, other = JavaClassCache.key_for("class A {}"), JavaClassCache.key_for("class B {}")
+    for key, name in ((busy, "A"), (other, "B")):
+        cache.put(key, _build(cache, name))
+        cache.release(key)
+    # Another process removing the entry holds its lock exclusively
+    fd = os.open(os.path.join(str(tmp_path), busy + ".lock"), os.O_RDWR)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    result = {}
+    waiter = threading.Thread(target=lambda: result.setdefault("busy", cache.get(busy)))
+    waiter.start()
+    time.sleep(0.2)
+    assert waiter.is_alive()
+    started = time.monotonic()
+    assert cache.get(other) is not None
+    assert time.monotonic() - started < 1
+    cache.release(other)
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+    waiter.join(5)
+    assert result["busy"] == os.path.join(str(tmp_path), busy)
+    cache.release(busy)
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_ttl_cache_expires_and_touches():
+    clock = _Clock()
+    cache = TTLCache(10, 100, clock=clock)
+    cache["a"] = 1
+    clock.now += 5
+    cache["b"] = 2
+    assert cache["a"] == 1 and "b" in cache
+    clock.now += 6
+    assert "a" not in cache and cache.get("a") is None
+    with pytest.raises(KeyError):
+        cache["a"]
+    assert cache.touch("b") is True
+    clock.now += 9
+    assert cache.get("b") == 2
+    assert cache.touch("a") is False
+    clock.now += 10
+    assert len(cache) == 0 and cache.expirations >= 2
+
+
+def test_ttl_cache_evicts_oldest_and_pops():
+    cache = TTLCache(60, 2, clock=_Clock())
+    cache["a"], cache["b"] = 1, 2
+    cache["a"] = 3  # re-set moves it to the back
+    cache["c"] = 4
+    assert cache.keys() == ["a", "c"] and cache.evictions == 1
+    assert cache.pop("a") == 3 and cache.pop("a", "gone") == "gone"
+    assert cache.items() == [("c", 4)]
+
+
+def test_command_index_ranks_prefix_matches_first():
+    index = CommandIndex(["grep", "egrep", "git", "Gzip", "ls", "lsblk"])
+    assert index.search("g") == ["git", "grep", "Gzip", "egrep"]
+    assert index.search("GREP") == ["grep", "egrep"]
+    assert index.search("rep") == ["egrep", "grep"]
+    assert index.search("") == ["egrep", "git", "grep", "Gzip", "ls", "lsblk"]
+    assert index.search("zzz") == []
+    assert index.page("l", 1, 5) == (["lsblk"], 2)
+
+
+def test_command_index_updates_invalidate_results():
+    index = CommandIndex(["python", "python3"])
+    assert index.search("ytho") == ["python", "python3"]
+    index.add("jython")
+    assert index.search("ytho") == ["jython", "python", "python3"]
+    index.discard("python")
+    assert index.search("ytho") == ["jython", "python3"] and "python" not in index
+    index.replace(["ls", "python3"])
+    assert len(index) == 2 and index.search("") == ["ls", "python3"]
+
+
+def test_bounded_capture_keeps_head_and_tail():
+    cap = BoundedCapture(head_bytes=4, tail_bytes=4)
+    for chunk in (b"ab", b"cdef", b"ghijkl"):
+        cap.feed(chunk)
+    assert cap.total == 12 and cap.dropped == 4
+    assert cap.text() == "abcd\n…[4 bytes dropped]…\nijkl"
+
+    small = BoundedCapture(head_bytes=4, tail_bytes=4)
+    small.feed(b"abcdef")
+    assert small.dropped == 0 and small.text() == "abcdef"
+
+
+def test_bounded_capture_tail_skips_a_split_character():
+    cap = BoundedCapture(head_bytes=2, tail_bytes=2)
+    cap.feed(b"ab" + b"x" * 10 + "é!".encode())
+    assert cap.text().endswith("…\n!")
+
+
+def test_run_captured_bounds_output_and_kills_over_budget(tmp_path):
+    env = dict(os.environ)
+    script = "import sys; sys.stdout.write('x' * 300000); sys.stderr.write('done')"
+    res = run_captured([sys.executable, "-c", script], str(tmp_path), env, 30)
+    assert res.returncode == 0 and res.stderr == "done"
+    assert "bytes dropped" in res.stdout and len(res.stdout) < 2 * (CAPTURE_HEAD_BYTES + CAPTURE_TAIL_BYTES)
+
+    loop = "import sys\nwhile True: sys.stdout.write('y' * 65536)"
+    res = run_captured([sys.executable, "-c", loop], str(tmp_path), env, 30, kill_bytes=1 << 20)
+    assert res.returncode != 0 and "output limit" in res.stderr + res.stdout
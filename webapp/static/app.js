@@ -19,8 +19,26 @@ let ptyReconnectAttempts = 0;
 let ptyPermanentError = false;  // True if error is permanent (no point reconnecting)
 let ptyLastError = '';          // Store last error message
 let ptySkipAutoReconnect = false;  // Skip auto-reconnect for manual reconnect
+let ptyBinary = false;          // Binary frame protocol accepted by the server
+let ptyDecoder = null;          // Streaming UTF-8 decoder for binary output
 const MAX_RECONNECT_ATTEMPTS = 5;
 
+// Session token from /api/auth, sent instead of the full initData
+let sessionToken = '';
+let sessionTokenExpires = 0;    // Unix seconds
+let sessionAuthPromise = null;  // In-flight /api/auth call
+
+// Binary /ws/terminal protocol (see pty_io.py): one type byte + payload
+const PTY_OP = {
+    OUTPUT: 0x00,
+    INPUT: 0x01,
+    RESIZE: 0x02,
+    PING: 0x03,
+    PONG: 0x04,
+    EXIT: 0x05
+};
+const ptyEncoder = new TextEncoder();
+
 // Prompt symbols per language
 const PROMPTS = {
     sh: '$',
@@ -275,21 +293,14 @@ function initPtyTerminal() {
     // Handle terminal input
     ptyTerminal.onData(data => {
         if (ptyWebSocket && ptyWebSocket.readyState === WebSocket.OPEN) {
-            ptyWebSocket.send(JSON.stringify({
-                type: 'input',
-                data: data
-            }));
+            sendPtyInput(data);
         }
     });
     
     // Handle terminal resize
     ptyTerminal.onResize(({ rows, cols }) => {
         if (ptyWebSocket && ptyWebSocket.readyState === WebSocket.OPEN) {
-            ptyWebSocket.send(JSON.stringify({
-                type: 'resize',
-                rows: rows,
-                cols: cols
-            }));
+            sendPtyResize(rows, cols);
         }
     });
     
@@ -307,6 +318,64 @@ function fitPtyTerminal() {
     }
 }
 
+function ptyFrame(op, payload) {
+    const frame = new Uint8Array(1 + (payload ? payload.length : 0));
+    frame[0] = op;
+    if (payload) frame.set(payload, 1);
+    return frame;
+}
+
+function sendPtyInput(data) {
+    if (ptyBinary) {
+        ptyWebSocket.send(ptyFrame(PTY_OP.INPUT, ptyEncoder.encode(data)));
+    } else {
+        ptyWebSocket.send(JSON.stringify({ type: 'input', data: data }));
+    }
+}
+
+function sendPtyResize(rows, cols) {
+    if (ptyBinary) {
+        const payload = new Uint8Array(4);
+        new DataView(payload.buffer).setUint16(0, rows);
+        new DataView(payload.buffer).setUint16(2, cols);
+        ptyWebSocket.send(ptyFrame(PTY_OP.RESIZE, payload));
+    } else {
+        ptyWebSocket.send(JSON.stringify({ type: 'resize', rows: rows, cols: cols }));
+    }
+}
+
+function handlePtyExit() {
+    console.log('PTY session ended');
+    ptyConnected = false;
+    updatePtyStatus('disconnected');
+    // Close WebSocket so reconnect works when switching tabs
+    if (ptyWebSocket) {
+        ptySkipAutoReconnect = true;  // Don't auto-reconnect on exit
+        ptyWebSocket.close();
+        ptyWebSocket = null;
+    }
+}
+
+function handlePtyBinary(buffer) {
+    const bytes = new Uint8Array(buffer);
+    if (bytes.length === 0) return;
+    switch (bytes[0]) {
+        case PTY_OP.OUTPUT:
+            if (ptyTerminal && ptyDecoder) {
+                // stream: true keeps a UTF-8 sequence split across frames for the next one
+                const text = ptyDecoder.decode(bytes.subarray(1), { stream: true });
+                if (text) ptyTerminal.write(text);
+            }
+            break;
+        case PTY_OP.EXIT:
+            handlePtyExit();
+            break;
+        case PTY_OP.PONG:
+            // Keepalive response
+            break;
+    }
+}
+
 function connectPtyWebSocket() {
     // Check for existing connection or connection in progress
     if (ptyWebSocket && 
@@ -323,17 +392,26 @@ function connectPtyWebSocket() {
     
     try {
         ptyWebSocket = new WebSocket(wsUrl);
+        ptyWebSocket.binaryType = 'arraybuffer';
+        ptyBinary = false;
         
         ptyWebSocket.onopen = () => {
             console.log('PTY WebSocket connected');
-            // Send auth message
+            // Send auth message (binary: ask for the binary frame protocol)
+            // (token: cheap check on reconnect; init_data: fallback if it was revoked)
             ptyWebSocket.send(JSON.stringify({
                 type: 'auth',
-                init_data: getInitData()
+                token: hasSessionToken() ? sessionToken : '',
+                init_data: getInitData(),
+                binary: typeof TextDecoder !== 'undefined' ? 1 : 0
             }));
         };
         
         ptyWebSocket.onmessage = (event) => {
+            if (event.data instanceof ArrayBuffer) {
+                handlePtyBinary(event.data);
+                return;
+            }
             try {
                 const msg = JSON.parse(event.data);
                 
@@ -343,15 +421,13 @@ function connectPtyWebSocket() {
                         ptyReconnectAttempts = 0;
                         ptyPermanentError = false;
                         ptyLastError = '';
+                        ptyBinary = !!msg.binary;
+                        ptyDecoder = ptyBinary ? new TextDecoder('utf-8') : null;
                         updatePtyStatus('connected');
                         // Request initial resize
                         if (ptyTerminal) {
                             const { rows, cols } = ptyTerminal;
-                            ptyWebSocket.send(JSON.stringify({
-                                type: 'resize',
-                                rows: rows,
-                                cols: cols
-                            }));
+                            sendPtyResize(rows, cols);
                         }
                         break;
                     
@@ -376,15 +452,7 @@ function connectPtyWebSocket() {
                         break;
                     
                     case 'exit':
-                        console.log('PTY session ended');
-                        ptyConnected = false;
-                        updatePtyStatus('disconnected');
-                        // Close WebSocket so reconnect works when switching tabs
-                        if (ptyWebSocket) {
-                            ptySkipAutoReconnect = true;  // Don't auto-reconnect on exit
-                            ptyWebSocket.close();
-                            ptyWebSocket = null;
-                        }
+                        handlePtyExit();
                         break;
                     
                     case 'pong':
@@ -602,12 +670,62 @@ function getInitData() {
     return tg?.initData || '';
 }
 
+function setSessionToken(data) {
+    sessionToken = data?.token || '';
+    sessionTokenExpires = data?.expires_at || 0;
+}
+
+function hasSessionToken() {
+    // Renew a minute early rather than race the expiry
+    return !!sessionToken && sessionTokenExpires - 60 > Date.now() / 1000;
+}
+
+async function apiAuth() {
+    // Exchange initData for a session token (one call shared by concurrent requests)
+    if (!sessionAuthPromise) {
+        sessionAuthPromise = fetch('/api/auth', {
+            method: 'POST',
+            headers: {
+                'X-Telegram-Init-Data': getInitData()
+            }
+        })
+            .then(response => response.ok ? response.json() : null)
+            .then(data => setSessionToken(data))
+            .catch(() => setSessionToken(null))
+            .finally(() => { sessionAuthPromise = null; });
+    }
+    return sessionAuthPromise;
+}
+
+function authHeaders(headers = {}) {
+    if (hasSessionToken()) {
+        return { ...headers, 'X-Session-Token': sessionToken };
+    }
+    return { ...headers, 'X-Telegram-Init-Data': getInitData() };
+}
+
+async function apiFetch(url, options = {}) {
+    if (!hasSessionToken() && getInitData()) {
+        await apiAuth();
+    }
+    const hadToken = hasSessionToken();
+    let response = await fetch(url, { ...options, headers: authHeaders(options.headers) });
+    if (response.status === 401 && hadToken) {
+        // Token revoked (session reset elsewhere) or server restarted: re-auth once
+        setSessionToken(null);
+        if (getInitData()) {
+            await apiAuth();
+        }
+        response = await fetch(url, { ...options, headers: authHeaders(options.headers) });
+    }
+    return response;
+}
+
 async function apiExecute(type, code) {
-    const response = await fetch('/api/execute', {
+    const response = await apiFetch('/api/execute', {
         method: 'POST',
         headers: {
-            'Content-Type': 'application/json',
-            'X-Telegram-Init-Data': getInitData()
+            'Content-Type': 'application/json'
         },
         body: JSON.stringify({ type, code })
     });
@@ -621,36 +739,31 @@ async function apiExecute(type, code) {
 }
 
 async function apiGetSession() {
-    const response = await fetch('/api/session', {
-        headers: {
-            'X-Telegram-Init-Data': getInitData()
-        }
-    });
+    const response = await apiFetch('/api/session');
     
     if (!response.ok) return null;
     return response.json();
 }
 
 async function apiGetCommands() {
-    const response = await fetch('/api/commands', {
-        headers: {
-            'X-Telegram-Init-Data': getInitData()
-        }
-    });
+    const response = await apiFetch('/api/commands');
     
     if (!response.ok) return null;
     return response.json();
 }
 
 async function apiResetSession() {
-    const response = await fetch('/api/session/reset', {
-        method: 'POST',
-        headers: {
-            'X-Telegram-Init-Data': getInitData()
-        }
+    const response = await apiFetch('/api/session/reset', {
+        method: 'POST'
     });
     
-    return response.ok;
+    if (!response.ok) return false;
+    // The reset revoked our old token; the response carries a new one
+    const data = await response.json().catch(() => null);
+    if (data?.token) {
+        setSessionToken(data);
+    }
+    return true;
 }
 
 // ==== Output Management ====
@@ -0,0 +1,599 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Async (aiohttp) serving mode for the Web App.
+
+Same API and the same in-memory state as webapp_server.py (which is imported
+for sessions, auth, allowlist and the PTY helpers), but waiting no longer
+holds an OS thread:
+- /api/execute awaits its scheduler slot, and shell commands run as asyncio
+  subprocesses. Python/JS/Java still run in a worker thread, only once a job
+  is granted. /api/cancel stops that work through the run's RunCanceller, and
+  the job keeps its slot until the thread has returned, so threads are
+  bounded by SCHEDULER slots, not requests.
+- /ws/terminal watches the PTY master fd with loop.add_reader, so an idle
+  terminal costs a coroutine and a file descriptor instead of two threads.
+
+Run:
+    python webapp_async.py                          # WEBAPP_HOST / WEBAPP_PORT
+    WEBAPP_SERVER=aiohttp python run_all.py --prod   # supervised, next to the bot
+"""
+
+import os
+import json
+import time
+import codecs
+import asyncio
+import contextlib
+import subprocess
+from functools import wraps
+
+from aiohttp import web, WSMsgType
+
+import webapp_server as core
+from scheduler import SCHEDULER, JobCancelled, QueueFull, classify as classify_job
+from shared_utils import normalize_code, truncate, run_shell_async, RunCanceller, cancellable
+from pty_io import (
+    PTY_FRAME_LATENCY_MS,
+    PTY_FRAME_MAX,
+    PTY_MAX_BUFFER,
+    wants_binary,
+    encode_frame,
+    decode_frame,
+    decode_resize,
+    OP_OUTPUT,
+    OP_INPUT,
+    OP_RESIZE,
+    OP_PING,
+    OP_PONG,
+    OP_EXIT,
+)
+
+
+WEBAPP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "webapp")
+
+routes = web.RouteTableDef()
+
+
+# ==== Auth ====
+def _json_error(status: int, **body) -> web.Response:
+    return web.json_response(body, status=status)
+
+
+def require_auth(handler):
+    """Same rules as webapp_server.require_auth; sets request["user_id"] / request["user_data"]."""
+    @wraps(handler)
+    async def decorated(request: web.Request):
+        if core.DEV_MODE:
+            request["user_id"] = 0
+            request["user_data"] = {"dev_mode": True}
+            request["auth_method"] = "dev"
+            core.reporter.report_activity(0)
+            return await handler(request)
+
+        if not core.BOT_TOKEN:
+            return _json_error(
+                503,
+                error="Server misconfigured",
+                message="BOT_TOKEN not set. Set WEBAPP_DEV_MODE=1 for development.",
+            )
+
+        user_id, user, method = core.resolve_user(
+            request.headers.get("X-Telegram-Init-Data", ""),
+            request.headers.get("X-Session-Token", ""),
+        )
+        if user_id is None:
+            return _json_error(401, error="Unauthorized", message="Invalid or expired init data or session token")
+        if user_id not in core.OWNER_IDS:
+            return _json_error(403, error="Forbidden", message="Access denied", user_id=user_id)
+
+        request["user_id"] = user_id
+        request["user_data"] = user
+        request["auth_method"] = method
+        core.reporter.report_activity(user_id)
+        return await handler(request)
+    return decorated
+
+
+# ==== API Endpoints ====
+
+@routes.get("/")
+async def index(_request):
+    """Return main Web App page."""
+    return web.FileResponse(os.path.join(WEBAPP_DIR, "index.html"))
+
+
+@routes.get("/api/health")
+async def health(_request):
+    """Health check."""
+    activity = {k: v for k, v in core.reporter.stats().items() if k != "connect_error"}
+    return web.json_response({
+        "status": "ok",
+        "server": "aiohttp",
+        "timestamp": time.time(),
+        "activity_reporter": activity,
+        "scheduler": SCHEDULER.stats(),
+        "auth_cache": core.AUTH_CACHE.stats(),
+        "py_contexts": core.py_context_health(),
+    })
+
+
+async def execute_shell(cmdline: str, sess: dict, user_id: int) -> dict:
+    """Execute shell command as an asyncio subprocess (cancellation kills its process group)."""
+    cmdline = normalize_code(cmdline)
+    result, done = core.prepare_shell(cmdline, sess, user_id)
+    if done:
+        return result
+    try:
+        shell_exec = core.SHELL_EXECUTABLE or "/bin/bash"
+        p = await run_shell_async(shell_exec, cmdline, sess["cwd"], sess["env"], core.TIMEOUT)
+        result["output"] = truncate(p.stdout or "", core.MAX_OUTPUT)
+        result["error"] = p.stderr or ""
+        result["exit_code"] = p.returncode
+    except subprocess.TimeoutExpired:
+        result["error"] = f"Timeout ({core.TIMEOUT}s)"
+        result["exit_code"] = -1
+    except Exception as e:
+        result["error"] = str(e)
+        result["exit_code"] = -1
+    return result
+
+
+async def _in_thread(fn, *args):
+    """
+    asyncio.to_thread that, when cancelled, still waits for fn to return before
+    re-raising: the run's RunCanceller stops it, and until then the job keeps
+    its scheduler slot.
+    """
+    fut = asyncio.ensure_future(asyncio.to_thread(fn, *args))
+    try:
+        return await asyncio.shield(fut)
+    except asyncio.CancelledError:
+        with contextlib.suppress(Exception):
+            await fut
+        raise
+
+
+async def execute_python(code: str, _sess: dict, user_id: int) -> dict:
+    return await _in_thread(core.execute_python, code, user_id)
+
+
+async def execute_js(code: str, sess: dict, user_id: int) -> dict:
+    return await _in_thread(core.execute_js, code, sess, user_id)
+
+
+async def execute_java(code: str, sess: dict, _user_id: int) -> dict:
+    return await _in_thread(core.execute_java, code, sess)
+
+
+EXECUTORS = {
+    "sh": execute_shell,
+    "py": execute_python,
+    "js": execute_js,
+    "java": execute_java,
+}
+
+
+@routes.post("/api/execute")
+@require_auth
+async def execute(request: web.Request):
+    """Execute command or code."""
+    try:
+        data = await request.json()
+    except Exception:
+        data = None
+    if not data:
+        return _json_error(400, error="No data provided")
+
+    exec_type = data.get("type", "sh")
+    code = (data.get("code") or "").strip()
+    if not code:
+        return _json_error(400, error="No code provided")
+    if exec_type not in EXECUTORS:
+        return _json_error(400, error=f"Unknown type: {exec_type}")
+
+    user_id = request["user_id"]
+    sess = core.get_session(user_id)
+
+    try:
+        ticket = SCHEDULER.submit(user_id, classify_job(exec_type, code), f"{exec_type}: {code[:60]}")
+    except QueueFull as e:
+        return _json_error(429, error=f"Queue full: {e}")
+
+    task = asyncio.current_task()
+    loop = asyncio.get_running_loop()
+    active = [True]
+    canceller = RunCanceller()
+
+    def _cancel_task():
+        if active[0]:
+            task.cancel()
+
+    def _on_cancel():
+        canceller.cancel()  # cancelling the task alone doesn't stop a to_thread executor
+        loop.call_soon_threadsafe(_cancel_task)
+
+    ticket.set_cancel_hook(_on_cancel)
+    try:
+        try:
+            await asyncio.wait_for(ticket.wait_async(), core.SCHED_QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return _json_error(503, error=f"Queue timeout ({core.SCHED_QUEUE_TIMEOUT:g}s)", queue=SCHEDULER.stats())
+        except JobCancelled:
+            return web.json_response(core.cancelled_result(exec_type, code))
+        try:
+            with cancellable(canceller):
+                result = await EXECUTORS[exec_type](code, sess, user_id)
+        except asyncio.CancelledError:
+            # /api/cancel on a running job; anything else (shutdown) propagates
+            if not ticket.cancelled:
+                raise
+            task.uncancel()
+            result = core.cancelled_result(exec_type, code)
+    finally:
+        active[0] = False
+        # e.g. in-thread Python left running by core.execute_python's timeout
+        if canceller.active:
+            await asyncio.to_thread(canceller.finish, core.TIMEOUT)
+        ticket.release()
+
+    return web.json_response(result)
+
+
+@routes.get("/api/session")
+@require_auth
+async def get_session_info(request: web.Request):
+    """Return current session info."""
+    user_id = request["user_id"]
+    sess = core.get_session(user_id)
+    return web.json_response({
+        "user_id": user_id,
+        "cwd": sess["cwd"],
+        "user": request["user_data"],
+    })
+
+
+@routes.post("/api/auth")
+@require_auth
+async def auth_token(request: web.Request):
+    """Exchange Telegram init data for a session token (send it as X-Session-Token)."""
+    if request["auth_method"] == "token":
+        return _json_error(401, error="Unauthorized", message="Send X-Telegram-Init-Data to get a token")
+    token, expires_at = core.issue_session_token(request["user_id"], request["user_data"])
+    return web.json_response({"token": token, "expires_at": expires_at, "user_id": request["user_id"]})
+
+
+@routes.post("/api/session/reset")
+@require_auth
+async def reset_session(request: web.Request):
+    """Reset session. Revokes the user's session tokens and returns a fresh one."""
+    user_id = request["user_id"]
+    await asyncio.to_thread(core.reset_user_state, user_id)
+    core.revoke_session_tokens(user_id)
+    token, expires_at = core.issue_session_token(user_id)
+    return web.json_response({"status": "ok", "message": "Session reset", "token": token, "expires_at": expires_at})
+
+
+@routes.get("/api/queue")
+@require_auth
+async def queue_status(request: web.Request):
+    """Return the user's queued/running jobs and overall scheduler load."""
+    return web.json_response({"jobs": SCHEDULER.user_jobs(request["user_id"]), "scheduler": SCHEDULER.stats()})
+
+
+@routes.post("/api/cancel")
+@require_auth
+async def cancel_jobs(request: web.Request):
+    """Cancel the user's jobs: {"id": <job id>} for one, empty body for all."""
+    try:
+        data = await request.json()
+    except Exception:
+        data = {}
+    job_id = (data or {}).get("id")
+    if job_id is not None and not isinstance(job_id, int):
+        return _json_error(400, error="id must be an integer")
+    return web.json_response({"status": "ok", "cancelled": SCHEDULER.cancel_user(request["user_id"], job_id)})
+
+
+@routes.get("/api/commands")
+@require_auth
+async def list_commands(_request):
+    """Return list of allowed commands."""
+    return web.json_response({
+        "commands": sorted(core.ALLOWED_CMDS),
+        "allow_all": core.ALLOW_ALL_COMMANDS,
+    })
+
+
+@routes.post("/api/pty/close")
+@require_auth
+async def close_pty(request: web.Request):
+    """Close PTY session for current user."""
+    async with _PTY_LOCKS.setdefault(request["user_id"], asyncio.Lock()):
+        _detach_user_pty(request["user_id"])
+        await asyncio.to_thread(core.close_pty_session_by_user, request["user_id"])
+    return web.json_response({"status": "ok", "message": "PTY session closed"})
+
+
+# ==== PTY WebSocket Terminal ====
+
+class PtyPump:
+    """
+    Moves bytes between a PTY master fd and a WebSocket on the event loop.
+    Output is coalesced like pty_io does for the threaded server: a frame goes
+    out PTY_FRAME_LATENCY_MS after the first byte (or once PTY_FRAME_MAX bytes
+    are buffered); when the client falls PTY_MAX_BUFFER behind, reading pauses
+    (the shell blocks on write).
+    """
+
+    def __init__(self, master_fd: int, ws: web.WebSocketResponse, binary: bool = False):
+        self.fd = master_fd
+        self.ws = ws
+        self.binary = binary
+        self.loop = asyncio.get_running_loop()
+        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        self._out: list[bytes] = []
+        self._out_bytes = 0
+        self._in = bytearray()
+        self._ready = asyncio.Event()
+        self._reading = False
+        self._writing = False
+        self.eof = False
+        os.set_blocking(master_fd, False)
+        self._resume_reading()
+        self._task = asyncio.create_task(self._send_loop())
+
+    def _resume_reading(self):
+        if not self._reading and not self.eof:
+            self.loop.add_reader(self.fd, self._on_readable)
+            self._reading = True
+
+    def _pause_reading(self):
+        if self._reading:
+            self.loop.remove_reader(self.fd)
+            self._reading = False
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.fd, PTY_FRAME_MAX)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""  # EIO: the shell exited
+        if not data:
+            self.eof = True
+            self._pause_reading()
+        else:
+            self._out.append(data)
+            self._out_bytes += len(data)
+            if self._out_bytes >= PTY_MAX_BUFFER:
+                self._pause_reading()
+        self._ready.set()
+
+    async def _send_loop(self):
+        try:
+            while True:
+                await self._ready.wait()
+                if self._out_bytes < PTY_FRAME_MAX and not self.eof and PTY_FRAME_LATENCY_MS > 0:
+                    # Latency window: let more output join this frame
+                    await asyncio.sleep(PTY_FRAME_LATENCY_MS / 1000)
+                self._ready.clear()
+                if self._out:
+                    data = b"".join(self._out)
+                    self._out.clear()
+                    self._out_bytes = 0
+                    for i in range(0, len(data), PTY_FRAME_MAX):
+                        await self._send_output(data[i:i + PTY_FRAME_MAX])
+                    self._resume_reading()
+                if self.eof:
+                    if self.binary:
+                        await self.ws.send_bytes(encode_frame(OP_EXIT))
+                    else:
+                        await self.ws.send_str(json.dumps({"type": "exit"}))
+                    await self.ws.close()
+                    return
+        except (ConnectionResetError, RuntimeError):
+            # Client went away; the receive loop notices and cleans up
+            pass
+
+    async def _send_output(self, chunk: bytes):
+        if self.binary:
+            await self.ws.send_bytes(encode_frame(OP_OUTPUT, chunk))
+            return
+        # Incremental decoder: a UTF-8 sequence split between reads stays intact
+        text = self._decoder.decode(chunk)
+        if text:
+            await self.ws.send_str(json.dumps({"type": "output", "data": text}))
+
+    def write(self, data: bytes):
+        """Queue input for the shell; written as the PTY accepts it."""
+        if self.eof:
+            return
+        self._in += data
+        self._flush_input()
+
+    def _flush_input(self):
+        while self._in:
+            try:
+                n = os.write(self.fd, self._in)
+            except BlockingIOError:
+                break
+            except OSError:
+                self._in.clear()
+                break
+            del self._in[:n]
+        if self._in and not self._writing:
+            self.loop.add_writer(self.fd, self._flush_input)
+            self._writing = True
+        elif not self._in and self._writing:
+            self.loop.remove_writer(self.fd)
+            self._writing = False
+
+    async def send_json(self, obj: dict):
+        await self.ws.send_str(json.dumps(obj))
+
+    def detach(self):
+        """Stop touching the fd (it is about to be closed); the client gets "exit"."""
+        self._pause_reading()
+        if self._writing:
+            self.loop.remove_writer(self.fd)
+            self._writing = False
+        self.eof = True
+        self._ready.set()
+
+    def close(self):
+        self.detach()
+        self._task.cancel()
+
+
+# session_id -> PtyPump. A session's fd is closed by core.create_pty_session (new tab
+# of the same user) or /api/pty/close; its pump is detached first, otherwise the
+# loop could end up watching a reused fd number.
+PUMPS: dict = {}
+# user_id -> lock: two tabs opening at once must not close each other's new fd
+_PTY_LOCKS: dict = {}
+
+
+def _detach_user_pty(user_id: int):
+    session = core.pty_sessions.get(user_id)
+    pump = PUMPS.pop(session["session_id"], None) if session else None
+    if pump is not None:
+        pump.detach()
+
+
+async def validate_ws_auth(ws: web.WebSocketResponse) -> tuple[int | None, dict]:
+    """
+    First message must be {"type": "auth", "init_data": ...} or {"type": "auth", "token": ...}
+    (not checked in dev mode).
+    Returns (user_id or None, auth message) like webapp_server.validate_ws_auth.
+    """
+    try:
+        msg = await ws.receive(timeout=5)
+    except asyncio.TimeoutError:
+        msg = None
+    auth_data = {}
+    if msg is not None and msg.type == WSMsgType.TEXT:
+        try:
+            auth_data = json.loads(msg.data)
+        except json.JSONDecodeError:
+            pass
+        if not isinstance(auth_data, dict):
+            auth_data = {}
+    if core.DEV_MODE:
+        return 0, auth_data
+    if not core.BOT_TOKEN or auth_data.get("type") != "auth":
+        return None, auth_data
+    try:
+        user_id, _, _ = core.resolve_user(auth_data.get("init_data", ""), auth_data.get("token", ""))
+        return (user_id if user_id in core.OWNER_IDS else None), auth_data
+    except Exception:
+        return None, auth_data
+
+
+@routes.get("/ws/terminal")
+async def ws_terminal(request: web.Request):
+    """WebSocket endpoint for interactive PTY terminal."""
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+
+    if not core.PTY_AVAILABLE:
+        await ws.send_str(json.dumps({"type": "error", "message": "PTY not available on this system"}))
+        await ws.close()
+        return ws
+
+    # PTY provides full shell access - only allow if ALLOW_ALL_COMMANDS is enabled
+    if not core.ALLOW_ALL_COMMANDS:
+        await ws.send_str(json.dumps({
+            "type": "error",
+            "message": "PTY terminal requires ALLOW_ALL_COMMANDS=1 (full shell access)"
+        }))
+        await ws.close()
+        return ws
+
+    user_id, auth_data = await validate_ws_auth(ws)
+    if user_id is None:
+        await ws.send_str(json.dumps({"type": "error", "message": "Authentication failed"}))
+        await ws.close()
+        return ws
+
+    core.reporter.report_activity(user_id)
+    binary = wants_binary(auth_data)
+    await ws.send_str(json.dumps({"type": "auth_ok", "user_id": user_id, "binary": binary}))
+
+    async with _PTY_LOCKS.setdefault(user_id, asyncio.Lock()):
+        try:
+            # fork + closing a previous session (which sleeps briefly) stay off the loop
+            _detach_user_pty(user_id)
+            pty_session = await asyncio.to_thread(core.create_pty_session, user_id)
+        except Exception as e:
+            await ws.send_str(json.dumps({"type": "error", "message": f"Failed to create PTY: {str(e)}"}))
+            await ws.close()
+            return ws
+        pump = PtyPump(pty_session["master_fd"], ws, binary)
+        PUMPS[pty_session["session_id"]] = pump
+
+    try:
+        async for msg in ws:
+            if msg.type == WSMsgType.BINARY:
+                # Binary protocol: type byte + payload
+                op, payload = decode_frame(msg.data)
+                if op == OP_INPUT:
+                    if payload:
+                        pump.write(payload)
+                elif op == OP_RESIZE:
+                    size = decode_resize(payload)
+                    if size:
+                        core.resize_pty(pty_session["master_fd"], *size)
+                elif op == OP_PING:
+                    await ws.send_bytes(encode_frame(OP_PONG))
+                continue
+            if msg.type != WSMsgType.TEXT:
+                continue
+            try:
+                data = json.loads(msg.data)
+            except json.JSONDecodeError:
+                # Treat as raw input
+                pump.write(msg.data.encode("utf-8"))
+                continue
+            msg_type = data.get("type")
+            if msg_type == "input":
+                input_data = data.get("data", "")
+                if input_data:
+                    pump.write(input_data.encode("utf-8"))
+            elif msg_type == "resize":
+                core.resize_pty(pty_session["master_fd"], data.get("rows", 24), data.get("cols", 80))
+            elif msg_type == "ping":
+                await pump.send_json({"type": "pong"})
+    except Exception:
+        pass
+    finally:
+        pump.close()
+        PUMPS.pop(pty_session["session_id"], None)
+        # Cleanup this specific PTY session (not by user_id, a newer tab may own it)
+        await asyncio.to_thread(core.close_pty_session, pty_session)
+    return ws
+
+
+# ==== Run ====
+def create_app() -> web.Application:
+    app = web.Application()
+    app.add_routes(routes)
+    app.router.add_static("/static/", os.path.join(WEBAPP_DIR, "static"))
+    return app
+
+
+def run_server(host=None, port=None):
+    """Run the async server."""
+    host = host or os.getenv("WEBAPP_HOST", "0.0.0.0")
+    port = port or int(os.getenv("WEBAPP_PORT", "8080"))
+    print(f"🌐 Web App (aiohttp) on http://{host}:{port}")
+    web.run_app(create_app(), host=host, port=port, print=None)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Run the Web App on aiohttp")
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--port", type=int, default=None)
+    args = parser.parse_args()
+    run_server(args.host, args.port)
@@ -17,14 +17,18 @@ import time
 import hmac
 import shlex
 import signal
+import base64
 import hashlib
+import codecs
 import textwrap
 import traceback
 import subprocess
 import contextlib
+import functools
+import contextvars
 from functools import wraps
 from urllib.parse import parse_qsl, unquote
-from threading import Lock, Thread
+from threading import Lock
 from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 
 from flask import Flask, request, jsonify, send_from_directory
@@ -32,6 +36,25 @@ from flask_sock import Sock
 
 # Activity reporter
 from activity_reporter import create_reporter
+from py_pool import create_pool_from_env
+from py_contexts import PythonContexts
+from js_worker import run_js, reset_js
+from java_daemon import run_java
+from pty_io import (
+    get_reactor as get_pty_reactor,
+    wants_binary,
+    encode_frame,
+    decode_frame,
+    decode_resize,
+    OP_OUTPUT,
+    OP_INPUT,
+    OP_RESIZE,
+    OP_PING,
+    OP_PONG,
+    OP_EXIT,
+)
+from scheduler import SCHEDULER, JobCancelled, QueueFull, classify as classify_job
+from session_store import ShellSessions
 
 # Import shared utilities
 from shared_utils import (
@@ -41,10 +64,12 @@ from shared_utils import (
     normalize_code,
     truncate,
     exec_python_in_context,
-    run_js_blocking,
-    run_java_blocking,
+    RunCanceller,
+    cancellable,
     run_shell_blocking,
     handle_builtins,
+    materialize_env,
+    TTLCache,
 )
 
 # ==== Configuration ====
@@ -59,6 +84,20 @@ TIMEOUT = int(os.getenv("CMD_TIMEOUT", "60"))
 MAX_OUTPUT = int(os.getenv("MAX_OUTPUT", "10000"))
 SHELL_EXECUTABLE = os.getenv("SHELL_EXECUTABLE") or ("/bin/bash" if os.path.exists("/bin/bash") else None)
 ALLOW_ALL_COMMANDS = os.getenv("ALLOW_ALL_COMMANDS", "").lower() in ("1", "true", "yes", "on")
+# How long /api/execute waits for a scheduler slot before giving up
+SCHED_QUEUE_TIMEOUT = float(os.getenv("SCHED_QUEUE_TIMEOUT", "120"))
+
+# Telegram init data is valid for 24h after auth_date
+INIT_DATA_MAX_AGE = 86400
+# Web App HMAC key, derived from the bot token once instead of per request
+WEBAPP_SECRET_KEY = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+# Already-verified init data (digest -> (expires_at, data))
+AUTH_CACHE_SIZE = int(os.getenv("WEBAPP_AUTH_CACHE_SIZE", "1024"))
+AUTH_CACHE = TTLCache(ttl=INIT_DATA_MAX_AGE, maxsize=AUTH_CACHE_SIZE)
+# Session tokens from /api/auth: valid this long, signed with a per-process key
+# (a restart invalidates them; the client falls back to init data and re-auths)
+SESSION_TOKEN_TTL = int(os.getenv("WEBAPP_TOKEN_TTL", "3600"))
+SESSION_TOKEN_KEY = os.urandom(32)
 
 # Activity reporter (keep secrets in ENV, not in code)
 # Expected ENV: ACTIVITY_MONGODB_URI
@@ -72,15 +111,18 @@ reporter = create_reporter(
 # Load allowed commands (respects ENV and file like bot.py)
 ALLOWED_CMDS = load_allowed_cmds()
 
-# Sessions per user_id
-webapp_sessions = {}
-webapp_sessions_lock = Lock()
+# Shell sessions (cwd/env) per user_id, shared with the bot's chats (see session_store)
+webapp_sessions = ShellSessions("shell")
+
+# Python context per user_id (idle/budget eviction, optional spill to disk; see py_contexts)
+PY_CONTEXT = PythonContexts()
 
-# Python context per user_id
-PY_CONTEXT = {}
+# Process-isolated Python workers, one per user up to PY_WORKERS (0 falls back to in-thread exec)
+PY_POOL = create_pool_from_env(default_size=8)
 
-# Thread pool for code execution with timeout
-executor = ThreadPoolExecutor(max_workers=4)
+# Thread pool for code execution with timeout. Admission is the scheduler's job;
+# the spare workers cover threads still winding down after a timeout.
+executor = ThreadPoolExecutor(max_workers=max(4, SCHEDULER.slots * 2))
 
 # Flask app
 app = Flask(__name__, static_folder="webapp/static")
@@ -93,24 +135,16 @@ pty_sessions_lock = Lock()
 
 # ==== Helpers ====
 def get_session(user_id: int) -> dict:
-    """Get or create session for user."""
-    with webapp_sessions_lock:
-        if user_id not in webapp_sessions:
-            webapp_sessions[user_id] = {
-                "cwd": os.getcwd(),
-                "env": dict(os.environ),
-            }
-        return webapp_sessions[user_id]
+    """Get session for user (defaults if none). Call save_session() after changing it."""
+    return webapp_sessions.get(user_id)
 
 
-def validate_telegram_webapp_data(init_data: str) -> dict | None:
-    """
-    Validate data sent from Telegram Web App.
-    Returns dict with data if valid, None otherwise.
-    """
-    if not BOT_TOKEN:
-        return None
-    
+def save_session(user_id: int, sess: dict) -> None:
+    webapp_sessions.save(user_id, sess)
+
+
+def _verify_init_data(init_data: str) -> dict | None:
+    """Full HMAC check of a Telegram Web App init-data string (no cache)."""
     try:
         # Parse data
         parsed = dict(parse_qsl(init_data, keep_blank_values=True))
@@ -126,15 +160,14 @@ def validate_telegram_webapp_data(init_data: str) -> dict | None:
         data_check_string = "\n".join(data_check_arr)
         
         # Calculate hash
-        secret_key = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
-        calculated_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+        calculated_hash = hmac.new(WEBAPP_SECRET_KEY, data_check_string.encode(), hashlib.sha256).hexdigest()
         
         if not hmac.compare_digest(calculated_hash, received_hash):
             return None
         
         # Check validity (up to 24 hours)
         auth_date = int(parsed.get("auth_date", 0))
-        if time.time() - auth_date > 86400:
+        if time.time() - auth_date > INIT_DATA_MAX_AGE:
             return None
         
         # Parse user
@@ -147,16 +180,114 @@ def validate_telegram_webapp_data(init_data: str) -> dict | None:
         return None
 
 
+def validate_telegram_webapp_data(init_data: str) -> dict | None:
+    """
+    Validate data sent from Telegram Web App.
+    Returns dict with data if valid, None otherwise.
+
+    The client sends the same init data on every request, so verified strings
+    are remembered (keyed by digest) and later calls are a cache lookup. A
+    cached entry still expires INIT_DATA_MAX_AGE after its auth_date.
+    """
+    if not BOT_TOKEN or not init_data or not isinstance(init_data, str):
+        return None
+    
+    key = hashlib.sha256(init_data.encode()).digest()
+    cached = AUTH_CACHE.get(key)
+    if cached is not None:
+        expires_at, data = cached
+        if time.time() <= expires_at:
+            return dict(data)
+        AUTH_CACHE.pop(key)
+        return None
+    
+    data = _verify_init_data(init_data)
+    if data is not None:
+        expires_at = int(data.get("auth_date", 0)) + INIT_DATA_MAX_AGE
+        AUTH_CACHE[key] = (expires_at, data)
+        return dict(data)
+    return None
+
+
+# ==== Session tokens ====
+# A token is "<user_id>.<generation>.<expires>.<sig>", sig = HMAC(SESSION_TOKEN_KEY)
+# over the rest. Bumping a user's generation revokes every token issued before.
+_token_generations: dict[int, int] = {}
+_token_users: dict[int, dict] = {}  # last Telegram profile seen per user, for /api/session
+_token_lock = Lock()
+
+
+def _sign_token(body: str) -> str:
+    digest = hmac.new(SESSION_TOKEN_KEY, body.encode(), hashlib.sha256).digest()[:18]
+    return base64.urlsafe_b64encode(digest).decode()
+
+
+def issue_session_token(user_id: int, user: dict | None = None) -> tuple[str, int]:
+    """Return (token, expires_at) for user_id."""
+    expires_at = int(time.time()) + SESSION_TOKEN_TTL
+    with _token_lock:
+        generation = _token_generations.get(user_id, 0)
+        if user:
+            _token_users[user_id] = user
+    body = f"{user_id}.{generation}.{expires_at}"
+    return f"{body}.{_sign_token(body)}", expires_at
+
+
+def verify_session_token(token: str) -> int | None:
+    """user_id of a valid, unexpired, unrevoked token; None otherwise."""
+    try:
+        body, sig = token.rsplit(".", 1)
+        user_id, generation, expires_at = (int(part) for part in body.split("."))
+    except (ValueError, AttributeError):
+        return None
+    # Bytes: compare_digest rejects str with non-ASCII characters (TypeError)
+    if not hmac.compare_digest(sig.encode("utf-8", "replace"), _sign_token(body).encode()):
+        return None
+    if expires_at < time.time():
+        return None
+    with _token_lock:
+        if generation != _token_generations.get(user_id, 0):
+            return None
+    return user_id
+
+
+def revoke_session_tokens(user_id: int) -> None:
+    """Invalidate every token issued to user_id so far."""
+    with _token_lock:
+        _token_generations[user_id] = _token_generations.get(user_id, 0) + 1
+
+
+def resolve_user(init_data: str, token: str = "") -> tuple[int | None, dict, str]:
+    """
+    Identify the caller from a session token (cheap) or, failing that, init data.
+    Returns (user_id, user, method); user_id is None if neither is valid.
+    Does not check OWNER_IDS.
+    """
+    if token:
+        user_id = verify_session_token(token)
+        if user_id is not None:
+            with _token_lock:
+                user = _token_users.get(user_id) or {"id": user_id}
+            return user_id, user, "token"
+    data = validate_telegram_webapp_data(init_data)
+    if not data:
+        return None, {}, ""
+    user = data.get("user", {})
+    return user.get("id", 0), user, "init_data"
+
+
 def require_auth(f):
     """Decorator for user authentication."""
     @wraps(f)
     def decorated(*args, **kwargs):
         init_data = request.headers.get("X-Telegram-Init-Data", "")
+        token = request.headers.get("X-Session-Token", "")
         
         # Development mode - skip authentication entirely
         if DEV_MODE:
             request.user_id = 0
             request.user_data = {"dev_mode": True}
+            request.auth_method = "dev"
             reporter.report_activity(request.user_id)
             return f(*args, **kwargs)
         
@@ -167,12 +298,9 @@ def require_auth(f):
                 "message": "BOT_TOKEN not set. Set WEBAPP_DEV_MODE=1 for development."
             }), 503
         
-        data = validate_telegram_webapp_data(init_data)
-        if not data:
-            return jsonify({"error": "Unauthorized", "message": "Invalid or expired init data"}), 401
-        
-        user = data.get("user", {})
-        user_id = user.get("id", 0)
+        user_id, user, method = resolve_user(init_data, token)
+        if user_id is None:
+            return jsonify({"error": "Unauthorized", "message": "Invalid or expired init data or session token"}), 401
         
         # Check authorization - OWNER_IDS is never empty due to default
         if user_id not in OWNER_IDS:
@@ -180,6 +308,7 @@ def require_auth(f):
         
         request.user_id = user_id
         request.user_data = user
+        request.auth_method = method
         reporter.report_activity(request.user_id)
         return f(*args, **kwargs)
     return decorated
@@ -199,10 +328,26 @@ def static_files(filename):
     return send_from_directory("webapp/static", filename)
 
 
+def py_context_health(top: int = 5) -> dict:
+    """/py context stats plus the sizes of the largest namespaces (no user ids: /api/health is public)."""
+    contexts = PY_POOL if PY_POOL is not None else PY_CONTEXT
+    sizes = sorted((v["bytes"] for v in contexts.sizes().values()), reverse=True)
+    return {**contexts.stats(), "largest_bytes": sizes[:top]}
+
+
 @app.route("/api/health")
 def health():
     """Health check."""
-    return jsonify({"status": "ok", "timestamp": time.time()})
+    # Public endpoint: leave out the connect error text (it may contain the cluster host)
+    activity = {k: v for k, v in reporter.stats().items() if k != "connect_error"}
+    return jsonify({
+        "status": "ok",
+        "timestamp": time.time(),
+        "activity_reporter": activity,
+        "scheduler": SCHEDULER.stats(),
+        "auth_cache": AUTH_CACHE.stats(),
+        "py_contexts": py_context_health(),
+    })
 
 
 @app.route("/api/execute", methods=["POST"])
@@ -220,19 +365,35 @@ def execute():
         if not code:
             return jsonify({"error": "No code provided"}), 400
         
+        if exec_type not in ("sh", "py", "js", "java"):
+            return jsonify({"error": f"Unknown type: {exec_type}"}), 400
+        
         user_id = getattr(request, "user_id", 0)
         sess = get_session(user_id)
         
-        if exec_type == "sh":
-            result = execute_shell(code, sess)
-        elif exec_type == "py":
-            result = execute_python(code, user_id)
-        elif exec_type == "js":
-            result = execute_js(code, sess)
-        elif exec_type == "java":
-            result = execute_java(code, sess)
-        else:
-            return jsonify({"error": f"Unknown type: {exec_type}"}), 400
+        try:
+            ticket = SCHEDULER.submit(user_id, classify_job(exec_type, code), f"{exec_type}: {code[:60]}")
+        except QueueFull as e:
+            return jsonify({"error": f"Queue full: {e}"}), 429
+        # /api/cancel stops the run's process, worker or in-thread Python code (see RunCanceller)
+        canceller = RunCanceller()
+        ticket.set_cancel_hook(canceller.cancel)
+        try:
+            try:
+                if not ticket.wait(SCHED_QUEUE_TIMEOUT):
+                    ticket.cancel()
+                    return jsonify({"error": f"Queue timeout ({SCHED_QUEUE_TIMEOUT:g}s)", "queue": SCHEDULER.stats()}), 503
+            except JobCancelled:
+                return jsonify(cancelled_result(exec_type, code))
+            
+            with cancellable(canceller):
+                result = run_execute(exec_type, code, sess, user_id)
+            if ticket.cancelled:
+                result = cancelled_result(exec_type, code, result.get("output", ""))
+        finally:
+            # Work still running in a thread (cancelled, or left by a timeout) keeps the slot until it stops
+            canceller.finish(TIMEOUT)
+            ticket.release()
         
         return jsonify(result)
     
@@ -240,9 +401,39 @@ def execute():
         return jsonify({"error": str(e), "traceback": traceback.format_exc()}), 500
 
 
-def execute_shell(cmdline: str, sess: dict) -> dict:
-    """Execute shell command."""
-    cmdline = normalize_code(cmdline)
+def run_execute(exec_type: str, code: str, sess: dict, user_id: int) -> dict:
+    """Dispatch one /api/execute run by type (blocking)."""
+    if exec_type == "sh":
+        return execute_shell(code, sess, user_id)
+    if exec_type == "py":
+        return execute_python(code, user_id)
+    if exec_type == "js":
+        return execute_js(code, sess, user_id)
+    return execute_java(code, sess)
+
+
+def submit(fn, *args):
+    """executor.submit that carries the caller's context (the run's RunCanceller) into the worker thread."""
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def cancelled_result(exec_type: str, code: str, output: str = "") -> dict:
+    """Result for a job cancelled through /api/cancel."""
+    return {
+        "type": exec_type,
+        "code": code,
+        "output": output,
+        "error": "Cancelled",
+        "exit_code": -1,
+        "timestamp": time.time(),
+    }
+
+
+def prepare_shell(cmdline: str, sess: dict, user_id: int) -> tuple[dict, bool]:
+    """
+    Builtins and allowlist check shared by the sync and async servers.
+    Returns (result, done): done=True means result is final and nothing should run.
+    """
     result = {
         "type": "sh",
         "code": cmdline,
@@ -256,10 +447,11 @@ def execute_shell(cmdline: str, sess: dict) -> dict:
     # Only handles simple commands, compound commands go to shell
     builtin_resp = handle_builtins(sess, cmdline)
     if builtin_resp is not None:
+        save_session(user_id, sess)
         result["output"] = builtin_resp
         if builtin_resp.startswith("❌") or builtin_resp.startswith("❗"):
             result["exit_code"] = 1
-        return result
+        return result, True
     
     # Check permission
     if not ALLOW_ALL_COMMANDS:
@@ -270,15 +462,25 @@ def execute_shell(cmdline: str, sess: dict) -> dict:
                 if first_token and first_token not in ALLOWED_CMDS:
                     result["error"] = f"Command not allowed: {first_token}"
                     result["exit_code"] = 1
-                    return result
+                    return result, True
         except ValueError:
             result["error"] = "Parse error"
             result["exit_code"] = 1
-            return result
+            return result, True
+    
+    return result, False
+
+
+def execute_shell(cmdline: str, sess: dict, user_id: int) -> dict:
+    """Execute shell command."""
+    cmdline = normalize_code(cmdline)
+    result, done = prepare_shell(cmdline, sess, user_id)
+    if done:
+        return result
     
     try:
         shell_exec = SHELL_EXECUTABLE or "/bin/bash"
-        future = executor.submit(run_shell_blocking, shell_exec, cmdline, sess["cwd"], sess["env"], TIMEOUT)
+        future = submit(run_shell_blocking, shell_exec, cmdline, sess["cwd"], sess["env"], TIMEOUT)
         try:
             p = future.result(timeout=TIMEOUT + 5)  # Extra time for thread overhead
             result["output"] = truncate(p.stdout or "", MAX_OUTPUT)
@@ -298,6 +500,12 @@ def execute_shell(cmdline: str, sess: dict) -> dict:
     return result
 
 
+def _exec_in_user_context(user_id: int, src: str) -> tuple[str, str, str | None]:
+    """Run src in the user's persistent namespace (kept from eviction while it runs)."""
+    with PY_CONTEXT.use(user_id) as ctx:
+        return exec_python_in_context(src, ctx)
+
+
 def execute_python(code: str, user_id: int) -> dict:
     """Execute Python code in shared context with timeout."""
     cleaned = textwrap.dedent(code)
@@ -312,33 +520,35 @@ def execute_python(code: str, user_id: int) -> dict:
         "timestamp": time.time(),
     }
     
-    # Get or create context for user
-    ctx = PY_CONTEXT.get(user_id)
-    if ctx is None:
-        ctx = {"__builtins__": __builtins__, "__name__": "__main__"}
-        PY_CONTEXT[user_id] = ctx
-    
+    future = None
     try:
-        # Execute with timeout using ThreadPoolExecutor
-        future = executor.submit(exec_python_in_context, cleaned, ctx)
-        try:
+        if PY_POOL is not None:
+            # Runs in a worker process that is killed and replaced on timeout,
+            # so no thread keeps burning CPU after the request gives up
+            out, err, tb_text = PY_POOL.execute(user_id, cleaned, TIMEOUT)
+        else:
+            # Execute in the user's context with timeout using ThreadPoolExecutor
+            future = submit(_exec_in_user_context, user_id, cleaned)
             out, err, tb_text = future.result(timeout=TIMEOUT)
-            result["output"] = truncate(out, MAX_OUTPUT)
-            
-            # Preserve both stderr and traceback (don't overwrite)
-            error_parts = []
-            if err and err.strip():
-                error_parts.append(err.rstrip())
-            if tb_text and tb_text.strip():
-                error_parts.append(tb_text.rstrip())
-                result["exit_code"] = 1
-            
-            result["error"] = "\n".join(error_parts)
-            
-        except FuturesTimeoutError:
+        
+        result["output"] = truncate(out, MAX_OUTPUT)
+        
+        # Preserve both stderr and traceback (don't overwrite)
+        error_parts = []
+        if err and err.strip():
+            error_parts.append(err.rstrip())
+        if tb_text and tb_text.strip():
+            error_parts.append(tb_text.rstrip())
+            result["exit_code"] = 1
+        
+        result["error"] = "\n".join(error_parts)
+    
+    except FuturesTimeoutError:
+        # Also catches the pool's TimeoutError (same class since Python 3.11)
+        if future is not None:
             future.cancel()
-            result["error"] = f"Timeout ({TIMEOUT}s)"
-            result["exit_code"] = -1
+        result["error"] = f"Timeout ({TIMEOUT}s)"
+        result["exit_code"] = -1
     except Exception as e:
         result["error"] = str(e)
         result["exit_code"] = 1
@@ -378,7 +588,7 @@ def _execute_external_code(
     }
     
     try:
-        future = executor.submit(run_func, cleaned, sess["cwd"], sess["env"], TIMEOUT)
+        future = submit(run_func, cleaned, sess["cwd"], sess["env"], TIMEOUT)
         try:
             p = future.result(timeout=TIMEOUT + extra_timeout)
             result["output"] = truncate(p.stdout or "", MAX_OUTPUT)
@@ -401,17 +611,18 @@ def _execute_external_code(
     return result
 
 
-def execute_js(code: str, sess: dict) -> dict:
-    """Execute JavaScript code with Node.js."""
+def execute_js(code: str, sess: dict, user_id: int = 0) -> dict:
+    """Execute JavaScript code with Node.js (warm per-user worker when JS_WORKER=1)."""
+    run_func = functools.partial(run_js, f"web:{user_id}")
     return _execute_external_code(
-        code, sess, "js", run_js_blocking, "Node.js not found", extra_timeout=5
+        code, sess, "js", run_func, "Node.js not found", extra_timeout=5
     )
 
 
 def execute_java(code: str, sess: dict) -> dict:
     """Execute Java code."""
     return _execute_external_code(
-        code, sess, "java", run_java_blocking, "Java not found", extra_timeout=10
+        code, sess, "java", run_java, "Java not found", extra_timeout=10
     )
 
 
@@ -428,17 +639,54 @@ def get_session_info():
     })
 
 
+@app.route("/api/auth", methods=["POST"])
+@require_auth
+def auth_token():
+    """Exchange Telegram init data for a session token (send it as X-Session-Token)."""
+    if request.auth_method == "token":
+        return jsonify({"error": "Unauthorized", "message": "Send X-Telegram-Init-Data to get a token"}), 401
+    token, expires_at = issue_session_token(request.user_id, request.user_data)
+    return jsonify({"token": token, "expires_at": expires_at, "user_id": request.user_id})
+
+
 @app.route("/api/session/reset", methods=["POST"])
 @require_auth
 def reset_session():
-    """Reset session."""
+    """Reset session. Revokes the user's session tokens and returns a fresh one."""
+    user_id = getattr(request, "user_id", 0)
+    reset_user_state(user_id)
+    revoke_session_tokens(user_id)
+    token, expires_at = issue_session_token(user_id)
+    return jsonify({"status": "ok", "message": "Session reset", "token": token, "expires_at": expires_at})
+
+
+def reset_user_state(user_id: int):
+    """Drop the user's shell session, Python context and JS worker."""
+    webapp_sessions.drop(user_id)
+    PY_CONTEXT.pop(user_id, None)
+    if PY_POOL is not None:
+        PY_POOL.reset(user_id)
+    reset_js(f"web:{user_id}")
+
+
+@app.route("/api/queue", methods=["GET"])
+@require_auth
+def queue_status():
+    """Return the user's queued/running jobs and overall scheduler load."""
+    user_id = getattr(request, "user_id", 0)
+    return jsonify({"jobs": SCHEDULER.user_jobs(user_id), "scheduler": SCHEDULER.stats()})
+
+
+@app.route("/api/cancel", methods=["POST"])
+@require_auth
+def cancel_jobs():
+    """Cancel the user's jobs: {"id": <job id>} for one, empty body for all."""
     user_id = getattr(request, "user_id", 0)
-    with webapp_sessions_lock:
-        if user_id in webapp_sessions:
-            del webapp_sessions[user_id]
-        if user_id in PY_CONTEXT:
-            del PY_CONTEXT[user_id]
-    return jsonify({"status": "ok", "message": "Session reset"})
+    data = request.get_json(silent=True) or {}
+    job_id = data.get("id")
+    if job_id is not None and not isinstance(job_id, int):
+        return jsonify({"error": "id must be an integer"}), 400
+    return jsonify({"status": "ok", "cancelled": SCHEDULER.cancel_user(user_id, job_id)})
 
 
 @app.route("/api/commands", methods=["GET"])
@@ -453,48 +701,41 @@ def list_commands():
 
 # ==== PTY WebSocket Terminal ====
 
-def validate_ws_auth(ws) -> int | None:
+def validate_ws_auth(ws) -> tuple[int | None, dict]:
     """
     Validate WebSocket authentication.
-    Returns user_id if valid, None otherwise.
+    Returns (user_id, auth message); user_id is None if invalid. The auth
+    message also carries client options (e.g. "binary", see pty_io).
     """
-    # Development mode - skip authentication
+    try:
+        # Wait for auth message (first message should be auth)
+        auth_msg = ws.receive(timeout=5)
+        auth_data = json.loads(auth_msg) if auth_msg else {}
+        if not isinstance(auth_data, dict):
+            auth_data = {}
+    except Exception:
+        auth_data = {}
+    
+    # Development mode - skip authentication (the message is still consumed)
     if DEV_MODE:
-        # Still need to receive and discard auth message to keep protocol consistent
-        try:
-            ws.receive(timeout=5)
-        except Exception:
-            pass
-        return 0
+        return 0, auth_data
     
     # Production mode - require BOT_TOKEN
     if not BOT_TOKEN:
-        return None
+        return None, auth_data
     
     try:
-        # Wait for auth message (first message should be auth)
-        auth_msg = ws.receive(timeout=5)
-        if not auth_msg:
-            return None
-        
-        auth_data = json.loads(auth_msg)
         if auth_data.get("type") != "auth":
-            return None
-        
-        init_data = auth_data.get("init_data", "")
-        data = validate_telegram_webapp_data(init_data)
-        if not data:
-            return None
+            return None, auth_data
         
-        user = data.get("user", {})
-        user_id = user.get("id", 0)
+        # A session token (from /api/auth) skips the init data check on reconnect
+        user_id, _, _ = resolve_user(auth_data.get("init_data", ""), auth_data.get("token", ""))
+        if user_id is None or user_id not in OWNER_IDS:
+            return None, auth_data
         
-        if user_id not in OWNER_IDS:
-            return None
-        
-        return user_id
+        return user_id, auth_data
     except Exception:
-        return None
+        return None, auth_data
 
 
 import uuid as _uuid_module  # For generating unique session IDs
@@ -507,6 +748,16 @@ def _close_pty_session_internal(session: dict):
     if not session:
         return
     
+    # A session can be closed twice (new tab + old connection cleanup); closing
+    # master_fd again could hit an unrelated fd that reused the number
+    with pty_sessions_lock:
+        if session.get("closed"):
+            return
+        session["closed"] = True
+    
+    # Make sure the shared reader no longer watches the fd before it is closed
+    get_pty_reactor().remove(session["master_fd"])
+    
     try:
         os.close(session["master_fd"])
     except Exception:
@@ -572,7 +823,7 @@ def create_pty_session(user_id: int) -> dict:
                     pass
                 
                 # Set environment
-                env = sess["env"].copy()
+                env = materialize_env(sess["env"])
                 env["TERM"] = "xterm-256color"
                 env["COLORTERM"] = "truecolor"
                 
@@ -672,7 +923,6 @@ def close_pty_session(session: dict):
 try:
     import pty
     import struct
-    import select
     import termios
     import fcntl
     PTY_AVAILABLE = True
@@ -711,7 +961,7 @@ def ws_terminal(ws):
         return
     
     # Authenticate
-    user_id = validate_ws_auth(ws)
+    user_id, auth_data = validate_ws_auth(ws)
     if user_id is None:
         ws.send(json.dumps({
             "type": "error",
@@ -721,8 +971,9 @@ def ws_terminal(ws):
 
     reporter.report_activity(user_id)
     
-    # Send auth success
-    ws.send(json.dumps({"type": "auth_ok", "user_id": user_id}))
+    # Send auth success (and whether the binary frame protocol is on)
+    binary = wants_binary(auth_data)
+    ws.send(json.dumps({"type": "auth_ok", "user_id": user_id, "binary": binary}))
     
     # Create PTY session
     try:
@@ -738,13 +989,8 @@ def ws_terminal(ws):
     try:
         master_fd = pty_session["master_fd"]
         
-        # Set non-blocking mode
-        flags = fcntl.fcntl(master_fd, fcntl.F_GETFL)
-        fcntl.fcntl(master_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
-        
         # Lock for thread-safe WebSocket sends
         ws_send_lock = Lock()
-        reader_running = True
         
         def safe_ws_send(data):
             """Thread-safe WebSocket send."""
@@ -754,33 +1000,22 @@ def ws_terminal(ws):
             except Exception:
                 pass
         
-        # Read from PTY and send to WebSocket
-        def read_pty():
-            nonlocal reader_running
-            while reader_running:
-                try:
-                    readable, _, _ = select.select([master_fd], [], [], 0.1)
-                    if master_fd in readable:
-                        try:
-                            data = os.read(master_fd, 4096)
-                            if data:
-                                safe_ws_send(json.dumps({
-                                    "type": "output",
-                                    "data": data.decode("utf-8", errors="replace")
-                                }))
-                            else:
-                                # EOF
-                                safe_ws_send(json.dumps({"type": "exit"}))
-                                break
-                        except OSError:
-                            safe_ws_send(json.dumps({"type": "exit"}))
-                            break
-                except Exception:
-                    break
+        # PTY output is read by the shared reactor (pty_io) and arrives here as
+        # coalesced frames; the decoder keeps multi-byte chars split across frames intact
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
         
-        # Start PTY reader thread
-        reader_thread = Thread(target=read_pty, daemon=True)
-        reader_thread.start()
+        def send_output(frame: bytes):
+            if binary:
+                with ws_send_lock:
+                    ws.send(encode_frame(OP_OUTPUT, frame))
+                return
+            text = decoder.decode(frame)
+            if text:
+                with ws_send_lock:
+                    ws.send(json.dumps({"type": "output", "data": text}))
+        
+        exit_msg = encode_frame(OP_EXIT) if binary else json.dumps({"type": "exit"})
+        get_pty_reactor().add(master_fd, send_output, on_close=lambda: safe_ws_send(exit_msg))
         
         # Main loop - receive from WebSocket and write to PTY
         try:
@@ -789,6 +1024,20 @@ def ws_terminal(ws):
                 if msg is None:
                     break
                 
+                if isinstance(msg, (bytes, bytearray)):
+                    # Binary protocol: type byte + payload
+                    op, payload = decode_frame(msg)
+                    if op == OP_INPUT:
+                        if payload:
+                            os.write(master_fd, payload)
+                    elif op == OP_RESIZE:
+                        size = decode_resize(payload)
+                        if size:
+                            resize_pty(master_fd, *size)
+                    elif op == OP_PING:
+                        safe_ws_send(encode_frame(OP_PONG))
+                    continue
+                
                 try:
                     data = json.loads(msg)
                     msg_type = data.get("type")
@@ -814,10 +1063,6 @@ def ws_terminal(ws):
         
         except Exception:
             pass
-        
-        finally:
-            # Stop reader thread
-            reader_running = False
     
     finally:
         # Cleanup this specific PTY session (not by user_id to avoid race condition)